@@ -3,8 +3,11 @@ import h5py as h5
 import glob
 from scipy.signal import butter, filtfilt, welch
 from scipy.ndimage.filters import gaussian_filter1d
+import matplotlib.pyplot as plt
 import os
 
+from instrumentation import stage
+
 mouse = '439183' 
 
 remote_server = '/mnt/sd5.2'
@@ -19,10 +22,14 @@ probes = ('probeA', 'probeB', 'probeC', 'probeD', 'probeE', 'probeF')
 
 for probe_idx, probe in enumerate(probes[:]):
 
+    probe_stage = stage('probe', probe=probe).start()
+
     remote_directory = glob.glob(remote_server + '/*' + mouse + '*/*' + mouse + '*' + probe + '_sorted/continuous/Neuropix*100.1')[0]
 
     print(remote_directory)
 
+    loading = stage('load_data', probe=probe).start()
+
     raw_data = np.memmap(remote_directory + '/continuous.dat', dtype='int16')
     data = np.reshape(raw_data, (int(raw_data.size / 384), 384))
     
@@ -33,8 +40,13 @@ for probe_idx, probe in enumerate(probes[:]):
     
     D = data[start_index:end_index,:]*0.195
 
+    loading.stop()
+    filtering = stage('filter', probe=probe).start()
+
     for i in range(D.shape[1]):
        D[:,i] = filtfilt(b,a,D[:,i])
+
+    filtering.stop()
       
     M = np.median(D[:,370:])
        
@@ -46,9 +58,13 @@ for probe_idx, probe in enumerate(probes[:]):
         
     power = np.zeros((int(nfft/2+1), channels.size))
 
+    spectrum = stage('power_spectrum', probe=probe).start()
+
     for channel in range(D.shape[1]):
         sample_frequencies, Pxx_den = welch(D[:,channel], fs=2500, nfft=nfft)
         power[:,channel] = Pxx_den
+
+    spectrum.stop()
         
     in_range = (sample_frequencies > 0) * (sample_frequencies < 10)
 
@@ -99,4 +115,6 @@ for probe_idx, probe in enumerate(probes[:]):
         plt.close(fig)
     except KeyError:
         print("probe not found.")
+
+    probe_stage.stop()
         
\ No newline at end of file
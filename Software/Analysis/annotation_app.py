@@ -18,6 +18,8 @@ import pandas as pd
 
 import os
 
+from volume_io import load_volume
+
 DEFAULT_SLICE = 400
 DEFAULT_VIEW = 0
 
@@ -326,7 +328,7 @@ class App(QWidget):
 
         if fname.split('.')[-1] == '001':
 
-            self.volume = self.loadVolume(fname)
+            self.volume = load_volume(fname)
             self.data_loaded = True
             self.setWindowTitle(os.path.basename(fname))
             
@@ -345,24 +347,6 @@ class App(QWidget):
         if self.data_loaded:
             self.annotations.to_csv(self.output_file)
 
-    def loadVolume(self, fname, _dtype='u1', num_slices=1023):
-        
-        dtype = np.dtype(_dtype)
-
-        volume = np.fromfile(fname, dtype) # read it in
-
-        z_size = np.sum([volume[1], volume[2] << pow(2,3)])
-        x_size = np.sum([(val << pow(2,i+1)) for i, val in enumerate(volume[8:4:-1])])
-        y_size = np.sum([(val << pow(2,i+1)) for i, val in enumerate(volume[12:8:-1])])
-        
-        fsize = np.array([z_size, x_size, y_size]).astype('int')
-
-        volume = np.reshape(volume[13:], fsize) # remove 13-byte header and reshape
-        
-        print("Data loaded.")
-        
-        return volume
-
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -0,0 +1,361 @@
+"""
+
+Runs opt_volume_creator.py for many mice
+
+Usage:
+
+    python batch_volume_creator.py [options] <transforms.json | glob | list.txt> ...
+
+Each argument is a transforms.json file, a glob pattern matching several
+of them (quote it so the shell does not expand it), or a text file listing
+one transforms.json path per line.
+
+Every mouse runs as a separate opt_volume_creator.py process, so a failure
+or crash only affects that mouse. Jobs are started as long as the sum of
+their estimated peak memory stays within the budget.
+
+Batch options:
+
+    -j, --jobs N        maximum number of mice processed at once
+                        (default = number of cores / workers per mouse)
+    -m, --memory GB     memory budget (default = currently available memory)
+    --summary FILE      where to write the summary table
+                        (default = batch_summary.csv)
+
+All other options (--workers, --threads, --engine, --channels, --format,
+--resume, ...) are passed on to opt_volume_creator.py. The output of each
+mouse is written to opt_volume_creator.log next to its transforms.json.
+
+"""
+
+import glob
+import json
+import os
+import subprocess
+import threading
+import time
+
+import sys, getopt
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import opt_volume_creator
+from opt_volume_creator import available_memory, estimate_channel_memory
+
+GB = pow(1024, 3)
+
+
+def find_transforms(sources):
+
+    """
+    Expands transforms.json files, glob patterns and list files into a
+    sorted list of transforms.json paths
+
+    """
+
+    filenames = []
+
+    for source in sources:
+
+        if source.endswith('.txt'):
+            with open(source) as f:
+                filenames += [line.strip() for line in f
+                              if len(line.strip()) > 0 and not line.startswith('#')]
+        else:
+            matches = glob.glob(source)
+            if len(matches) == 0:
+                print('WARNING: no files match ' + source)
+            filenames += matches
+
+    return sorted(set(os.path.abspath(f) for f in filenames))
+
+
+def job_memory(imwidth=1488, engine='sequential', num_channels=2,
+               grid_size=1024, memory_limit=None):
+
+    """
+    Estimates the peak memory of one opt_volume_creator.py process in bytes
+
+    Each channel needs estimate_channel_memory(); the pyramid levels of a
+    finished volume add about 1/7 of the output volume. Out-of-core jobs
+    (memory_limit given) stay within their limit.
+
+    """
+
+    if memory_limit is not None:
+        return memory_limit
+
+    output_size = (grid_size - 1) * grid_size * grid_size
+
+    return num_channels * (estimate_channel_memory(imwidth, engine, grid_size) +
+                           output_size // 7)
+
+
+def job_channels(imwidth=1488, engine='sequential', grid_size=1024,
+                 memory_limit=None, memory_budget=None):
+
+    """
+    Returns the number of channels one process should handle at once: 2
+    if a job processing both fits in memory_budget (or the budget is
+    unknown), otherwise 1
+
+    """
+
+    if memory_budget is None:
+        return 2
+
+    if job_memory(imwidth, engine, 2, grid_size, memory_limit) <= memory_budget:
+        return 2
+
+    return 1
+
+
+class MemoryBudget:
+
+    """
+    Hands out memory reservations without exceeding a total budget
+
+    A reservation larger than the whole budget is granted when nothing
+    else is reserved, so that it runs alone instead of never running.
+
+    """
+
+    def __init__(self, total):
+
+        self.total = total
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+
+        with self.condition:
+            while self.reserved > 0 and self.reserved + amount > self.total:
+                self.condition.wait()
+            self.reserved += amount
+
+    def release(self, amount):
+
+        with self.condition:
+            self.reserved -= amount
+            self.condition.notify_all()
+
+
+def run_job(transforms_file, mouse, options, budget, memory):
+
+    """
+    Runs opt_volume_creator.py for one mouse, once its memory is available
+
+    Returns
+    =======
+    row - dictionary with the timing and outcome of the job
+
+    """
+
+    log_file = os.path.join(os.path.dirname(transforms_file),
+                            'opt_volume_creator.log')
+
+    command = ([sys.executable, os.path.abspath(opt_volume_creator.__file__)] +
+               options + [transforms_file])
+
+    queued = time.time()
+    budget.acquire(memory)
+    start = time.time()
+
+    print('Starting mouse ' + str(mouse) + ' (' + transforms_file + ')')
+
+    error = None
+
+    try:
+        with open(log_file, 'w') as log:
+            returncode = subprocess.call(command, stdout=log,
+                                         stderr=subprocess.STDOUT)
+    except OSError as err:
+        print('ERROR: could not start mouse ' + str(mouse) + ': ' + str(err))
+        returncode = None
+        error = str(err)
+    finally:
+        budget.release(memory)
+
+    elapsed = time.time() - start
+    status = 'done' if returncode == 0 else 'failed'
+
+    print('Finished mouse ' + str(mouse) + ' (' + status + ', ' +
+          str(int(elapsed)) + ' s)')
+
+    return {'mouse': mouse,
+            'transforms': transforms_file,
+            'status': status,
+            'returncode': returncode,
+            'wait_s': round(start - queued, 1),
+            'elapsed_s': round(elapsed, 1),
+            'memory_gb': round(memory / GB, 2),
+            'log': log_file,
+            'error': error}
+
+
+def failed_job(transforms_file, error):
+
+    """
+    Returns the summary row of a job that could not be started
+
+    """
+
+    print('ERROR: could not read ' + transforms_file + ': ' + str(error))
+
+    return {'mouse': '',
+            'transforms': transforms_file,
+            'status': 'failed',
+            'returncode': None,
+            'wait_s': 0.0,
+            'elapsed_s': 0.0,
+            'memory_gb': 0.0,
+            'log': None,
+            'error': str(error)}
+
+
+def run_batch(transforms_files, options, num_jobs=1, memory_budget=None,
+              engine='sequential', num_channels=None, grid_size=1024,
+              memory_limit=None):
+
+    """
+    Processes a list of mice on a pool of num_jobs concurrent processes
+
+    Parameters
+    ==========
+    transforms_files - list of transforms.json paths
+    options - list of command-line options for opt_volume_creator.py
+    num_jobs - maximum number of concurrent processes
+    memory_budget - maximum total estimated memory in bytes
+                    (default = available memory)
+    engine - engine used by opt_volume_creator.py (for the memory estimate)
+    num_channels - channels processed at once by each process; if None,
+                   chosen for each mouse (see job_channels) and passed on
+                   as --channels
+    grid_size, memory_limit - the --grid-size and --memory-limit of each
+                              process, in voxels and bytes
+
+    Returns
+    =======
+    summary - pd.DataFrame with one row per mouse
+
+    """
+
+    if memory_budget is None:
+        memory_budget = available_memory()
+
+    # an unknown budget runs one mouse at a time
+    budget = MemoryBudget(0 if memory_budget is None else memory_budget)
+
+    print('Processing ' + str(len(transforms_files)) + ' mice, up to ' +
+          str(num_jobs) + ' at a time within ' +
+          str(round(budget.total / GB, 1)) + ' GB')
+
+    def run(transforms_file):
+
+        # a missing or malformed transforms.json only fails this mouse
+        try:
+            with open(transforms_file) as f:
+                transforms = json.load(f)
+
+            mouse = transforms.get('mouse', '')
+            imwidth = int(transforms.get('imwidth', 1488))
+        except Exception as err:
+            return failed_job(transforms_file, err)
+
+        if num_channels is None:
+            channels = job_channels(imwidth, engine, grid_size, memory_limit,
+                                    memory_budget)
+            job_options = options + ['--channels', str(channels)]
+        else:
+            channels = num_channels
+            job_options = options
+
+        memory = job_memory(imwidth, engine, channels, grid_size,
+                            memory_limit)
+
+        return run_job(transforms_file, mouse, job_options, budget, memory)
+
+    with ThreadPoolExecutor(num_jobs) as executor:
+        rows = list(executor.map(run, transforms_files))
+
+    return pd.DataFrame(rows)
+
+
+def main(argv):
+
+    try:
+        opts, argv = getopt.gnu_getopt(argv,
+                                       'j:m:' + opt_volume_creator.OPTIONS,
+                                       ['jobs=', 'memory=', 'summary='] +
+                                       opt_volume_creator.LONG_OPTIONS)
+    except getopt.GetoptError as err:
+        print('ERROR: ' + str(err))
+        return 1
+
+    num_jobs = None
+    memory_budget = None
+    summary_file = 'batch_summary.csv'
+
+    engine = 'sequential'
+    num_channels = None
+    num_workers = 1
+    num_threads = 1
+    grid_size = 1024
+    memory_limit = None
+
+    options = []
+
+    for opt, value in opts:
+        if opt in ('-j', '--jobs'):
+            num_jobs = int(value)
+        elif opt in ('-m', '--memory'):
+            memory_budget = int(float(value) * GB)
+        elif opt == '--summary':
+            summary_file = value
+        elif opt in ('-n', '--channels'):
+            # a process has at most 2 channels; the same value is used for
+            # the memory estimate
+            num_channels = min(max(int(value), 1), 2)
+            options += [opt, str(num_channels)]
+        else:
+            options += [opt, value] if len(value) > 0 else [opt]
+
+            if opt in ('-e', '--engine'):
+                engine = value
+            elif opt in ('-w', '--workers'):
+                num_workers = int(value)
+            elif opt in ('-t', '--threads'):
+                num_threads = int(value)
+            elif opt == '--grid-size':
+                grid_size = int(value)
+            elif opt == '--memory-limit':
+                memory_limit = int(float(value) * GB)
+
+    # without --channels, run_batch fixes the number of channels of each
+    # mouse, so that the memory estimate holds
+    if num_jobs is None:
+        num_jobs = max(1, (os.cpu_count() or 1) //
+                       (max(num_workers, num_threads) * (num_channels or 2)))
+
+    transforms_files = find_transforms(argv)
+
+    if len(transforms_files) == 0:
+        print('ERROR: Required input argument (transforms.json files, glob patterns or list files)')
+        return 1
+
+    summary = run_batch(transforms_files, options, num_jobs, memory_budget,
+                        engine, num_channels, grid_size, memory_limit)
+
+    print()
+    print(summary[['mouse', 'status', 'wait_s', 'elapsed_s', 'memory_gb']].to_string(index=False))
+
+    summary.to_csv(summary_file, index=False)
+    print('Summary written to ' + summary_file)
+
+    return 0 if (summary['status'] == 'done').all() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
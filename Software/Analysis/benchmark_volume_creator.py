@@ -0,0 +1,613 @@
+"""
+
+Benchmarks for the volume creation pipeline
+
+Generates a synthetic stack of reconstructed slices (imgRot__rec*.tif for
+the fluor and trans channels, plus a transforms.json), times the
+individual stages of opt_volume_creator.py and whole process_volume runs,
+and writes the results to a JSON file.
+
+Usage:
+
+    python benchmark_volume_creator.py [options]
+
+Options:
+
+    --image-size N      width and height of the synthetic slices (default = 2052)
+    --imwidth N         width of the cropped region and number of slices
+                        (default = 1488)
+    --unique-slices N   number of distinct slice files; the others are
+                        links to them (default = 16)
+    --data DIR          where to write the synthetic stack (default = a
+                        temporary directory, removed afterwards)
+    --repeats N         number of times each stage is timed (default = 3)
+    --engines LIST      comma-separated engines for whole runs
+                        (default = sequential,fused; 'none' skips them)
+    --workers N         worker processes for whole runs (default = 1)
+    --threads N         threads for whole runs (default = 1)
+    --stages LIST       comma-separated stages to time (default = all;
+                        'none' skips them)
+    -o, --output FILE   results file (default = benchmark_results.json)
+    --baseline FILE     earlier results file to compare against
+    --tolerance X       slowdown (as a fraction) above which a result counts
+                        as a regression (default = 0.2)
+
+Stage timings are the fastest of the repeats; the memory reported for a
+stage is the peak resident memory (RSS) of the process while it runs.
+Whole runs are done in a separate process and report its peak RSS and,
+separately, the peak of the summed RSS of its worker processes (which
+counts memory shared between them, e.g. the slice buffer, once per
+process). Stage and worker memory are only measured on Linux (None
+elsewhere). The exit status is 1 if any result is slower than the
+baseline by more than the tolerance.
+
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import sys, getopt
+
+import numpy as np
+from PIL import Image
+
+import opt_volume_creator as ovc
+
+STAGES = ('read_image', 'open_image', 'process_image', 'process_image_lut',
+          'load_slices', 'resize_volume', 'transpose_volume', 'rotate_volume',
+          'save_volume')
+
+
+def synthetic_slice(image_size, index, num_slices, seed=0):
+
+    """
+    Creates one uint16 slice: a noisy background with an elliptical
+    'brain' whose size varies along the stack
+
+    """
+
+    rng = np.random.RandomState(seed + index)
+
+    y, x = np.ogrid[:image_size, :image_size]
+    center = (image_size - 1) / 2
+
+    radius = image_size / 4 * (0.5 + np.sin(np.pi * (index + 0.5) / num_slices))
+    inside = (pow((x - center) / radius, 2) +
+              pow((y - center) / (0.8 * radius), 2)) < 1
+
+    imarray = rng.normal(28000, 4000, (image_size, image_size))
+    imarray[inside] += 16000
+
+    return np.clip(imarray, 0, 65535).astype('uint16')
+
+
+def generate_stack(directory, image_size=2052, num_slices=1488,
+                   unique_slices=16, imwidth=1488):
+
+    """
+    Writes a synthetic dataset with the layout expected by
+    opt_volume_creator.py
+
+    Only unique_slices distinct images are written; the other slice files
+    are hard links to them (or copies, where links are not supported).
+
+    Returns
+    =======
+    transforms_file - path of the transforms.json file
+
+    """
+
+    for image_type in ('fluor', 'trans'):
+
+        recon_directory = os.path.join(directory, image_type, 'native', 'recon')
+        os.makedirs(recon_directory, exist_ok=True)
+
+        unique_files = []
+
+        for i in range(num_slices):
+
+            fname = os.path.join(recon_directory, 'imgRot__rec%08d.tif' % i)
+
+            if i < unique_slices:
+                index = i * num_slices // unique_slices
+                Image.fromarray(synthetic_slice(image_size, index, num_slices)).save(fname)
+                unique_files.append(fname)
+            else:
+                source = unique_files[i * unique_slices // num_slices]
+                try:
+                    os.link(source, fname)
+                except OSError:
+                    shutil.copyfile(source, fname)
+
+    transforms = {'location': directory,
+                  'output_directory': os.path.join(directory, 'output'),
+                  'mouse': 'benchmark',
+                  'rot1': 3.0, 'rot2': -2.0, 'rot3': 1.5,
+                  'offset1': 10, 'offset2': -10,
+                  'flip_image': False,
+                  'imwidth': imwidth}
+
+    transforms_file = os.path.join(directory, 'transforms.json')
+
+    with open(transforms_file, 'w') as f:
+        json.dump(transforms, f, indent=2)
+
+    return transforms_file
+
+
+def reset_peak_rss():
+
+    """
+    Resets the peak resident memory (VmHWM) of this process to its current
+    resident memory (Linux 4.0 and later)
+
+    Returns
+    =======
+    reset - False if this is not supported
+
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+
+    """
+    Returns the peak resident memory of this process in bytes (Linux), or
+    None
+
+    """
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def descendant_rss(pid):
+
+    """
+    Returns the summed resident memory in bytes of all descendants of a
+    process (e.g. its multiprocessing workers), from /proc (Linux)
+
+    """
+
+    parents = {}
+
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/' + entry + '/stat') as f:
+                    stat = f.read()
+                # the fields after the command name are state, ppid, ...
+                parents[int(entry)] = int(stat[stat.rindex(')') + 1:].split()[1])
+            except (OSError, ValueError, IndexError):
+                pass
+
+    descendants = []
+    pids = [pid]
+
+    while len(pids) > 0:
+        pids = [child for child, parent in parents.items() if parent in pids]
+        descendants += pids
+
+    total = 0
+
+    for child in descendants:
+        try:
+            with open('/proc/' + str(child) + '/statm') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            pass
+
+    return total
+
+
+class WorkerMemory:
+
+    """
+    Tracks the peak summed resident memory of the descendants of this
+    process, sampled on a background thread (Linux)
+
+    Usage
+    =====
+    with WorkerMemory() as workers:
+        ...
+    workers.peak_mb
+
+    """
+
+    def __init__(self, interval=0.05):
+
+        self.interval = interval
+        self.peak = 0
+        self.available = os.path.isdir('/proc/self')
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, descendant_rss(os.getpid()))
+
+    @property
+    def peak_mb(self):
+
+        return self.peak / pow(2, 20) if self.available else None
+
+    def __enter__(self):
+
+        if self.available:
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.stopped.set()
+
+        if self.available:
+            self.thread.join()
+
+
+def format_mb(value):
+
+    return '     n/a' if value is None else '%8.1f' % value
+
+
+def time_stage(function, repeats=3):
+
+    """
+    Times function() repeats times
+
+    Returns
+    =======
+    seconds - fastest time
+    peak_mb - peak resident memory of the process during the first call
+              (MB), or None if it cannot be measured
+
+    """
+
+    reset = reset_peak_rss()
+
+    start = time.perf_counter()
+    function()
+    times = [time.perf_counter() - start]
+
+    peak = peak_rss() if reset else None
+
+    for i in range(repeats - 1):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times), None if peak is None else peak / pow(2, 20)
+
+
+def benchmark_stages(transforms_file, stages=STAGES, repeats=3):
+
+    """
+    Times the individual stages of opt_volume_creator.py on the synthetic
+    stack
+
+    Returns
+    =======
+    results - list of dictionaries (name, seconds, peak_mb)
+
+    """
+
+    with open(transforms_file) as f:
+        t = json.load(f)
+
+    imwidth = t['imwidth']
+    images = sorted(os.listdir(os.path.join(t['location'], 'fluor', 'native', 'recon')))
+    images = [os.path.join(t['location'], 'fluor', 'native', 'recon', image)
+              for image in images]
+
+    limit1, limit2 = 60, 180
+
+    imarray = ovc.open_image(images[0], t['rot1'], t['offset1'], t['offset2'],
+                             imwidth)
+    volume = np.random.RandomState(0).randint(0, 256, (1024, 1024, imwidth)).astype('uint8')
+
+    output_directory = tempfile.mkdtemp()
+
+    cases = {
+        'read_image':
+            lambda: ovc.read_image(images[0]),
+        'open_image':
+            lambda: ovc.open_image(images[0], t['rot1'], t['offset1'],
+                                   t['offset2'], imwidth),
+        'process_image':
+            lambda: ovc.process_image(imarray.copy(), limit1, limit2),
+        'process_image_lut':
+            lambda: ovc.process_image_lut(imarray, limit1, limit2),
+        'load_slices':
+            lambda: ovc.load_slices(images, t['rot1'], t['offset1'],
+                                    t['offset2'], imwidth, limit1, limit2),
+        'resize_volume':
+            lambda: ovc.resize_volume(volume),
+        'transpose_volume':
+            lambda: np.ascontiguousarray(ovc.transpose_volume(volume)),
+        'rotate_volume':
+            lambda: ovc.rotate_volume(volume, t['rot2'], axis=1),
+        'save_volume':
+            lambda: ovc.save_volume(volume, 'benchmark', output_directory,
+                                    'fluor'),
+    }
+
+    results = []
+
+    try:
+        for stage in stages:
+
+            # whole-stack stages are too slow to repeat
+            stage_repeats = 1 if stage in ('load_slices', 'resize_volume',
+                                           'rotate_volume') else repeats
+
+            seconds, peak_mb = time_stage(cases[stage], stage_repeats)
+
+            print('  %-20s %8.3f s  %s MB (peak RSS)' %
+                  (stage, seconds, format_mb(peak_mb)))
+
+            results.append({'name': 'stage:' + stage,
+                            'seconds': seconds,
+                            'peak_mb': peak_mb})
+    finally:
+        shutil.rmtree(output_directory, ignore_errors=True)
+
+    return results
+
+
+def benchmark_run(transforms_file, engine='sequential', num_workers=1,
+                  num_threads=1):
+
+    """
+    Times one whole process_volume run in a separate process
+
+    Returns
+    =======
+    result - dictionary (name, seconds, peak_mb, workers_peak_mb)
+
+    """
+
+    # The child is timed here; recording stages in it (OPT_PROFILE) would
+    # only add the sampler thread to the measurement
+    env = dict(os.environ)
+    env.pop('OPT_PROFILE', None)
+
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '--child', transforms_file,
+                                      '--engines', engine,
+                                      '--workers', str(num_workers),
+                                      '--threads', str(num_threads)],
+                                     env=env)
+
+    result = json.loads(output.decode().strip().splitlines()[-1])
+
+    print('  %-20s %8.3f s  %s MB (peak RSS), workers %s MB' %
+          (result['name'], result['seconds'], format_mb(result['peak_mb']),
+           format_mb(result['workers_peak_mb']).strip()))
+
+    return result
+
+
+def run_child(transforms_file, engine, num_workers, num_threads):
+
+    """
+    Runs process_volume once and prints its timing as the last line of
+    output (called by benchmark_run in a new process)
+
+    """
+
+    import resource
+
+    with open(transforms_file) as f:
+        t = json.load(f)
+
+    output_directory = t['output_directory']
+
+    start = time.perf_counter()
+
+    with WorkerMemory() as workers:
+        ovc.process_volume(t['location'], output_directory, t['mouse'],
+                           t['rot1'], t['rot2'], t['rot3'],
+                           t['offset1'], t['offset2'], t['flip_image'],
+                           imwidth=t['imwidth'], num_workers=num_workers,
+                           engine=engine, num_threads=num_threads,
+                           max_channels=1, histogram_samples=8)
+
+    seconds = time.perf_counter() - start
+
+    shutil.rmtree(output_directory, ignore_errors=True)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+    print(json.dumps({'name': 'run:' + engine,
+                      'seconds': seconds,
+                      'peak_mb': peak / pow(2, 20),
+                      'workers_peak_mb': workers.peak_mb}))
+
+
+def compare_to_baseline(results, baseline_file, tolerance=0.2):
+
+    """
+    Prints the change of each result relative to a baseline results file
+
+    Returns
+    =======
+    regressions - list of names whose time increased by more than tolerance
+
+    """
+
+    with open(baseline_file) as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+
+    regressions = []
+
+    print()
+    print('%-28s %10s %10s %8s' % ('benchmark', 'baseline', 'current', 'change'))
+
+    for result in results:
+
+        if result['name'] not in baseline:
+            continue
+
+        before = baseline[result['name']]['seconds']
+        change = result['seconds'] / before - 1
+
+        flag = ''
+        if change > tolerance:
+            regressions.append(result['name'])
+            flag = '  REGRESSION'
+
+        print('%-28s %9.3fs %9.3fs %+7.0f%%%s' %
+              (result['name'], before, result['seconds'], 100 * change, flag))
+
+    return regressions
+
+
+def main(argv):
+
+    try:
+        opts, argv = getopt.gnu_getopt(argv, 'o:',
+                                       ['image-size=', 'imwidth=',
+                                        'unique-slices=', 'data=', 'repeats=',
+                                        'engines=', 'workers=', 'threads=',
+                                        'stages=', 'output=', 'baseline=',
+                                        'tolerance=', 'child='])
+    except getopt.GetoptError as err:
+        print('ERROR: ' + str(err))
+        return 1
+
+    config = {'image_size': 2052,
+              'imwidth': 1488,
+              'unique_slices': 16,
+              'repeats': 3,
+              'engines': ['sequential', 'fused'],
+              'workers': 1,
+              'threads': 1,
+              'stages': list(STAGES)}
+
+    data_directory = None
+    output_file = 'benchmark_results.json'
+    baseline_file = None
+    tolerance = 0.2
+    child = None
+
+    for opt, value in opts:
+        if opt == '--image-size':
+            config['image_size'] = int(value)
+        elif opt == '--imwidth':
+            config['imwidth'] = int(value)
+        elif opt == '--unique-slices':
+            config['unique_slices'] = int(value)
+        elif opt == '--data':
+            data_directory = value
+        elif opt == '--repeats':
+            config['repeats'] = int(value)
+        elif opt == '--engines':
+            config['engines'] = [] if value == 'none' else value.split(',')
+        elif opt == '--workers':
+            config['workers'] = int(value)
+        elif opt == '--threads':
+            config['threads'] = int(value)
+        elif opt == '--stages':
+            config['stages'] = [] if value == 'none' else value.split(',')
+        elif opt in ('-o', '--output'):
+            output_file = value
+        elif opt == '--baseline':
+            baseline_file = value
+        elif opt == '--tolerance':
+            tolerance = float(value)
+        elif opt == '--child':
+            child = value
+
+    if child is not None:
+        run_child(child, config['engines'][0], config['workers'],
+                  config['threads'])
+        return 0
+
+    for stage in config['stages']:
+        if stage not in STAGES:
+            print('ERROR: unknown stage ' + stage + ' (choose from ' +
+                  ', '.join(STAGES) + ')')
+            return 1
+
+    if config['imwidth'] + 300 + 10 > config['image_size']:
+        print('ERROR: imwidth must be at most image size - 310')
+        return 1
+
+    remove_data = data_directory is None
+
+    if data_directory is None:
+        data_directory = tempfile.mkdtemp(prefix='opt_benchmark_')
+
+    results = []
+
+    try:
+        print('Generating synthetic stack in ' + data_directory + '...')
+        transforms_file = generate_stack(data_directory, config['image_size'],
+                                         config['imwidth'],
+                                         config['unique_slices'],
+                                         config['imwidth'])
+
+        if len(config['stages']) > 0:
+            print('Timing stages:')
+            results += benchmark_stages(transforms_file, config['stages'],
+                                        config['repeats'])
+
+        if len(config['engines']) > 0:
+            print('Timing process_volume:')
+            for engine in config['engines']:
+                results.append(benchmark_run(transforms_file, engine,
+                                             config['workers'],
+                                             config['threads']))
+    finally:
+        if remove_data:
+            shutil.rmtree(data_directory, ignore_errors=True)
+
+    report = {'config': config,
+              'environment': {'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'platform': platform.platform(),
+                              'processor': platform.processor(),
+                              'cpu_count': os.cpu_count()},
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'results': results}
+
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('Results written to ' + output_file)
+
+    if baseline_file is not None:
+        regressions = compare_to_baseline(results, baseline_file, tolerance)
+        if len(regressions) > 0:
+            print(str(len(regressions)) + ' regression(s) above ' +
+                  str(int(100 * tolerance)) + '%')
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,325 @@
+"""
+
+Chunked, losslessly compressed storage for OPT volumes (.cvol)
+
+Most of an OPT volume is uniform background, so it compresses very well.
+The volume is split into cubic chunks (64 x 64 x 64 by default) that are
+compressed independently, so any region can be read by decompressing only
+the chunks it overlaps.
+
+File layout:
+
+    8 bytes     magic number b'OPTCVOL1'
+    4 bytes     length of the JSON header (little-endian uint32)
+    n bytes     JSON header: shape, dtype, chunk shape, codec
+    16 * N      chunk index: (offset, length) as little-endian int64 for
+                each of the N chunks, in C order of the chunk grid
+    ...         compressed chunks
+
+zlib is always available; zstd is used if the zstandard package is
+installed.
+
+"""
+
+import json
+import struct
+import threading
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from volume_io import VolumeWriter, write_nc_header, grid_voxel_size
+
+MAGIC = b'OPTCVOL1'
+
+
+def _compressor(codec, level):
+
+    if codec == 'zlib':
+        return lambda data: zlib.compress(data, level)
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('The zstd codec requires the zstandard package')
+        # A ZstdCompressor must not be shared between threads, so each
+        # thread compressing chunks gets its own
+        local = threading.local()
+
+        def compress(data):
+            if not hasattr(local, 'compressor'):
+                local.compressor = zstandard.ZstdCompressor(level=level)
+            return local.compressor.compress(data)
+
+        return compress
+    else:
+        raise ValueError('Unknown codec: ' + str(codec))
+
+
+def _decompressor(codec):
+
+    if codec == 'zlib':
+        return zlib.decompress
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('The zstd codec requires the zstandard package')
+        return lambda data: zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raise ValueError('Unknown codec: ' + str(codec))
+
+
+def default_codec():
+
+    """
+    Returns 'zstd' if the zstandard package is installed, otherwise 'zlib'
+
+    """
+
+    return 'zlib' if zstandard is None else 'zstd'
+
+
+def save_chunked_volume(volume, fname, chunk_size=64, codec=None, level=3,
+                        num_threads=1, on_slab=None):
+
+    """
+    Writes a volume as independently compressed chunks
+
+    The volume is read one slab of chunk_size slices at a time, so it can
+    be a memory-mapped or non-contiguous array.
+
+    Parameters
+    ==========
+    volume - 3-dimensional array
+    fname - output filename (string, usually ending in .cvol)
+    chunk_size - edge length of the cubic chunks
+    codec - 'zlib' or 'zstd' (default = zstd if available)
+    level - compression level
+    num_threads - number of threads compressing chunks
+    on_slab - optional function called with each slab, in order (e.g.
+              PyramidBuilder.add, see volume_pyramid.py)
+
+    """
+
+    if codec is None:
+        codec = default_codec()
+
+    compress = _compressor(codec, level)
+
+    shape = tuple(int(n) for n in volume.shape)
+    chunk_shape = (chunk_size,) * 3
+    grid = [int(np.ceil(n / chunk_size)) for n in shape]
+
+    header = json.dumps({'shape': shape,
+                         'dtype': np.dtype(volume.dtype).str,
+                         'chunk_shape': chunk_shape,
+                         'codec': codec}).encode()
+
+    index = np.zeros((int(np.prod(grid)), 2), dtype='<i8')
+
+    with open(fname, 'wb') as f, ThreadPoolExecutor(num_threads) as executor:
+
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+
+        index_offset = f.tell()
+        f.write(index.tobytes())
+
+        for i in range(grid[0]):
+
+            slab = np.ascontiguousarray(volume[i * chunk_size:(i + 1) * chunk_size])
+
+            chunks = [np.ascontiguousarray(slab[:, j * chunk_size:(j + 1) * chunk_size,
+                                                   k * chunk_size:(k + 1) * chunk_size])
+                      for j, k in product(range(grid[1]), range(grid[2]))]
+
+            for n, data in enumerate(executor.map(compress, chunks)):
+                index[i * grid[1] * grid[2] + n] = (f.tell(), len(data))
+                f.write(data)
+
+            if on_slab is not None:
+                on_slab(slab)
+
+        f.seek(index_offset)
+        f.write(index.tobytes())
+
+
+class ChunkedVolume:
+
+    """
+    Random access to a chunked volume file
+
+    Supports slicing with integers and slices (step 1), e.g.
+    volume[400, :, :] or volume[100:200, 300:400, :]; only the chunks that
+    overlap the requested region are read and decompressed.
+
+    """
+
+    def __init__(self, fname):
+
+        self.fname = fname
+
+        with open(fname, 'rb') as f:
+
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(fname + ' is not a chunked volume file')
+
+            header_length, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_length).decode())
+
+            self.shape = tuple(header['shape'])
+            self.dtype = np.dtype(header['dtype'])
+            self.chunk_shape = tuple(header['chunk_shape'])
+            self.codec = header['codec']
+
+            self.grid = tuple(int(np.ceil(n / c))
+                              for n, c in zip(self.shape, self.chunk_shape))
+
+            num_chunks = int(np.prod(self.grid))
+            self.index = np.frombuffer(f.read(16 * num_chunks),
+                                       dtype='<i8').reshape(num_chunks, 2)
+
+        self.decompress = _decompressor(self.codec)
+
+    @property
+    def ndim(self):
+        return 3
+
+    def chunk_bounds(self, chunk):
+
+        lower = [c * s for c, s in zip(chunk, self.chunk_shape)]
+        upper = [min(l + s, n) for l, s, n in zip(lower, self.chunk_shape, self.shape)]
+
+        return lower, upper
+
+    def read_chunk(self, chunk):
+
+        """
+        Reads and decompresses one chunk, given its (i, j, k) grid position
+
+        """
+
+        offset, length = self.index[np.ravel_multi_index(chunk, self.grid)]
+
+        with open(self.fname, 'rb') as f:
+            f.seek(offset)
+            data = self.decompress(f.read(length))
+
+        lower, upper = self.chunk_bounds(chunk)
+
+        return np.frombuffer(data, dtype=self.dtype).reshape(
+            [u - l for l, u in zip(lower, upper)])
+
+    def read_region(self, lower, upper, num_threads=1):
+
+        """
+        Reads the region lower[d] <= index < upper[d] into an np.ndarray
+
+        """
+
+        region = np.zeros([u - l for l, u in zip(lower, upper)], dtype=self.dtype)
+
+        chunk_ranges = [range(l // c, (u - 1) // c + 1) if u > l else range(0)
+                        for l, u, c in zip(lower, upper, self.chunk_shape)]
+
+        def copy_chunk(chunk):
+
+            data = self.read_chunk(chunk)
+            chunk_lower, chunk_upper = self.chunk_bounds(chunk)
+
+            src = []
+            dst = []
+
+            for d in range(3):
+                start = max(lower[d], chunk_lower[d])
+                stop = min(upper[d], chunk_upper[d])
+                src.append(slice(start - chunk_lower[d], stop - chunk_lower[d]))
+                dst.append(slice(start - lower[d], stop - lower[d]))
+
+            region[tuple(dst)] = data[tuple(src)]
+
+        chunks = list(product(*chunk_ranges))
+
+        if num_threads > 1:
+            with ThreadPoolExecutor(num_threads) as executor:
+                list(executor.map(copy_chunk, chunks))
+        else:
+            for chunk in chunks:
+                copy_chunk(chunk)
+
+        return region
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        key = key + (slice(None),) * (3 - len(key))
+
+        lower = []
+        upper = []
+        squeeze = []
+
+        for d, k in enumerate(key):
+
+            if isinstance(k, slice):
+                start, stop, step = k.indices(self.shape[d])
+                if step != 1:
+                    raise IndexError('Only slices with step 1 are supported')
+                lower.append(start)
+                upper.append(max(start, stop))
+            else:
+                k = int(k)
+                if k < 0:
+                    k += self.shape[d]
+                if not 0 <= k < self.shape[d]:
+                    raise IndexError('Index ' + str(k) + ' is out of bounds')
+                lower.append(k)
+                upper.append(k + 1)
+                squeeze.append(d)
+
+        return np.squeeze(self.read_region(lower, upper), axis=tuple(squeeze))
+
+    def to_array(self, num_threads=1):
+
+        return self.read_region((0, 0, 0), self.shape, num_threads)
+
+
+def load_chunked_volume(fname, num_threads=4):
+
+    """
+    Reads a whole chunked volume into memory
+
+    """
+
+    return ChunkedVolume(fname).to_array(num_threads)
+
+
+def chunked_to_drishti(fname, drishti_fname):
+
+    """
+    Converts a chunked volume to Drishti format, one slab of chunks at a time
+
+    Parameters
+    ==========
+    fname - chunked volume filename (.cvol)
+    drishti_fname - output Drishti description filename (.pvl.nc); the raw
+                    data is written to drishti_fname + '.001'
+
+    """
+
+    volume = ChunkedVolume(fname)
+    slab_size = volume.chunk_shape[0]
+
+    with VolumeWriter(drishti_fname + '.001', volume.shape, volume.dtype) as writer:
+        for start in range(0, volume.shape[0], slab_size):
+            writer.write(volume[start:start + slab_size])
+
+    write_nc_header(drishti_fname, volume.shape, volume.dtype,
+                    voxel_size=grid_voxel_size(volume.shape))
@@ -0,0 +1,352 @@
+"""
+
+Opt-in timing and memory instrumentation for the OPT pipeline
+
+Instrumentation is off by default, and stage() then costs almost nothing.
+It is turned on by setting the OPT_PROFILE environment variable to a file
+prefix, or by calling enable(prefix) (e.g. from a --profile option):
+
+    $ OPT_PROFILE=/tmp/run1 python opt_volume_creator.py transforms.json
+
+OPT_PROFILE only enables recording in the top-level process, not in its
+multiprocessing workers.
+
+For every stage, the following are recorded:
+
+    wall_s          elapsed time
+    cpu_s           CPU time of the whole process (all threads)
+    children_cpu_s  CPU time of child processes that finished during the
+                    stage (e.g. a multiprocessing pool)
+    read_bytes      bytes read by the process (all threads; Linux only)
+    write_bytes     bytes written by the process (all threads; Linux only)
+    peak_rss_mb     peak resident memory of the process during the stage
+
+Two files are written, named after the prefix and the process id so that
+concurrent processes do not overwrite each other:
+
+    <prefix>_<pid>.jsonl        one JSON record per stage
+    <prefix>_<pid>.trace.json   Chrome trace events, which can be opened in
+                                chrome://tracing or https://ui.perfetto.dev
+
+Both files are written as stages finish, so they are usable even if the
+process crashes. (The trace file is a JSON array without its closing
+bracket, which trace viewers accept.)
+
+Usage
+=====
+with stage('resize_volume', channel='fluor'):
+    ...
+
+@profiled()
+def process_volume(...):
+    ...
+
+s = stage('probe', probe=probe).start()    # for module-level scripts
+...
+s.stop()
+
+"""
+
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+
+def _io_counters():
+
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f if ':' in line)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _current_rss():
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    if resource is not None:
+        # peak rather than current memory, the best available here
+        unit = 1 if os.uname().sysname == 'Darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+    return 0
+
+
+def _children_cpu():
+
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class _Recorder:
+
+    def __init__(self, prefix, sample_interval=0.05):
+
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.open_stages = set()
+        self.thread_names = {}
+
+        directory = os.path.dirname(prefix)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+
+        fname = prefix + '_' + str(self.pid)
+
+        self.jsonl_file = open(fname + '.jsonl', 'a')
+        self.trace_file = open(fname + '.trace.json', 'w')
+        self.trace_file.write('[\n')
+
+        self.sample_interval = sample_interval
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+
+    def timestamp(self):
+
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def _sample(self):
+
+        while not self.stopped.wait(self.sample_interval):
+
+            rss = _current_rss()
+
+            with self.lock:
+                for s in self.open_stages:
+                    s.peak_rss = max(s.peak_rss, rss)
+                if len(self.open_stages) > 0:
+                    self._trace({'name': 'memory', 'ph': 'C',
+                                 'ts': self.timestamp(), 'pid': self.pid,
+                                 'args': {'rss_mb': rss / pow(2, 20)}})
+
+    def _trace(self, event):
+
+        self.trace_file.write(json.dumps(event) + ',\n')
+        self.trace_file.flush()
+
+    def begin(self, s):
+
+        with self.lock:
+            self.open_stages.add(s)
+
+    def end(self, s, record, event):
+
+        with self.lock:
+
+            self.open_stages.discard(s)
+
+            thread = threading.current_thread()
+
+            if thread.ident not in self.thread_names:
+                self.thread_names[thread.ident] = thread.name
+                self._trace({'name': 'thread_name', 'ph': 'M',
+                             'pid': self.pid, 'tid': thread.ident,
+                             'args': {'name': thread.name}})
+
+            self.jsonl_file.write(json.dumps(record) + '\n')
+            self.jsonl_file.flush()
+            self._trace(event)
+
+    def close(self):
+
+        self.stopped.set()
+        self.sampler.join()
+
+        with self.lock:
+            self.jsonl_file.close()
+            self.trace_file.close()
+
+
+_recorder = None
+
+
+def enable(prefix, sample_interval=0.05):
+
+    """
+    Starts recording stages to <prefix>_<pid>.jsonl and
+    <prefix>_<pid>.trace.json
+
+    Parameters
+    ==========
+    prefix - path and start of the file names
+    sample_interval - seconds between memory samples
+
+    """
+
+    global _recorder
+
+    if _recorder is not None and _recorder.pid == os.getpid():
+        return
+
+    _recorder = _Recorder(prefix, sample_interval)
+
+    atexit.register(disable)
+
+
+def disable():
+
+    """
+    Stops recording and closes the files
+
+    """
+
+    global _recorder
+
+    if _recorder is not None and _recorder.pid == os.getpid():
+        _recorder.close()
+
+    _recorder = None
+
+
+def enabled():
+
+    return _recorder is not None and _recorder.pid == os.getpid()
+
+
+class Stage:
+
+    """
+    One timed stage; see stage()
+
+    """
+
+    def __init__(self, recorder, name, args):
+
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def start(self):
+
+        self.start_time = time.time()
+        self.start_ts = self.recorder.timestamp()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_children_cpu = _children_cpu()
+        self.start_read, self.start_write = _io_counters()
+        self.peak_rss = _current_rss()
+
+        self.recorder.begin(self)
+
+        return self
+
+    def stop(self):
+
+        wall = time.perf_counter() - self.start_wall
+        read, write = _io_counters()
+
+        self.peak_rss = max(self.peak_rss, _current_rss())
+
+        metrics = {'wall_s': wall,
+                   'cpu_s': time.process_time() - self.start_cpu,
+                   'children_cpu_s': _children_cpu() - self.start_children_cpu,
+                   'read_bytes': None if read is None else read - self.start_read,
+                   'write_bytes': None if write is None else write - self.start_write,
+                   'peak_rss_mb': self.peak_rss / pow(2, 20)}
+
+        record = {'name': self.name,
+                  'start': self.start_time,
+                  'pid': self.recorder.pid,
+                  'thread': threading.current_thread().name}
+        record.update(metrics)
+        record['args'] = self.args
+
+        args = dict(metrics)
+        args.update(self.args)
+
+        event = {'name': self.name, 'ph': 'X', 'ts': self.start_ts,
+                 'dur': wall * 1e6, 'pid': self.recorder.pid,
+                 'tid': threading.get_ident(), 'args': args}
+
+        self.recorder.end(self, record, event)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+
+        self.stop()
+
+
+class _NullStage:
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, **args):
+
+    """
+    Returns a context manager that records one stage, or does nothing if
+    instrumentation is disabled
+
+    Parameters
+    ==========
+    name - stage name
+    args - JSON-serializable values stored with the stage (e.g. channel)
+
+    """
+
+    if not enabled():
+        return _NULL_STAGE
+
+    return Stage(_recorder, name, args)
+
+
+def profiled(name=None):
+
+    """
+    Decorator recording every call of a function as a stage
+
+    """
+
+    def decorator(function):
+
+        stage_name = function.__name__ if name is None else name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Worker processes (e.g. the slice worker pools) inherit OPT_PROFILE, but
+# only the top-level process records stages
+if len(os.environ.get('OPT_PROFILE', '')) > 0 and multiprocessing.parent_process() is None:
+    enable(os.environ['OPT_PROFILE'])
@@ -3,17 +3,42 @@ from PIL import Image
 import glob
 import os
 
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, gaussian_filter1d
 from skimage.transform import resize
 import pandas as pd
 import glob
 from scipy.ndimage import rotate
 
+from multiprocessing import RawArray, get_context, get_all_start_methods
+from concurrent.futures import ThreadPoolExecutor
+
+from volume_resampling import (rotation_matrix, scaling_matrix, flip_matrix,
+                               input_bounds, resample, resample_blocks,
+                               block_size_for_memory)
+from volume_io import (write_volume, write_nc_header, grid_voxel_size,
+                       load_volume, BackgroundWriter)
+from slice_reader import read_image, prefetch_images
+from chunked_volume import save_chunked_volume
+from volume_pyramid import PyramidBuilder, PYRAMID_FACTORS
+from stage_manifest import StageManifest, stage_key
+from instrumentation import stage, profiled, enable as enable_profiling
+
+from functools import lru_cache
+
+import contextlib
+import hashlib
+import json
+import tempfile
+import threading
+
 import sys, getopt
 
 def open_image(filename, rotation, offset1, offset2, imwidth, flip_image=False):
 
-    imarray = np.array(Image.open(filename))
+    return transform_image(read_image(filename), rotation, offset1, offset2,
+                           imwidth, flip_image)
+
+def transform_image(imarray, rotation, offset1, offset2, imwidth, flip_image=False):
 
     imarray = imarray[:2052,:2052]
 
@@ -30,7 +55,7 @@ def open_image(filename, rotation, offset1, offset2, imwidth, flip_image=False):
 
     return imarray
 
-def process_image(imarray, limit1, limit2):
+def process_image(imarray, limit1, limit2, sigma=2):
 
     distance = limit2 - limit1
 
@@ -40,112 +65,526 @@ def process_image(imarray, limit1, limit2):
     imarray = imarray / (distance) # normalize between zero and one
     imarray = 1 - imarray # invert
     imarray = imarray * 255 # scale to 8-bit
-    imarray = gaussian_filter(imarray,2) # smooth
+    imarray = gaussian_filter(imarray,sigma) # smooth
     imarray = imarray.astype('uint8') # convert to unsigned int
 
     return imarray
 
-def resize_volume(volume):
+@lru_cache(maxsize=8)
+def window_lut(limit1, limit2, max_value=65535):
+
+    """
+    Lookup table for the intensity window applied by process_image
+
+    Entry i holds the clipped, normalized and inverted value (0 - 255, float32)
+    of an input value i * 256 / max_value, i.e. of the value open_image
+    returns for a raw pixel value i.
+
+    """
+
+    values = np.arange(max_value + 1, dtype='float32') * (pow(2,8) / max_value)
+
+    np.clip(values, limit1, limit2, out=values)
+
+    return ((1 - (values - limit1) / (limit2 - limit1)) * 255).astype('float32')
+
+def process_image_lut(imarray, limit1, limit2, sigma=2, max_value=65535):
+
+    """
+    Fast version of process_image using a lookup table
+
+    Unsigned 8- or 16-bit input is used as raw pixel values and mapped
+    through the table directly. Floating-point input (on the 0 - 256 scale
+    returned by open_image) is first quantized to 1 / max_value steps.
+    Smoothing runs in float32, in place. The result matches process_image
+    within one grey level.
+
+    """
+
+    if imarray.dtype.kind == 'u' and imarray.dtype.itemsize <= 2:
+        codes = imarray
+        max_value = np.iinfo(imarray.dtype).max
+    else:
+        codes = np.multiply(imarray, max_value / pow(2,8), dtype='float32')
+        np.clip(codes, 0, max_value, out=codes)
+        codes = np.rint(codes, out=codes).astype('uint16')
+
+    windowed = window_lut(limit1, limit2, max_value).take(codes)
+
+    gaussian_filter(windowed, sigma, output=windowed) # smooth
+
+    return windowed.astype('uint8')
+
+def transform_and_process_image(imarray, rot1, offset1, offset2, imwidth,
+                                flip_image, limit1, limit2):
+
+    imarray = transform_image(imarray, rot1, offset1, offset2, imwidth, flip_image)
+
+    return process_image_lut(imarray, limit1, limit2)
+
+def crop_and_process_image(imarray, lower, upper, limit1, limit2, sigma):
+
+    """
+    Prepares one slice for the fused path: crops the region needed by the
+    resampler, then windows and smooths it at native resolution
+
+    """
+
+    imarray = imarray[:2052,:2052][lower[0]:upper[0], lower[1]:upper[1]]
+
+    return process_image_lut(imarray, limit1, limit2, sigma)
+
+def _worker_context():
+
+    """
+    Returns the multiprocessing context for the slice worker pools
+
+    Pools can be created while other threads are running (the
+    BackgroundWriter, and the other channel with max_channels > 1), and a
+    forked child can inherit a lock held by one of them. The workers are
+    therefore started from a fresh interpreter: forkserver where available,
+    spawn otherwise.
+
+    """
+
+    if 'forkserver' in get_all_start_methods():
+        return get_context('forkserver')
+
+    return get_context('spawn')
+
+def _init_slice_worker(buffer, shape, axis, function, params):
+
+    global _shared_volume, _slice_axis, _slice_function, _slice_params
+
+    if isinstance(buffer, str):
+        _shared_volume = np.memmap(buffer, dtype='uint8', mode='r+', shape=shape)
+    else:
+        _shared_volume = np.frombuffer(buffer, dtype='uint8').reshape(shape)
+    _slice_axis = axis
+    _slice_function = function
+    _slice_params = params
+
+def _load_slice(task):
+
+    slice_idx, filename = task
+
+    index = [slice(None)] * _shared_volume.ndim
+    index[_slice_axis] = slice_idx
+
+    _shared_volume[tuple(index)] = _slice_function(read_image(filename),
+                                                   *_slice_params)
+
+    return slice_idx
+
+def fill_volume(images, shape, axis, function, params, num_workers=1,
+                max_in_flight=8, output=None):
+
+    """
+    Builds a uint8 volume by calling function(imarray, *params) for
+    every image and storing the result at that image's index along axis
+
+    With num_workers > 1, images are read and processed by a pool of worker
+    processes that write directly into a shared buffer; the output is
+    identical to the serial path. The serial path reads ahead with
+    prefetch_images so that file latency overlaps with processing.
+
+    If output is an np.memmap, the workers write directly to its file, so
+    the volume never has to fit in memory.
+
+    Parameters
+    ==========
+    images - list of image filenames (one per slice)
+    shape - shape of the output volume
+    axis - axis along which slices are stacked
+    function - module-level function returning one 2D uint8 slice
+    params - additional arguments for function
+    num_workers - number of worker processes (default = 1, serial)
+    max_in_flight - number of reads kept in flight by the serial path
+    output - optional preallocated uint8 array (e.g. np.memmap)
+
+    Returns
+    =======
+    volume - np.ndarray (uint8)
+
+    """
+
+    if num_workers > 1:
+
+        if isinstance(output, np.memmap):
+            output.flush()
+            buffer = output.filename
+            volume = output
+        else:
+            buffer = RawArray('B', int(np.prod(shape)))
+            volume = np.frombuffer(buffer, dtype='uint8').reshape(shape)
+
+        with _worker_context().Pool(num_workers,
+                                    initializer=_init_slice_worker,
+                                    initargs=(buffer, shape, axis, function,
+                                              params)) as pool:
+            for _ in pool.imap_unordered(_load_slice,
+                                         enumerate(images),
+                                         chunksize=4):
+                pass
+
+        if output is not None and volume is not output:
+            output[...] = volume
+            volume = output
+
+    else:
+
+        volume = np.zeros(shape, dtype='uint8') if output is None else output
+
+        index = [slice(None)] * len(shape)
+
+        for slice_idx, imarray in enumerate(prefetch_images(images, max_in_flight)):
+
+            index[axis] = slice_idx
+            volume[tuple(index)] = function(imarray, *params)
+
+    return volume
+
+def load_slices(images, rot1, offset1, offset2, imwidth, limit1, limit2,
+                flip_image=False, num_workers=1):
+
+    """
+    Opens and windows the reconstructed slices, filling one volume
+
+    Parameters
+    ==========
+    images - sorted list of reconstructed TIFF filenames
+    rot1, offset1, offset2, imwidth, flip_image - parameters for open_image
+    limit1, limit2 - intensity window for process_image
+    num_workers - number of worker processes (default = 1, serial)
+
+    Returns
+    =======
+    volume_data - np.ndarray (1024 x 1024 x imwidth, uint8)
+
+    """
+
+    params = (rot1, offset1, offset2, imwidth, flip_image, limit1, limit2)
+
+    return fill_volume(images[:imwidth], (1024, 1024, imwidth), 2,
+                       transform_and_process_image, params, num_workers)
+
+def compose_transform(rot1, rot2, rot3, offset1, offset2, imwidth,
+                      flip_image=False, image_shape=(2052, 2052),
+                      grid_size=1024):
+
+    """
+    Composes the operations of the sequential pipeline into one matrix
+
+    The sequential pipeline flips and rotates each slice by rot1, crops it,
+    resizes it to grid_size, resizes the slice axis to grid_size, transposes,
+    then rotates the volume by rot2 and rot3. The returned matrix maps
+    indices of that final volume to (slice, row, column) indices of the
+    stack of raw slices.
+
+    Parameters
+    ==========
+    rot1, rot2, rot3 - rotation angles in degrees (from transforms.json)
+    offset1, offset2 - crop offsets (from transforms.json)
+    imwidth - width of the cropped region and number of slices
+    flip_image - True if slices are flipped along the L/R axis
+    image_shape - shape of the (cropped) raw slices
+    grid_size - size of the output grid
+
+    Returns
+    =======
+    matrix - np.ndarray (4 x 4), output -> input
+    output_shape - tuple
+
+    """
+
+    output_shape = (grid_size - 1, grid_size, grid_size)
+    height, width = image_shape
+
+    scale = imwidth / grid_size
+    crop = np.array([0, 300 - offset1, 300 - offset2])
+
+    matrix = rotation_matrix(rot3, output_shape[:2], axes=(0, 1))
+    matrix = rotation_matrix(rot2, output_shape[::2], axes=(0, 2)) @ matrix
+    matrix = scaling_matrix([scale] * 3, 0.5 * scale - 0.5 + crop) @ matrix
+    matrix = rotation_matrix(rot1, image_shape, axes=(1, 2)) @ matrix
+
+    if flip_image:
+        matrix = flip_matrix(width, axis=2) @ matrix
+
+    return matrix, output_shape
+
+def fused_volume(images, rot1, rot2, rot3, offset1, offset2, imwidth,
+                 limit1, limit2, flip_image=False, num_workers=1,
+                 num_threads=1, order=1, grid_size=1024,
+                 scratch_directory=None, memory_limit=None):
+
+    """
+    Creates the final volume with a single resampling step
+
+    Slices are windowed and smoothed at native resolution, cropped to the
+    region that contributes to the output, and resampled once through the
+    matrix from compose_transform.
+
+    If scratch_directory is given, the source region and the output volume
+    are memory-mapped files in that directory instead of arrays in memory,
+    and the output is resampled in cubic blocks sized so that the blocks
+    and the input regions they need fit within memory_limit bytes. Memory
+    use then no longer depends on imwidth or grid_size.
+
+    Returns
+    =======
+    volume - np.ndarray ((grid_size - 1) x grid_size x grid_size, uint8),
+             or np.memmap if scratch_directory is given
+
+    """
+
+    with Image.open(images[0]) as im:
+        image_shape = (min(im.height, 2052), min(im.width, 2052))
+
+    matrix, output_shape = compose_transform(rot1, rot2, rot3, offset1, offset2,
+                                             imwidth, flip_image, image_shape,
+                                             grid_size)
+
+    input_shape = (min(len(images), imwidth),) + image_shape
+    lower, upper = input_bounds(matrix, output_shape, input_shape, margin=order)
+
+    sigma = 2 * imwidth / grid_size
+
+    source_shape = tuple(int(n) for n in upper - lower)
+    source = None
+    output = None
+
+    if scratch_directory is not None:
+        source = scratch_volume(scratch_directory, source_shape)
+        output = scratch_volume(scratch_directory, output_shape)
+
+    print('   Loading source region ' + str(source_shape) + '...')
+
+    with stage('load_source', shape=source_shape):
+        source = fill_volume(images[lower[0]:upper[0]], source_shape, 0,
+                             crop_and_process_image,
+                             (lower[1:], upper[1:], limit1, limit2, sigma),
+                             num_workers, output=source)
+
+    matrix = scaling_matrix(np.ones((3,)), -lower) @ matrix
+
+    print('   Resampling volume...')
+
+    if scratch_directory is None:
+        with stage('resample', shape=output_shape):
+            return resample(source, matrix, output_shape, order=order,
+                            num_threads=num_threads)
+
+    block_size = block_size_for_memory(matrix, output_shape, memory_limit,
+                                       order, num_threads=num_threads)
+
+    print('   Resampling in blocks of ' + str(block_size) + ' voxels')
+
+    with stage('resample', shape=output_shape, block_size=block_size):
+        volume = resample_blocks(source, matrix, output_shape, output,
+                                 order=order, num_threads=num_threads,
+                                 block_size=block_size)
+
+    # free the disk space of the source region before the next channel
+    source_file = source.filename
+    del source
+
+    try:
+        os.remove(source_file)
+    except OSError:
+        pass
+
+    return volume
+
+def scratch_volume(directory, shape, dtype='u1'):
+
+    """
+    Creates a memory-mapped volume in a new file in directory
+
+    The file is removed together with the directory (see process_volume).
+
+    """
+
+    fd, fname = tempfile.mkstemp(suffix='.raw', dir=directory)
+    os.close(fd)
+
+    return np.memmap(fname, dtype=dtype, mode='w+', shape=shape)
+
+def resize_volume(volume, output_size=1024, num_threads=1, slab_size=32):
+
+    """
+    Resizes the slice axis (last axis) of a volume to output_size and keeps
+    the first output_size - 1 slices
+
+    Equivalent to calling skimage.transform.resize on every horizontal slice
+    (Gaussian anti-aliasing followed by linear interpolation), but the whole
+    volume is processed in float32 slabs along the first axis, optionally
+    on several threads.
+
+    Parameters
+    ==========
+    volume - np.ndarray (N x M x num_slices, uint8)
+    output_size - number of slices after resizing
+    num_threads - number of threads (default = 1)
+    slab_size - number of horizontal slices processed at once
+
+    Returns
+    =======
+    volume2 - np.ndarray (N x M x output_size - 1, uint8)
+
+    """
+
+    input_size = volume.shape[2]
+    scale = input_size / output_size
+    sigma = max(0, (scale - 1) / 2)
+
+    coords = (np.arange(output_size - 1) + 0.5) * scale - 0.5
+    coords = np.clip(coords, 0, input_size - 1)
+
+    index0 = np.floor(coords).astype('int')
+    index1 = np.minimum(index0 + 1, input_size - 1)
+    weight1 = (coords - index0).astype('float32')
+
+    volume2 = np.zeros(volume.shape[:2] + (output_size - 1,), dtype='uint8')
+
+    def resize_slab(start):
+
+        rows = volume[start:start + slab_size].reshape(-1, input_size)
+
+        if sigma > 0:
+            rows = gaussian_filter1d(rows, sigma, axis=1, mode='mirror',
+                                     output=np.float32)
+        else:
+            rows = rows.astype('float32')
+
+        resized = np.take(rows, index0, axis=1)
+        upper = np.take(rows, index1, axis=1)
 
-    volume2 = np.zeros((1024,1024,1023), dtype='uint8')
+        upper -= resized
+        upper *= weight1
+        resized += upper
 
-    for horzslice in range(1024):
+        np.clip(resized, 0, 255, out=resized)
 
-        imslice = volume[horzslice,:,:]
-        imslice = resize(imslice, (1024, 1024))
-        imslice = imslice*255
-        imslice = imslice.astype('uint8')
+        volume2[start:start + slab_size] = resized.reshape((-1,) + volume2.shape[1:])
 
-        volume2[horzslice,:,:] = imslice[:,:1023]
+    starts = range(0, volume.shape[0], slab_size)
+
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            list(executor.map(resize_slab, starts))
+    else:
+        for start in starts:
+            resize_slab(start)
 
     return volume2
 
-def create_header():
+def rotate_volume(volume, angle, axis):
+
+    """
+    Rotates every slice of a volume taken along axis
 
-    Z = [3, 0, 0]
-    X = [0, 4, 0, 0]
-    Y = [0, 4, 0, 0]
+    """
 
-    header = [0, 255]
-    header.extend(Z)
-    header.extend(X)
-    header.extend(Y)
+    new_volume = np.zeros((volume.shape),dtype='u1')
 
-    header = np.array(header).astype('uint8')
+    index = [slice(None)] * volume.ndim
 
-    return header
+    for i in range(volume.shape[axis]):
+        index[axis] = i
+        new_volume[tuple(index)] = rotate(volume[tuple(index)], angle, reshape=False, cval=200)
+
+    return new_volume
 
 
 def transpose_volume(volume):
 
-    V = np.transpose(volume[:,:,:])
+    """
+    Moves the slice axis to the front: V[k, i, j] = volume[i, j, k]
 
-    for i in range(0, V.shape[0]):
-        V[i,:,:] = V[i,:,:].T
+    Returns a view, so no data is copied.
 
-    return V
+    """
 
+    return np.moveaxis(volume, 2, 0)
 
-def add_header(volume):
 
-    volume_flat = volume.flatten()
-    full_dataset = np.concatenate((create_header(), volume_flat))
+def volume_filename(mouse, data_directory, image_type, output_format='drishti'):
 
-    return full_dataset
+    """
+    Returns the name of the file that load_volume opens for a saved volume
 
+    """
 
-def loadVolume(fname, _dtype='u1', num_slices=1023):
+    fname = data_directory + '/' + mouse + '_' + image_type
 
-    dtype = np.dtype(_dtype)
+    if output_format == 'chunked':
+        return fname + '.cvol'
+    elif output_format == 'drishti':
+        return fname + '.pvl.nc.001'
+    else:
+        raise ValueError('Unknown output format: ' + str(output_format))
 
-    volume = np.fromfile(fname, dtype) # read it in
 
-    z_size = np.sum([volume[1], volume[2] << pow(2,3)])
-    x_size = np.sum([(val << pow(2,i+1)) for i, val in enumerate(volume[8:4:-1])])
-    y_size = np.sum([(val << pow(2,i+1)) for i, val in enumerate(volume[12:8:-1])])
+def save_volume(volume, mouse, data_directory, image_type,
+                output_format='drishti', pyramid=None):
 
-    fsize = np.array([z_size, x_size, y_size]).astype('int')
+    """
+    Saves a volume, and if a PyramidBuilder is given, its pyramid levels
 
-    volume = np.reshape(volume[13:], fsize) # remove 13-byte header and reshape
+    The levels are built from the slabs of the volume as it is written,
+    and saved after it (with '_ds<factor>' added to image_type).
 
-    return volume
+    """
 
+    os.makedirs(data_directory, exist_ok=True)
 
-def save_volume(volume, mouse, data_directory, image_type):
+    fname = volume_filename(mouse, data_directory, image_type, output_format)
 
-    flattened = add_header(volume)
+    on_slab = None if pyramid is None else pyramid.add
 
-    if not os.path.exists(data_directory):
-        os.mkdir(data_directory)
+    with stage('save_volume', volume=image_type, format=output_format):
+        if output_format == 'chunked':
+            save_chunked_volume(volume, fname, on_slab=on_slab)
+        else:
+            write_volume(volume, fname, on_slab=on_slab)
+            write_nc_header(fname[:-len('.001')], volume.shape, volume.dtype,
+                            voxel_size=grid_voxel_size(volume.shape))
 
-    fname = data_directory + '/' + mouse + '_' + image_type + '.pvl.nc'
+    if pyramid is not None:
+        for factor, level in pyramid.finish().items():
+            save_volume(level, mouse, data_directory,
+                        image_type + '_ds' + str(factor), output_format)
 
-    flattened.tofile(fname + '.001')
 
-    nc_file_string = """<!DOCTYPE Drishti_Header>
-    <PvlDotNcFileHeader>
-      <rawfile></rawfile>
-      <voxeltype>unsigned char</voxeltype>
-      <pvlvoxeltype>unsigned char</pvlvoxeltype>
-      <gridsize>1023 1024 1024</gridsize>
-      <voxelunit>micron</voxelunit>
-      <voxelsize>10 10 10</voxelsize>
-      <description></description>
-      <slabsize>1024</slabsize>
-      <rawmap>0 255 </rawmap>
-      <pvlmap>0 255 </pvlmap>
-    </PvlDotNcFileHeader>"""
+def image_histogram(imarray):
 
-    print(nc_file_string, file=open(fname, 'w+'))
+    """
+    Counts the pixels in the bins [1, 2), ... [252, 253), [253, 254]
 
+    Same result as np.histogram(imarray, bins=range(1,255)), using
+    np.bincount on integer bin indices.
 
-def find_histogram_bounds(imarray, threshold = 3.0):
+    """
 
-    h,b = np.histogram(imarray.flatten(), bins=range(1,255))
+    values = imarray[(imarray >= 1) & (imarray <= 254)]
 
-    print(h)
+    return np.bincount(np.minimum(values.astype('int'), 253) - 1, minlength=253)
+
+
+def bounds_from_histogram(h, threshold = 3.0):
+
+    """
+    Finds the histogram peak and the range of bins with more than
+    10^threshold pixels
+
+    """
+
+    b = np.arange(1, 255)
+
+    with np.errstate(divide='ignore'):
+        logH = np.log10(h)
 
-    logH = np.log10(h)
     a = np.where(logH > threshold)
 
     peak = b[np.argmax(logH)]
@@ -155,120 +594,600 @@ def find_histogram_bounds(imarray, threshold = 3.0):
 
     return peak, limit1, limit2
 
-# %%
 
+def find_histogram_bounds(imarray, threshold = 3.0):
 
+    h = image_histogram(imarray)
 
-def process_volume(input_directory,
-                   output_directory,
-                   mouse,
-                   rot1, rot2, rot3, offset1, offset2,
-                   flip_image=False,
-                   imwidth=1488):
+    print(h)
 
-    print(input_directory)
-    print(output_directory)
-    image_types = ('fluor','trans')
+    return bounds_from_histogram(h, threshold)
 
-    for type_index, image_type in enumerate(image_types):
 
-        print(image_type)
+def sampled_histogram_bounds(images, rot1, offset1, offset2, imwidth,
+                             num_samples=16, threshold = 3.0):
 
-        search_string = os.path.join(input_directory,
-                                     image_type,
-                                     'native',
-                                     'recon', 'imgRot__rec*.tif')
+    """
+    Finds the intensity window from num_samples slices spread evenly across
+    the stack, rather than from a single slice
 
-        images = glob.glob(search_string)
-        images.sort()
+    The histogram is averaged over the sampled slices, so threshold keeps
+    its per-slice meaning.
 
-        print(len(images))
+    Returns
+    =======
+    peak, limit1, limit2
 
-        volume_data = np.zeros((1024, 1024, imwidth), dtype='uint8')
+    """
 
-        print(images[500])
+    num_slices = min(len(images), imwidth)
 
-        imarray = open_image(images[500], rot1, offset1, offset2, imwidth)
+    sample_indices = np.linspace(0, num_slices - 1, num_samples + 2)[1:-1]
+    sample_indices = np.unique(np.round(sample_indices).astype('int'))
+
+    counts = np.zeros((253,), dtype='int64')
+
+    for imarray in prefetch_images([images[i] for i in sample_indices]):
+        counts += image_histogram(transform_image(imarray, rot1, offset1,
+                                                  offset2, imwidth))
+
+    return bounds_from_histogram(counts / len(sample_indices), threshold)
+
+
+_histogram_cache_lock = threading.Lock()
+
+def cached_histogram_bounds(cache_file, image_type, images, rot1, offset1,
+                            offset2, imwidth, num_samples=None):
 
+    """
+    Returns the intensity window for one channel, reusing the limits stored
+    in cache_file if they were computed from the same slices and parameters
+
+    With num_samples = None, the window is computed from slice 500 only
+    (find_histogram_bounds); otherwise from num_samples slices
+    (sampled_histogram_bounds).
+
+    """
+
+    if num_samples is None:
+        sources = [images[500]]
+    else:
+        sources = images[:imwidth]
+
+    key = {'rot1': rot1, 'offset1': offset1, 'offset2': offset2,
+           'imwidth': imwidth, 'num_samples': num_samples,
+           'images': file_fingerprint(sources)}
+
+    if cache_file is not None:
+        with _histogram_cache_lock:
+            cache = read_json(cache_file)
+        entry = cache.get(image_type)
+        if entry is not None and entry['key'] == key:
+            print('  Using cached histogram bounds from ' + cache_file)
+            return entry['peak'], entry['limit1'], entry['limit2']
+
+    if num_samples is None:
+        print(images[500])
+        imarray = open_image(images[500], rot1, offset1, offset2, imwidth)
         peak, limit1, limit2 = find_histogram_bounds(imarray)
-        print('  Peak of histogram: ' + str(peak))
+    else:
+        peak, limit1, limit2 = sampled_histogram_bounds(images, rot1, offset1,
+                                                        offset2, imwidth,
+                                                        num_samples)
+
+    peak, limit1, limit2 = int(peak), int(limit1), int(limit2)
+
+    if cache_file is not None:
+        with _histogram_cache_lock:
+            cache = read_json(cache_file)
+            cache[image_type] = {'key': key, 'peak': peak,
+                                 'limit1': limit1, 'limit2': limit2}
+            write_json(cache_file, cache)
+
+    return peak, limit1, limit2
+
+
+def read_json(fname):
+
+    """
+    Reads a JSON cache file, returning {} if it is missing, unreadable or
+    truncated
+
+    """
+
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json(fname, values):
+
+    """
+    Writes a JSON cache file through a temporary file, so that an interrupted
+    write does not leave a truncated file
+
+    The cache is optional: if it cannot be written (e.g. the folder is
+    read-only), a warning is printed and the run continues.
+
+    """
+
+    temp_fname = fname + '.tmp'
+
+    try:
+        with open(temp_fname, 'w') as f:
+            json.dump(values, f, indent=2)
+        os.replace(temp_fname, fname)
+    except OSError as e:
+        print('  Could not write ' + fname + ': ' + str(e))
+
+
+def file_fingerprint(filenames):
+
+    """
+    Summarizes a list of files by their names, sizes and modification times
+
+    """
+
+    digest = hashlib.sha1()
+
+    for filename in filenames:
+        stat = os.stat(filename)
+        digest.update((os.path.basename(filename) + ' ' + str(stat.st_size) +
+                       ' ' + str(int(stat.st_mtime))).encode())
 
-        print('  Loading images...')
+    return digest.hexdigest()
 
-        for slice_idx, filename in enumerate(images[:imwidth]):
+# %%
+
+
+
+def available_memory():
+
+    """
+    Returns the memory available to new processes in bytes, or None if it
+    cannot be determined
+
+    """
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimate_channel_memory(imwidth=1488, engine='sequential', grid_size=1024):
+
+    """
+    Estimates the peak memory in bytes needed to process one channel
+
+    The sequential engine holds the loaded slices while the resized volume
+    is created, then two full volumes while rotating. The fused engine
+    holds the native-resolution source region (up to ~1.3 x imwidth per
+    side after rot1) and the output volume.
+
+    """
+
+    output_size = (grid_size - 1) * grid_size * grid_size
+
+    if engine == 'fused':
+        return int(imwidth * pow(1.3 * imwidth, 2)) + output_size
+
+    return max(grid_size * grid_size * imwidth + output_size, 2 * output_size)
+
+
+def process_channel(input_directory, image_type, save,
+                    rot1, rot2, rot3, offset1, offset2,
+                    flip_image=False,
+                    imwidth=1488,
+                    num_workers=1,
+                    engine='sequential',
+                    num_threads=1,
+                    save_checkpoints=False,
+                    histogram_samples=None,
+                    histogram_cache=None,
+                    pyramid_factors=PYRAMID_FACTORS,
+                    stage_file=None,
+                    grid_size=1024,
+                    scratch_directory=None,
+                    memory_limit=None):
+
+    """
+    Creates the volume for one channel ('fluor' or 'trans')
+
+    save(volume, suffix, stage, key, pyramid) is called with the final
+    volume (suffix '', stage 'final') and a PyramidBuilder for its
+    downsampled levels (None if pyramid_factors is empty), and, if
+    save_checkpoints is True, with the intermediate volumes (stages 'rot1'
+    and 'rot2', pyramid None).
+
+    To resume an earlier run, pass stage_file(stage, key, suffix), which
+    returns the file saved by that stage if it was completed with the same
+    key (see stage_manifest.py), or None. Processing then starts after the
+    last completed stage.
+
+    With the fused engine, grid_size sets the size of the output volume,
+    and scratch_directory and memory_limit enable out-of-core processing
+    (see fused_volume).
+
+    """
+
+    search_string = os.path.join(input_directory,
+                                 image_type,
+                                 'native',
+                                 'recon', 'imgRot__rec*.tif')
+
+    images = glob.glob(search_string)
+    images.sort()
+
+    print(image_type + ': ' + str(len(images)) + ' images')
+
+    with stage('histogram_bounds', channel=image_type):
+        peak, limit1, limit2 = cached_histogram_bounds(histogram_cache,
+                                                       image_type, images,
+                                                       rot1, offset1, offset2,
+                                                       imwidth,
+                                                       histogram_samples)
+    print('  ' + image_type + ' peak of histogram: ' + str(peak))
+
+    if stage_file is None:
+        keys = {}
+        completed = lambda stage, suffix: None
+    else:
+        keys = stage_keys(images, limit1, limit2, rot1, rot2, rot3,
+                          offset1, offset2, flip_image, imwidth, engine,
+                          pyramid_factors, grid_size)
+        completed = lambda stage, suffix: stage_file(stage, keys[stage], suffix)
+
+    if completed('final', '') is not None:
+        print('  ' + image_type + ' volume is up to date, skipping')
+        return
+
+    if engine == 'fused':
+
+        with stage('fused_volume', channel=image_type):
+            volume = fused_volume(images, rot1, rot2, rot3, offset1, offset2,
+                                  imwidth, limit1, limit2, flip_image,
+                                  num_workers, num_threads, grid_size=grid_size,
+                                  scratch_directory=scratch_directory,
+                                  memory_limit=memory_limit)
 
-            imarray = open_image(filename, rot1, offset1, offset2, imwidth, flip_image)
+        if scratch_directory is None:
+            allocate = np.zeros
+        else:
+            allocate = lambda shape, dtype: scratch_volume(scratch_directory,
+                                                           shape, dtype)
 
-            volume_data[:,:,slice_idx] = process_image(imarray, limit1, limit2)
+        save_final_volume(volume, image_type, save, pyramid_factors,
+                          keys.get('final'), allocate)
 
-        print("   Resizing volume...")
-        volume = resize_volume(volume_data)
+        return
 
-        print("   Transposing volume...")
-        volumeT = transpose_volume(volume)
+    rot2_file = completed('rot2', '_rot2')
 
-        print("   Saving volume...")
-        save_volume(volumeT, 'mouse' + str(mouse),
-                    os.path.join(output_directory, str(mouse)), image_type)
+    if rot2_file is not None:
 
+        print('  Resuming ' + image_type + ' from ' + rot2_file)
+        volume = load_volume(rot2_file)
 
-    # implement rotation 2
+    else:
 
-    for type_index, image_type in enumerate(image_types):
+        rot1_file = completed('rot1', '_rot1')
 
-        print('  ' + image_type)
+        if rot1_file is not None:
 
-        print('   Applying second rotation')
+            print('  Resuming ' + image_type + ' from ' + rot1_file)
+            volumeT = load_volume(rot1_file)
 
-        fname = os.path.join(output_directory,  str(mouse), 'mouse' + str(mouse) + '_' + image_type + '.pvl.nc.001')
+        else:
 
-        volume = loadVolume(fname)
+            print('  Loading ' + image_type + ' images...')
 
-        new_volume = np.zeros((volume.shape),dtype='u1')
+            with stage('load_slices', channel=image_type):
+                volume_data = load_slices(images, rot1, offset1, offset2,
+                                          imwidth, limit1, limit2, flip_image,
+                                          num_workers)
 
-        for i in range(1024):
-            new_volume[:,i,:] = rotate(volume[:,i,:], rot2, reshape=False, cval=200)
+            print("   Resizing " + image_type + " volume...")
+            with stage('resize_volume', channel=image_type):
+                volume = resize_volume(volume_data, num_threads=num_threads)
+            del volume_data
 
-        save_volume(new_volume, 'mouse' + str(mouse),
-                    os.path.join(output_directory, str(mouse)),
-                    image_type)
+            print("   Transposing " + image_type + " volume...")
+            volumeT = transpose_volume(volume)
 
-    # implement rotation 3
+            if save_checkpoints:
+                save(volumeT, '_rot1', 'rot1', keys.get('rot1'))
 
-    for type_index, image_type in enumerate(image_types):
+        print('   Applying second rotation (' + image_type + ')')
+        with stage('rotate_volume', channel=image_type, rotation='rot2'):
+            volume = rotate_volume(volumeT, rot2, axis=1)
 
-        print('  ' + image_type)
+        # volumeT is a view of the resized volume; release it so that only
+        # two full volumes are held while rotating (see estimate_channel_memory)
+        del volumeT
 
-        print('   Applying third rotation')
+        if save_checkpoints:
+            save(volume, '_rot2', 'rot2', keys.get('rot2'))
 
-        fname = os.path.join(output_directory,  str(mouse), 'mouse' + str(mouse) + '_' + image_type + '.pvl.nc.001')
+    print('   Applying third rotation (' + image_type + ')')
+    with stage('rotate_volume', channel=image_type, rotation='rot3'):
+        volume = rotate_volume(volume, rot3, axis=2)
 
-        volume = loadVolume(fname)
+    save_final_volume(volume, image_type, save, pyramid_factors,
+                      keys.get('final'))
 
-        new_volume = np.zeros((volume.shape),dtype='u1')
 
-        for i in range(1024):
-            new_volume[:,:,i] = rotate(volume[:,:,i], rot3, reshape=False, cval=200)
+def stage_keys(images, limit1, limit2, rot1, rot2, rot3, offset1, offset2,
+               flip_image, imwidth, engine, pyramid_factors, grid_size=1024):
 
-        save_volume(new_volume, 'mouse' + str(mouse),
-                    os.path.join(output_directory, str(mouse)),
-                    image_type)
+    """
+    Computes the keys of the 'rot1', 'rot2' and 'final' stages of a channel
+
+    Each key includes the key of the previous stage, so changing rot3 only
+    changes the key of the final stage, while changing the input images or
+    rot1 changes all three.
+
+    """
+
+    keys = {}
+
+    keys['rot1'] = stage_key(file_fingerprint(images), limit1, limit2, rot1,
+                             offset1, offset2, flip_image, imwidth)
+    keys['rot2'] = stage_key(keys['rot1'], rot2)
+    keys['final'] = stage_key(keys['rot2'], rot3, engine, list(pyramid_factors),
+                              grid_size)
+
+    return keys
+
+
+def save_final_volume(volume, image_type, save,
+                      pyramid_factors=PYRAMID_FACTORS, key=None,
+                      allocate=np.zeros):
+
+    """
+    Saves the final volume and its downsampled pyramid levels
+
+    The pyramid levels are built while the volume is written, in the same
+    pass, and saved with it, so the final stage is only recorded once all
+    of its files have been written. allocate(shape, dtype) creates the
+    arrays that hold the levels.
+
+    """
+
+    pyramid = None
+
+    if len(pyramid_factors) > 0:
+        pyramid = PyramidBuilder(volume.shape, volume.dtype, pyramid_factors,
+                                 allocate)
+
+    print("   Saving " + image_type + " volume...")
+    save(volume, '', 'final', key, pyramid)
+
+
+@profiled()
+def process_volume(input_directory,
+                   output_directory,
+                   mouse,
+                   rot1, rot2, rot3, offset1, offset2,
+                   flip_image=False,
+                   imwidth=1488,
+                   num_workers=1,
+                   engine='sequential',
+                   num_threads=1,
+                   save_checkpoints=False,
+                   max_channels=None,
+                   histogram_samples=None,
+                   histogram_cache=None,
+                   output_format='drishti',
+                   pyramid_factors=PYRAMID_FACTORS,
+                   resume=False,
+                   grid_size=1024,
+                   memory_limit=None,
+                   scratch_directory=None):
+
+    """
+    Creates the fluor and trans volumes for one mouse
+
+    Channels are processed concurrently when there is enough memory (or up
+    to max_channels at a time, if given). Volumes are written by a
+    background thread, so writing one volume overlaps with computing
+    the next.
+
+    Besides the full-resolution volumes, block-averaged copies are written
+    at each of pyramid_factors (see volume_pyramid.py); pass an empty tuple
+    to skip them.
+
+    With resume=True, the intermediate volumes are always saved and each
+    completed stage is recorded in stages.json in the output directory.
+    A later run with resume=True skips every stage whose inputs and
+    parameters have not changed.
+
+    The fused engine can create larger volumes (grid_size, e.g. 2048 for
+    5 micron voxels). Passing memory_limit (in bytes) processes them out of
+    core: the intermediate data are kept in memory-mapped files in a
+    temporary directory inside scratch_directory (default = the output
+    directory), and resampling is done in blocks that fit memory_limit,
+    shared between the channels processed at once.
+
+    """
+
+    if engine not in ('sequential', 'fused'):
+        raise ValueError('Unknown engine: ' + str(engine))
+
+    if engine != 'fused' and (grid_size != 1024 or memory_limit is not None):
+        raise ValueError('grid_size and memory_limit require the fused engine')
+
+    print(input_directory)
+    print(output_directory)
+    image_types = ('fluor','trans')
+
+    if max_channels is None and memory_limit is not None:
+        max_channels = 1
+    elif max_channels is None:
+        memory = available_memory()
+        if memory is None:
+            max_channels = 1
+        else:
+            max_channels = memory // estimate_channel_memory(imwidth, engine,
+                                                             grid_size)
+
+    max_channels = int(min(max(max_channels, 1), len(image_types)))
+
+    print('Processing ' + str(max_channels) + ' channel(s) at a time')
+
+    mouse_name = 'mouse' + str(mouse)
+    data_directory = os.path.join(output_directory, str(mouse))
+
+    if resume:
+        os.makedirs(data_directory, exist_ok=True)
+        manifest = StageManifest(os.path.join(data_directory, 'stages.json'))
+        save_checkpoints = True
+    else:
+        manifest = None
+
+    if memory_limit is not None:
+        if scratch_directory is None:
+            scratch_directory = data_directory
+        os.makedirs(scratch_directory, exist_ok=True)
+        scratch = tempfile.TemporaryDirectory(prefix='opt_scratch_',
+                                              dir=scratch_directory)
+        channel_memory = memory_limit // max_channels
+    else:
+        scratch = None
+        channel_memory = None
+
+    # the scratch files are removed only after the writer has saved them
+    with contextlib.ExitStack() as stack:
+
+        scratch_path = None if scratch is None else stack.enter_context(scratch)
+        writer = stack.enter_context(BackgroundWriter())
+
+        def run_channel(image_type):
+
+            def save(volume, suffix, stage=None, key=None, pyramid=None):
+
+                record = manifest is not None and stage is not None
+
+                # the writer runs tasks in order, so the stage is only
+                # recorded after its file has been completely written
+                if record:
+                    writer.submit(manifest.discard, image_type, stage)
+
+                writer.submit(save_volume, volume, mouse_name,
+                              data_directory, image_type + suffix,
+                              output_format, pyramid)
+
+                if record:
+                    writer.submit(manifest.record, image_type, stage, key,
+                                  volume_filename(mouse_name, data_directory,
+                                                  image_type + suffix,
+                                                  output_format))
+
+            def stage_file(stage, key, suffix):
+
+                fname = volume_filename(mouse_name, data_directory,
+                                        image_type + suffix, output_format)
+
+                if manifest.completed(image_type, stage, key, fname):
+                    return fname
+
+                return None
+
+            process_channel(input_directory, image_type, save,
+                            rot1, rot2, rot3, offset1, offset2,
+                            flip_image, imwidth, num_workers, engine,
+                            num_threads, save_checkpoints,
+                            histogram_samples, histogram_cache,
+                            pyramid_factors,
+                            stage_file if manifest is not None else None,
+                            grid_size, scratch_path, channel_memory)
+
+        if max_channels > 1:
+            with ThreadPoolExecutor(max_channels) as executor:
+                list(executor.map(run_channel, image_types))
+        else:
+            for image_type in image_types:
+                run_channel(image_type)
 
     print('DONE.')
 
 # %%
 
 
+OPTIONS = 'w:t:e:cn:s:f:'
+
+LONG_OPTIONS = ['workers=', 'threads=', 'engine=', 'checkpoints', 'channels=',
+                'histogram-samples=', 'format=', 'no-pyramid', 'resume',
+                'grid-size=', 'memory-limit=', 'scratch=', 'profile=']
+
+
 def main(argv):
 
+   try:
+       opts, argv = getopt.gnu_getopt(argv, OPTIONS, LONG_OPTIONS)
+   except getopt.GetoptError as err:
+       print('ERROR: ' + str(err))
+       return 1
+
+   num_workers = 1
+   num_threads = 1
+   engine = 'sequential'
+   save_checkpoints = False
+   max_channels = None
+   histogram_samples = None
+   output_format = 'drishti'
+   pyramid_factors = PYRAMID_FACTORS
+   resume = False
+   grid_size = 1024
+   memory_limit = None
+   scratch_directory = None
+
+   for opt, value in opts:
+       if opt in ('-w', '--workers'):
+           num_workers = int(value)
+       elif opt in ('-t', '--threads'):
+           num_threads = int(value)
+       elif opt in ('-e', '--engine'):
+           engine = value
+       elif opt in ('-c', '--checkpoints'):
+           save_checkpoints = True
+       elif opt in ('-n', '--channels'):
+           max_channels = int(value)
+       elif opt in ('-s', '--histogram-samples'):
+           histogram_samples = int(value)
+       elif opt in ('-f', '--format'):
+           output_format = value
+       elif opt == '--no-pyramid':
+           pyramid_factors = ()
+       elif opt == '--resume':
+           resume = True
+       elif opt == '--grid-size':
+           grid_size = int(value)
+       elif opt == '--memory-limit':
+           memory_limit = int(float(value) * pow(1024, 3))
+       elif opt == '--scratch':
+           scratch_directory = value
+       elif opt == '--profile':
+           enable_profiling(value)
+
    if len(argv) > 1:
        print('ERROR: Only one input argument allowed (path to transforms.json file)')
+       return 1
    elif len(argv) < 1:
        print('ERROR: Required input argument (path to transforms.json file)')
+       return 1
    else:
 
-       import json
-
        dictionary = json.load(open(argv[0]))
 
        if len(dictionary['output_directory']) == 0:
@@ -289,8 +1208,23 @@ def main(argv):
                    dictionary['rot3'],
                    dictionary['offset1'],
                    dictionary['offset2'],
-                   flip_image)
+                   flip_image,
+                   imwidth=dictionary.get('imwidth', 1488),
+                   num_workers=num_workers,
+                   engine=engine,
+                   num_threads=num_threads,
+                   save_checkpoints=save_checkpoints,
+                   max_channels=max_channels,
+                   histogram_samples=histogram_samples,
+                   histogram_cache=os.path.join(os.path.dirname(argv[0]),
+                                                'histogram_bounds.json'),
+                   output_format=output_format,
+                   pyramid_factors=pyramid_factors,
+                   resume=resume,
+                   grid_size=grid_size,
+                   memory_limit=memory_limit,
+                   scratch_directory=scratch_directory)
 
 if __name__ == "__main__":
-   main(sys.argv[1:])
+   sys.exit(main(sys.argv[1:]))
 
@@ -20,6 +20,8 @@ import warnings
 
 import os
 
+from slice_reader import prefetch_images
+
 NEW_OPT = False
 FLIP_IMAGE = True
 
@@ -403,10 +405,9 @@ class App(QWidget):
 
             print('Loading downsampled volume...')
 
-            for file_idx, filename in enumerate(filenames):
+            for file_idx, arr in enumerate(prefetch_images(filenames)):
 
                 printProgressBar(file_idx+1, len(filenames))
-                arr = np.array(Image.open(filename))
 
                 if NEW_OPT:
                     arr = arr - 5000
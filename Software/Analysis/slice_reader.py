@@ -0,0 +1,79 @@
+"""
+
+Prefetching reader for stacks of reconstructed TIFF slices
+
+On network-mounted storage, the latency of opening each file dominates the
+time spent reading a stack. prefetch_images keeps several reads in flight
+on a thread pool while the caller processes earlier slices, and still
+yields the arrays in order.
+
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+def read_image(filename):
+
+    """
+    Reads one image file into an np.ndarray
+
+    """
+
+    with Image.open(filename) as im:
+        return np.array(im)
+
+
+def prefetch_images(filenames, max_in_flight=8, max_bytes=pow(2,29),
+                    read=read_image):
+
+    """
+    Reads a list of images on a thread pool, yielding them in order
+
+    Parameters
+    ==========
+    filenames - list of image filenames
+    max_in_flight - maximum number of reads queued or running at once
+    max_bytes - maximum memory held by decoded images that have not been
+                yielded yet; the number of reads in flight is reduced
+                to stay below it (at least one read is always in flight)
+    read - function that reads one file (default = read_image)
+
+    Yields
+    ======
+    imarray - np.ndarray for each filename, in order
+
+    """
+
+    filenames = list(filenames)
+
+    if len(filenames) == 0:
+        return
+
+    with ThreadPoolExecutor(max_in_flight) as executor:
+
+        pending = deque([executor.submit(read, filenames[0])])
+        next_index = 1
+
+        try:
+
+            first = pending[0].result()
+            limit = max(1, min(max_in_flight, max_bytes // max(first.nbytes, 1)))
+
+            while len(pending) > 0:
+
+                imarray = pending.popleft().result()
+
+                while len(pending) < limit and next_index < len(filenames):
+                    pending.append(executor.submit(read, filenames[next_index]))
+                    next_index += 1
+
+                yield imarray
+
+        finally:
+
+            for future in pending:
+                future.cancel()
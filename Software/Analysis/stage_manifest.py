@@ -0,0 +1,93 @@
+"""
+
+Records which stages of a volume have been completed, so that an
+interrupted or re-parameterized run can resume from the first stage that
+needs to be redone.
+
+Each stage has a key: a hash of its parameters and of the key of the
+stage before it. Changing a parameter therefore changes the key of its
+own stage and of every later stage, while earlier stages still match.
+
+The manifest is a JSON file:
+
+    {channel: {stage: {'key': ..., 'file': ...}}}
+
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+
+def stage_key(*parts):
+
+    """
+    Hashes the parameters of a stage (any JSON-serializable values)
+
+    """
+
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class StageManifest:
+
+    """
+    Completed stages of each channel, stored in a JSON file
+
+    A stage is recorded only once its output file has been written, and is
+    discarded before the file is overwritten, so the manifest never points
+    to a partially written file. The manifest may be shared between
+    threads.
+
+    """
+
+    def __init__(self, fname):
+
+        self.fname = fname
+        self.lock = threading.Lock()
+
+    def _read(self):
+
+        if not os.path.exists(self.fname):
+            return {}
+
+        with open(self.fname) as f:
+            return json.load(f)
+
+    def _write(self, stages):
+
+        temp_fname = self.fname + '.tmp'
+
+        with open(temp_fname, 'w') as f:
+            json.dump(stages, f, indent=2)
+
+        os.replace(temp_fname, self.fname)
+
+    def completed(self, channel, stage, key, fname):
+
+        """
+        Returns True if the stage was completed with the same key and its
+        output (fname) still exists
+
+        """
+
+        with self.lock:
+            entry = self._read().get(channel, {}).get(stage)
+
+        return (entry is not None and entry['key'] == key and
+                entry['file'] == fname and os.path.exists(fname))
+
+    def record(self, channel, stage, key, fname):
+
+        with self.lock:
+            stages = self._read()
+            stages.setdefault(channel, {})[stage] = {'key': key, 'file': fname}
+            self._write(stages)
+
+    def discard(self, channel, stage):
+
+        with self.lock:
+            stages = self._read()
+            if stages.get(channel, {}).pop(stage, None) is not None:
+                self._write(stages)
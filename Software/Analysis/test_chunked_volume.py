@@ -0,0 +1,82 @@
+"""
+
+Tests for chunked_volume.py
+
+A volume written as a .cvol file must read back unchanged, whole, sliced
+across chunk boundaries and converted to Drishti format.
+
+Run with:
+
+    python -m pytest Software/Analysis
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chunked_volume
+from volume_io import load_volume
+
+
+def synthetic_volume(shape=(40, 30, 20), dtype='uint16'):
+
+    # Distinct values, so that any misplaced chunk is detected; the shape is
+    # not a multiple of the chunk size, so the grid has partial chunks
+    return (np.arange(np.prod(shape)) % 60000).astype(dtype).reshape(shape)
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'zstd'])
+def test_round_trip(tmpdir, codec):
+
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+
+    volume = synthetic_volume()
+    fname = os.path.join(str(tmpdir), 'volume.cvol')
+
+    chunked_volume.save_chunked_volume(volume, fname, chunk_size=16, codec=codec,
+                                       num_threads=4)
+
+    np.testing.assert_array_equal(chunked_volume.load_chunked_volume(fname), volume)
+    np.testing.assert_array_equal(load_volume(fname), volume)
+
+
+def test_slicing(tmpdir):
+
+    volume = synthetic_volume()
+    fname = os.path.join(str(tmpdir), 'volume.cvol')
+
+    chunked_volume.save_chunked_volume(volume, fname, chunk_size=16, codec='zlib')
+
+    chunked = chunked_volume.ChunkedVolume(fname)
+
+    assert chunked.shape == volume.shape
+    assert chunked.dtype == volume.dtype
+
+    for key in [(17,), (-1,), (slice(10, 35), slice(5, 29), slice(15, 20)),
+                (slice(None), 3, slice(None)), (39, 29, 19)]:
+        np.testing.assert_array_equal(chunked[key], volume[key])
+
+    with pytest.raises(IndexError):
+        chunked[40]
+
+    with pytest.raises(IndexError):
+        chunked[::2]
+
+
+def test_chunked_to_drishti(tmpdir):
+
+    volume = synthetic_volume(dtype='uint8')
+    fname = os.path.join(str(tmpdir), 'volume.cvol')
+    drishti_fname = os.path.join(str(tmpdir), 'volume.pvl.nc')
+
+    chunked_volume.save_chunked_volume(volume, fname, chunk_size=16, codec='zlib')
+    chunked_volume.chunked_to_drishti(fname, drishti_fname)
+
+    assert os.path.isfile(drishti_fname)
+    np.testing.assert_array_equal(load_volume(drishti_fname + '.001'), volume)
@@ -0,0 +1,103 @@
+"""
+
+Tests for stage_manifest.py
+
+A stage counts as completed only if it was recorded with the same key and
+its output file still exists.
+
+Run with:
+
+    python -m pytest Software/Analysis
+
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stage_manifest import StageManifest, stage_key
+
+
+def output_file(tmpdir, name):
+
+    fname = os.path.join(str(tmpdir), name)
+
+    with open(fname, 'w') as f:
+        f.write('volume')
+
+    return fname
+
+
+def test_stage_key():
+
+    assert stage_key('images', 1.5, [2, 4, 8]) == stage_key('images', 1.5, [2, 4, 8])
+    assert stage_key('images', 1.5) != stage_key('images', 2.5)
+    assert stage_key({'a': 1, 'b': 2}) == stage_key({'b': 2, 'a': 1})
+
+    # a changed earlier stage changes the key of every later one
+    assert stage_key(stage_key('rot1'), 'rot2') != stage_key(stage_key('other'), 'rot2')
+
+
+def test_record_and_completed(tmpdir):
+
+    manifest = StageManifest(os.path.join(str(tmpdir), 'stages.json'))
+    fname = output_file(tmpdir, 'mouse1_fluor_rot1.pvl.nc.001')
+
+    assert not manifest.completed('fluor', 'rot1', 'key1', fname)
+
+    manifest.record('fluor', 'rot1', 'key1', fname)
+
+    assert manifest.completed('fluor', 'rot1', 'key1', fname)
+
+    # another instance reads the same file
+    assert StageManifest(manifest.fname).completed('fluor', 'rot1', 'key1', fname)
+
+    # other channels and stages are not affected
+    assert not manifest.completed('trans', 'rot1', 'key1', fname)
+    assert not manifest.completed('fluor', 'rot2', 'key1', fname)
+
+
+def test_key_mismatch(tmpdir):
+
+    manifest = StageManifest(os.path.join(str(tmpdir), 'stages.json'))
+    fname = output_file(tmpdir, 'mouse1_fluor_rot1.pvl.nc.001')
+
+    manifest.record('fluor', 'rot1', 'key1', fname)
+
+    assert not manifest.completed('fluor', 'rot1', 'key2', fname)
+    assert not manifest.completed('fluor', 'rot1', 'key1',
+                                  output_file(tmpdir, 'mouse1_fluor_rot1.cvol'))
+
+
+def test_missing_output(tmpdir):
+
+    manifest = StageManifest(os.path.join(str(tmpdir), 'stages.json'))
+    fname = output_file(tmpdir, 'mouse1_fluor_rot1.pvl.nc.001')
+
+    manifest.record('fluor', 'rot1', 'key1', fname)
+    os.remove(fname)
+
+    assert not manifest.completed('fluor', 'rot1', 'key1', fname)
+
+
+def test_discard(tmpdir):
+
+    manifest = StageManifest(os.path.join(str(tmpdir), 'stages.json'))
+    rot1_file = output_file(tmpdir, 'mouse1_fluor_rot1.pvl.nc.001')
+    rot2_file = output_file(tmpdir, 'mouse1_fluor_rot2.pvl.nc.001')
+
+    manifest.record('fluor', 'rot1', 'key1', rot1_file)
+    manifest.record('fluor', 'rot2', 'key2', rot2_file)
+
+    manifest.discard('fluor', 'rot2')
+    manifest.discard('trans', 'rot2')
+
+    assert manifest.completed('fluor', 'rot1', 'key1', rot1_file)
+    assert not manifest.completed('fluor', 'rot2', 'key2', rot2_file)
+
+    with open(manifest.fname) as f:
+        assert json.load(f) == {'fluor': {'rot1': {'key': 'key1', 'file': rot1_file}}}
+
+    assert not os.path.exists(manifest.fname + '.tmp')
@@ -0,0 +1,111 @@
+"""
+
+Tests for volume_pyramid.py
+
+Every pyramid level must equal the block mean of the full-resolution
+volume, however the volume is split into slabs while it is written.
+
+Run with:
+
+    python -m pytest Software/Analysis
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import volume_pyramid
+from chunked_volume import save_chunked_volume
+from volume_io import write_volume
+
+
+def synthetic_volume(shape=(37, 26, 20)):
+
+    # Not a multiple of 8 along any axis, so the far edges have partial blocks
+    return np.random.RandomState(0).randint(0, 256, shape).astype('uint8')
+
+
+def reference_level(volume, factor):
+
+    # Mean over factor x factor x factor blocks, dropping partial blocks
+    shape = [n // factor for n in volume.shape]
+    level = np.zeros(shape)
+
+    for i, j, k in np.ndindex(*shape):
+        level[i, j, k] = volume[i * factor:(i + 1) * factor,
+                                j * factor:(j + 1) * factor,
+                                k * factor:(k + 1) * factor].mean()
+
+    return level
+
+
+def test_build_pyramid():
+
+    volume = synthetic_volume()
+
+    levels = volume_pyramid.build_pyramid(volume)
+
+    assert sorted(levels) == list(volume_pyramid.PYRAMID_FACTORS)
+
+    for factor, level in levels.items():
+        assert level.dtype == volume.dtype
+        # levels are averaged from the unrounded previous level, then rounded
+        np.testing.assert_allclose(level, reference_level(volume, factor), atol=0.5)
+
+
+@pytest.mark.parametrize('slab_size', [1, 5, 8, 64])
+def test_slabs(slab_size):
+
+    volume = synthetic_volume()
+
+    expected = volume_pyramid.build_pyramid(volume)
+
+    pyramid = volume_pyramid.PyramidBuilder(volume.shape, volume.dtype)
+
+    for start in range(0, volume.shape[0], slab_size):
+        pyramid.add(volume[start:start + slab_size])
+
+    levels = pyramid.finish()
+
+    for factor in expected:
+        np.testing.assert_array_equal(levels[factor], expected[factor])
+
+
+@pytest.mark.parametrize('writer', ['drishti', 'chunked'])
+def test_built_while_writing(tmpdir, writer):
+
+    volume = synthetic_volume()
+
+    expected = volume_pyramid.build_pyramid(volume)
+
+    pyramid = volume_pyramid.PyramidBuilder(volume.shape, volume.dtype)
+
+    if writer == 'drishti':
+        write_volume(volume, os.path.join(str(tmpdir), 'volume.pvl.nc.001'),
+                     slab_size=12, on_slab=pyramid.add)
+    else:
+        save_chunked_volume(volume, os.path.join(str(tmpdir), 'volume.cvol'),
+                            chunk_size=16, codec='zlib', on_slab=pyramid.add)
+
+    levels = pyramid.finish()
+
+    for factor in expected:
+        np.testing.assert_array_equal(levels[factor], expected[factor])
+
+
+def test_factors_must_divide():
+
+    with pytest.raises(ValueError):
+        volume_pyramid.PyramidBuilder((16, 16, 16), 'uint8', (2, 3))
+
+
+def test_pyramid_filename():
+
+    assert volume_pyramid.pyramid_filename('mouse1_fluor.pvl.nc', 2) == 'mouse1_fluor_ds2.pvl.nc'
+    assert volume_pyramid.pyramid_filename('mouse1_fluor.pvl.nc.001', 4) == 'mouse1_fluor_ds4.pvl.nc.001'
+    assert volume_pyramid.pyramid_filename('mouse1_fluor.cvol', 8) == 'mouse1_fluor_ds8.cvol'
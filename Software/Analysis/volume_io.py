@@ -0,0 +1,371 @@
+"""
+
+Reading and writing OPT volumes in Drishti format
+
+A volume is stored as two files: a raw data file (.pvl.nc.001) and a small
+XML description (.pvl.nc).
+
+A Drishti raw file has a 13-byte header followed by the voxel data in C
+order:
+
+    byte 0      voxel type (0 = unsigned char, 1 = char, 2 = unsigned short,
+                3 = short, 4 = int, 5 = float)
+    bytes 1-12  grid size as three little-endian int32 values
+
+"""
+
+import os
+import queue
+import threading
+
+import numpy as np
+
+HEADER_SIZE = 13
+
+FIELD_OF_VIEW = 10240   # width of the output volumes in microns
+
+VOXEL_TYPES = {0: np.dtype('u1'),
+               1: np.dtype('i1'),
+               2: np.dtype('<u2'),
+               3: np.dtype('<i2'),
+               4: np.dtype('<i4'),
+               5: np.dtype('<f4')}
+
+VOXEL_TYPE_NAMES = {0: 'unsigned char',
+                    1: 'char',
+                    2: 'unsigned short',
+                    3: 'short',
+                    4: 'int',
+                    5: 'float'}
+
+NC_FILE_TEMPLATE = """<!DOCTYPE Drishti_Header>
+<PvlDotNcFileHeader>
+  <rawfile></rawfile>
+  <voxeltype>{voxeltype}</voxeltype>
+  <pvlvoxeltype>{voxeltype}</pvlvoxeltype>
+  <gridsize>{gridsize}</gridsize>
+  <voxelunit>micron</voxelunit>
+  <voxelsize>{voxelsize}</voxelsize>
+  <description></description>
+  <slabsize>{slabsize}</slabsize>
+  <rawmap>{rawmap} </rawmap>
+  <pvlmap>{rawmap} </pvlmap>
+</PvlDotNcFileHeader>"""
+
+
+def voxel_type(dtype):
+
+    """
+    Returns the Drishti voxel type code for a numpy dtype
+
+    """
+
+    dtype = np.dtype(dtype).newbyteorder('<')
+
+    for code, voxel_dtype in VOXEL_TYPES.items():
+        if voxel_dtype == dtype:
+            return code
+
+    raise ValueError('Drishti does not support voxels of type ' + str(dtype))
+
+
+def create_header(shape, dtype):
+
+    """
+    Creates the 13-byte header of a Drishti raw file
+
+    Parameters
+    ===========
+    shape - tuple of three ints
+    dtype - np.dtype of the voxels
+
+    Returns
+    ========
+    header - bytes
+
+    """
+
+    if len(shape) != 3:
+        raise ValueError('Drishti volumes must be 3-dimensional')
+
+    return (bytes([voxel_type(dtype)]) +
+            np.array(shape, dtype='<i4').tobytes())
+
+
+def read_header(fname):
+
+    """
+    Reads and validates the header of a Drishti raw file
+
+    Parameters
+    ===========
+    fname - filename (string)
+
+    Returns
+    ========
+    shape - tuple of three ints
+    dtype - np.dtype of the voxels
+
+    """
+
+    with open(fname, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+
+    if len(header) < HEADER_SIZE:
+        raise ValueError(fname + ' is too small to be a Drishti volume')
+
+    if header[0] not in VOXEL_TYPES:
+        raise ValueError(fname + ' has unknown voxel type ' + str(header[0]))
+
+    dtype = VOXEL_TYPES[header[0]]
+    shape = tuple(int(n) for n in np.frombuffer(header[1:], dtype='<i4'))
+
+    if min(shape) <= 0:
+        raise ValueError(fname + ' has invalid grid size ' + str(shape))
+
+    expected_size = HEADER_SIZE + int(np.prod(shape)) * dtype.itemsize
+    actual_size = os.path.getsize(fname)
+
+    if actual_size != expected_size:
+        raise ValueError(fname + ' is ' + str(actual_size) +
+                         ' bytes, expected ' + str(expected_size) +
+                         ' for grid size ' + str(shape))
+
+    return shape, dtype
+
+
+def load_volume(fname, mmap_mode='r'):
+
+    """
+    Loads an OPT volume file in Drishti format
+
+    The volume is memory-mapped rather than read, so opening it takes the
+    same time regardless of its size, and only the slices that are accessed
+    are read from disk.
+
+    Chunked volumes (.cvol, see chunked_volume.py) are decompressed into
+    memory instead.
+
+    Parameters
+    ===========
+    fname - filename (string)
+    mmap_mode - 'r' (read-only, default), 'r+' (read-write) or
+                'c' (copy-on-write); ignored for chunked volumes
+
+    Returns
+    ========
+    volume - 3-dimensional np.memmap (or np.ndarray for chunked volumes)
+
+    """
+
+    if fname.endswith('.cvol'):
+        from chunked_volume import load_chunked_volume
+        return load_chunked_volume(fname)
+
+    shape, dtype = read_header(fname)
+
+    return np.memmap(fname, dtype=dtype, mode=mmap_mode,
+                     offset=HEADER_SIZE, shape=shape)
+
+
+class VolumeWriter:
+
+    """
+    Streams a volume to a Drishti raw file one slab at a time
+
+    The header is written when the file is opened; slabs along the first
+    axis are appended with write() and must add up to shape[0] slices.
+    Nothing larger than one slab is ever held in memory.
+
+    Usage
+    =====
+    with VolumeWriter(fname, shape, dtype) as writer:
+        for slab in slabs:
+            writer.write(slab)
+
+    """
+
+    def __init__(self, fname, shape, dtype='u1'):
+
+        self.fname = fname
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.slices_written = 0
+
+        self.file = open(fname, 'wb')
+        self.file.write(create_header(self.shape, self.dtype))
+
+    def write(self, slab):
+
+        slab = np.asarray(slab)
+
+        if slab.ndim == 2:
+            slab = slab[np.newaxis]
+
+        if slab.shape[1:] != self.shape[1:]:
+            raise ValueError('Slab shape ' + str(slab.shape) +
+                             ' does not match volume shape ' + str(self.shape))
+
+        if self.slices_written + slab.shape[0] > self.shape[0]:
+            raise ValueError('Too many slices written to ' + self.fname)
+
+        np.ascontiguousarray(slab, dtype=self.dtype).tofile(self.file)
+
+        self.slices_written += slab.shape[0]
+
+    def close(self):
+
+        if self.file.closed:
+            return
+
+        self.file.close()
+
+        if self.slices_written != self.shape[0]:
+            raise ValueError(self.fname + ' is incomplete: ' +
+                             str(self.slices_written) + ' of ' +
+                             str(self.shape[0]) + ' slices written')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+def write_volume(volume, fname, slab_size=32, on_slab=None):
+
+    """
+    Writes a volume to a Drishti raw file without copying it
+
+    The volume may be any array-like with a shape, including non-contiguous
+    views such as transposes; only one slab of slab_size slices is made
+    contiguous at a time.
+
+    Parameters
+    ===========
+    volume - 3-dimensional array
+    fname - filename of the raw file (string, usually ending in .pvl.nc.001)
+    slab_size - number of slices written at once
+    on_slab - optional function called with each slab, in order (e.g.
+              PyramidBuilder.add, see volume_pyramid.py)
+
+    """
+
+    with VolumeWriter(fname, volume.shape, volume.dtype) as writer:
+        for start in range(0, volume.shape[0], slab_size):
+            slab = np.ascontiguousarray(volume[start:start + slab_size])
+            writer.write(slab)
+            if on_slab is not None:
+                on_slab(slab)
+
+
+def grid_voxel_size(shape):
+
+    """
+    Returns the voxel size in microns of a volume spanning FIELD_OF_VIEW
+    (e.g. 10 for the 1024-voxel grid, 20 for its 2x pyramid level)
+
+    """
+
+    return FIELD_OF_VIEW / shape[2]
+
+
+def write_nc_header(fname, shape, dtype='u1', voxel_size=10):
+
+    """
+    Writes the XML description (.pvl.nc) for a Drishti raw file
+
+    Parameters
+    ===========
+    fname - filename of the description (string, usually ending in .pvl.nc)
+    shape - tuple of three ints
+    dtype - np.dtype of the voxels
+    voxel_size - voxel size in microns
+
+    """
+
+    dtype = np.dtype(dtype)
+
+    if dtype.kind == 'f':
+        rawmap = '0 1'
+    else:
+        rawmap = str(np.iinfo(dtype).min) + ' ' + str(np.iinfo(dtype).max)
+
+    nc_file_string = NC_FILE_TEMPLATE.format(
+        voxeltype=VOXEL_TYPE_NAMES[voxel_type(dtype)],
+        gridsize=' '.join(str(n) for n in shape),
+        voxelsize=' '.join(['{:g}'.format(voxel_size)] * 3),
+        slabsize=shape[0] + 1,
+        rawmap=rawmap)
+
+    with open(fname, 'w') as f:
+        print(nc_file_string, file=f)
+
+
+class BackgroundWriter:
+
+    """
+    Runs save calls on a background thread so that computation can continue
+    while a volume is written
+
+    The queue is bounded: submit() blocks once max_pending saves are
+    waiting, so at most max_pending + 1 finished volumes are held in memory.
+    Errors raised while saving are re-raised by close().
+
+    Usage
+    =====
+    with BackgroundWriter() as writer:
+        writer.submit(save_volume, volume, mouse, directory, image_type)
+
+    """
+
+    def __init__(self, max_pending=1):
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+
+        while True:
+
+            task = self.queue.get()
+
+            if task is None:
+                break
+
+            function, args, kwargs = task
+
+            try:
+                if self.error is None:
+                    function(*args, **kwargs)
+            except Exception as error:
+                self.error = error
+
+    def submit(self, function, *args, **kwargs):
+
+        if self.error is not None:
+            raise self.error
+
+        self.queue.put((function, args, kwargs))
+
+    def close(self):
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
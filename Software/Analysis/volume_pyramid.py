@@ -0,0 +1,216 @@
+"""
+
+Multi-resolution pyramids of OPT volumes
+
+Each level is the full-resolution volume averaged over blocks of
+factor x factor x factor voxels (partial blocks at the far edges are
+dropped, so a 1023 x 1024 x 1024 volume gives 511 x 512 x 512 at 2x).
+Viewers can open a coarse level instantly and switch to finer levels
+on demand.
+
+Levels are stored next to the full-resolution volume, with '_ds<factor>'
+added to the name: mouse1_fluor.pvl.nc -> mouse1_fluor_ds2.pvl.nc
+
+"""
+
+import numpy as np
+
+from volume_io import load_volume
+
+PYRAMID_FACTORS = (2, 4, 8)
+
+
+def _block_mean(array, factor):
+
+    shape = [n // factor for n in array.shape]
+
+    blocks = array[:shape[0] * factor, :shape[1] * factor, :shape[2] * factor]
+    blocks = blocks.reshape(shape[0], factor, shape[1], factor, shape[2], factor)
+
+    return blocks.mean(axis=(1, 3, 5), dtype='float32')
+
+
+def _cast(mean, dtype):
+
+    if np.dtype(dtype).kind in 'iu':
+        mean = np.round(mean)
+
+    return mean.astype(dtype)
+
+
+def downsample_blocks(array, factor):
+
+    """
+    Averages a 3D array over blocks of factor x factor x factor voxels
+
+    Parameters
+    ==========
+    array - 3-dimensional array
+    factor - block edge length (int)
+
+    Returns
+    =======
+    downsampled - np.ndarray with the dtype of array (integers are rounded)
+
+    """
+
+    return _cast(_block_mean(np.asarray(array), factor), array.dtype)
+
+
+class PyramidBuilder:
+
+    """
+    Computes all downsampled levels of a volume from its slabs, in order
+
+    Slabs along the first axis are passed to add() as the volume is
+    written (see write_volume and save_chunked_volume), so the levels are
+    built in the same pass; only max(factors) slices are buffered, and only
+    the (much smaller) downsampled levels are held in memory (or in the
+    arrays returned by allocate, e.g. memory-mapped files). Each level is
+    averaged from the unrounded previous level, so the full-resolution data
+    is only reduced once.
+
+    Usage
+    =====
+    pyramid = PyramidBuilder(volume.shape, volume.dtype)
+    write_volume(volume, fname, on_slab=pyramid.add)
+    levels = pyramid.finish()
+
+    Parameters
+    ==========
+    shape - shape of the full-resolution volume
+    dtype - dtype of the full-resolution volume (and of the levels)
+    factors - downsampling factors; each must divide the next larger one
+    allocate - function(shape, dtype) creating the array for each level
+
+    """
+
+    def __init__(self, shape, dtype, factors=PYRAMID_FACTORS, allocate=np.zeros):
+
+        self.factors = sorted(factors)
+
+        for previous, factor in zip([1] + self.factors, self.factors):
+            if factor % previous != 0:
+                raise ValueError('Each pyramid factor must divide the next: ' +
+                                 str(self.factors))
+
+        self.dtype = np.dtype(dtype)
+        self.slab_size = self.factors[-1]
+
+        self.levels = {factor: allocate(tuple(n // factor for n in shape),
+                                        self.dtype)
+                       for factor in self.factors}
+
+        self.buffer = None
+        self.start = 0
+
+    def add(self, slab):
+
+        slab = np.asarray(slab)
+
+        if slab.ndim == 2:
+            slab = slab[np.newaxis]
+
+        if self.buffer is not None:
+            slab = np.concatenate([self.buffer, slab])
+
+        complete = slab.shape[0] - slab.shape[0] % self.slab_size
+
+        for start in range(0, complete, self.slab_size):
+            self._reduce(slab[start:start + self.slab_size])
+
+        self.buffer = np.array(slab[complete:]) if complete < slab.shape[0] else None
+
+    def _reduce(self, slab):
+
+        mean = np.ascontiguousarray(slab)
+        previous = 1
+
+        for factor in self.factors:
+
+            mean = _block_mean(mean, factor // previous)
+            previous = factor
+
+            level_start = self.start // factor
+            self.levels[factor][level_start:level_start + mean.shape[0]] = \
+                _cast(mean, self.dtype)
+
+        self.start += slab.shape[0]
+
+    def finish(self):
+
+        """
+        Reduces the remaining slices and returns the levels
+
+        Returns
+        =======
+        levels - dictionary of factor -> downsampled np.ndarray
+
+        """
+
+        if self.buffer is not None:
+            self._reduce(self.buffer)
+            self.buffer = None
+
+        return self.levels
+
+
+def build_pyramid(volume, factors=PYRAMID_FACTORS, allocate=np.zeros):
+
+    """
+    Computes all downsampled levels of a volume in a single pass over it
+
+    The volume is read in slabs of max(factors) slices, so it can be a
+    memory-mapped or non-contiguous array (see PyramidBuilder).
+
+    Parameters
+    ==========
+    volume - 3-dimensional array
+    factors - downsampling factors; each must divide the next larger one
+    allocate - function(shape, dtype) creating the array for each level
+
+    Returns
+    =======
+    levels - dictionary of factor -> downsampled np.ndarray
+
+    """
+
+    pyramid = PyramidBuilder(volume.shape, volume.dtype, factors, allocate)
+
+    for start in range(0, volume.shape[0], pyramid.slab_size):
+        pyramid.add(volume[start:start + pyramid.slab_size])
+
+    return pyramid.finish()
+
+
+def pyramid_filename(fname, factor):
+
+    """
+    Returns the filename of one pyramid level of a volume
+
+    Parameters
+    ==========
+    fname - filename of the full-resolution volume (.pvl.nc, .pvl.nc.001
+            or .cvol)
+    factor - downsampling factor
+
+    """
+
+    for extension in ('.pvl.nc.001', '.pvl.nc', '.cvol'):
+        if fname.endswith(extension):
+            return fname[:-len(extension)] + '_ds' + str(factor) + extension
+
+    raise ValueError('Unknown volume file extension: ' + fname)
+
+
+def load_pyramid_level(fname, factor):
+
+    """
+    Loads one pyramid level of a volume (factor = 1 loads the volume itself)
+
+    """
+
+    if factor == 1:
+        return load_volume(fname)
+
+    return load_volume(pyramid_filename(fname, factor))
@@ -9,36 +9,10 @@ from mpl_toolkits.mplot3d import Axes3D
 
 from scipy.spatial.distance import euclidean
 
-def loadVolume(fname, _dtype='u1'):
-
-    """
-    Loads an OPT volume file in Drishti format
-
-    Parameters
-    ===========
-    fname - filename (string)
-    dtype - data type (default = unsigned 8-bit integer)
-
-    Returns
-    ========
-    volume - 3-dimensional np.ndarray
-
-    """
-        
-    dtype = np.dtype(_dtype)
-
-    volume = np.fromfile(fname, dtype) # read it in
-    
-    z_size = np.sum([volume[1], volume[2] << pow(2,3)])
-    x_size = np.sum([(val << pow(2,i+1)) for i, val in enumerate(volume[8:4:-1])])
-    y_size = np.sum([(val << pow(2,i+1)) for i, val in enumerate(volume[12:8:-1])])
-    
-    fsize = np.array([z_size, x_size, y_size]).astype('int')
-
-    volume = np.reshape(volume[13:], fsize) # remove 13-byte header and reshape
-    
-    return volume
+from volume_io import load_volume
+from instrumentation import stage, profiled
 
+@profiled()
 def define_transform(source_landmarks, target_landmarks, volume_size=[1024, 1024, 1023]):
 
     """
@@ -130,6 +104,7 @@ def plot_transform(source_landmarks, target_landmarks):
     return fig
 
 
+@profiled()
 def transform_probe_coordinates(transform, probe_annotations, save_figures=False):
 
     """
@@ -281,11 +256,13 @@ if __name__ == "__main__":
 
     scan_type = 'fluor'
 
+    loading = stage('load_inputs', mouse=mouse).start()
+
     fname = os.path.join(prefix, mouse, 'probe_annotations.csv')
     probe_annotations = pd.read_csv(fname, index_col = 0)
 
-    volume = loadVolume(prefix + mouse + '/mouse' + mouse + '_' + scan_type + '.pvl.nc.001')
-    template = loadVolume('/mnt/md0/data/opt/template_brain/template_fluor.pvl.nc.001')
+    volume = load_volume(prefix + mouse + '/mouse' + mouse + '_' + scan_type + '.pvl.nc.001')
+    template = load_volume('/mnt/md0/data/opt/template_brain/template_fluor.pvl.nc.001')
     labels = np.load('/mnt/md0/data/opt/annotation_volume_10um_by_index.npy')
 
     source_landmarks = np.load(prefix + mouse + '/landmark_annotations.npy')
@@ -293,6 +270,8 @@ if __name__ == "__main__":
 
     structure_tree = pd.read_csv('/mnt/md0/data/opt/template_brain/ccf_structure_tree_2017.csv')
 
+    loading.stop()
+
     output_file = prefix + mouse + '/initial_ccf_coordinates.csv'
 
     source_landmarks = source_landmarks[:,np.array([2,0,1])]
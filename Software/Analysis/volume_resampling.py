@@ -0,0 +1,307 @@
+"""
+
+Single-pass resampling of OPT volumes.
+
+The crop, rotations, flip and resize applied by opt_volume_creator are all
+affine, so they can be composed into one 4 x 4 matrix that maps output voxel
+indices to input voxel indices. The output grid is then resampled once,
+instead of interpolating the data after every step.
+
+All matrices follow the scipy.ndimage convention: they map *output*
+coordinates to *input* coordinates, in homogeneous form.
+
+"""
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import affine_transform, spline_filter
+
+
+def rotation_matrix(angle, shape, axes=(0, 1), ndim=3):
+
+    """
+    Matrix equivalent to scipy.ndimage.rotate with reshape=False
+
+    Parameters
+    ==========
+    angle - rotation angle in degrees
+    shape - shape of the rotated plane (sizes along axes)
+    axes - the two axes defining the plane of rotation
+    ndim - number of dimensions of the full coordinate space
+
+    Returns
+    =======
+    matrix - np.ndarray ((ndim + 1) x (ndim + 1))
+
+    """
+
+    theta = np.deg2rad(angle)
+    c, s = np.cos(theta), np.sin(theta)
+
+    rot = np.array([[c, s], [-s, c]])
+    center = (np.asarray(shape, dtype='float') - 1) / 2
+
+    matrix = np.eye(ndim + 1)
+    axes = list(axes)
+
+    matrix[np.ix_(axes, axes)] = rot
+    matrix[axes, ndim] = center - rot @ center
+
+    return matrix
+
+
+def scaling_matrix(scale, offset):
+
+    """
+    Matrix mapping output index i to input index scale * i + offset
+
+    Parameters
+    ==========
+    scale - per-axis scale factors
+    offset - per-axis offsets
+
+    Returns
+    =======
+    matrix - np.ndarray ((ndim + 1) x (ndim + 1))
+
+    """
+
+    ndim = len(scale)
+
+    matrix = np.eye(ndim + 1)
+    matrix[np.arange(ndim), np.arange(ndim)] = scale
+    matrix[:ndim, ndim] = offset
+
+    return matrix
+
+
+def flip_matrix(size, axis, ndim=3):
+
+    """
+    Matrix equivalent to reversing one axis of length size
+
+    """
+
+    matrix = np.eye(ndim + 1)
+    matrix[axis, axis] = -1
+    matrix[axis, ndim] = size - 1
+
+    return matrix
+
+
+def _mapped_corners(matrix, output_shape):
+
+    ndim = len(output_shape)
+
+    corners = np.array(np.meshgrid(*[[0, n - 1] for n in output_shape],
+                                   indexing='ij')).reshape(ndim, -1)
+    corners = np.vstack((corners, np.ones((1, corners.shape[1]))))
+
+    return (matrix @ corners)[:ndim]
+
+
+def input_bounds(matrix, output_shape, input_shape, margin=1):
+
+    """
+    Finds the region of the input needed to resample the output grid
+
+    Parameters
+    ==========
+    matrix - output -> input matrix
+    output_shape - shape of the output grid
+    input_shape - shape of the full input
+    margin - extra voxels to include around the region
+
+    Returns
+    =======
+    lower, upper - integer index bounds of the input region (upper exclusive)
+
+    """
+
+    mapped = _mapped_corners(matrix, output_shape)
+
+    lower = np.floor(mapped.min(axis=1)).astype('int') - margin
+    upper = np.ceil(mapped.max(axis=1)).astype('int') + margin + 1
+
+    lower = np.clip(lower, 0, input_shape)
+    upper = np.clip(upper, 0, input_shape)
+
+    return lower, upper
+
+
+def resample(source, matrix, output_shape, output=None, order=1, cval=200,
+             num_threads=1, tile_size=32):
+
+    """
+    Resamples a volume once through an affine matrix, tile by tile
+
+    The output is split into tiles along its first axis, and each tile is
+    resampled on a thread pool (scipy.ndimage releases the GIL while
+    interpolating). For order > 1 the spline coefficients are computed
+    once for the whole source rather than once per tile.
+
+    Parameters
+    ==========
+    source - input np.ndarray (3D)
+    matrix - output -> input matrix (4 x 4)
+    output_shape - shape of the output volume
+    output - optional preallocated output array
+    order - spline interpolation order (default = 1, trilinear)
+    cval - value used outside the input
+    num_threads - number of threads (default = 1)
+    tile_size - number of output slices per tile
+
+    Returns
+    =======
+    output - np.ndarray with the dtype of source
+
+    """
+
+    if output is None:
+        output = np.zeros(output_shape, dtype=source.dtype)
+
+    if order > 1:
+        source = spline_filter(source, order, output=np.float32)
+
+    def resample_tile(start):
+
+        stop = min(start + tile_size, output_shape[0])
+
+        tile_matrix = matrix @ scaling_matrix(np.ones((3,)), [start, 0, 0])
+
+        affine_transform(source, tile_matrix,
+                         output_shape=(stop - start,) + tuple(output_shape[1:]),
+                         output=output[start:stop],
+                         order=order, cval=cval, prefilter=False)
+
+    starts = range(0, output_shape[0], tile_size)
+
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            list(executor.map(resample_tile, starts))
+    else:
+        for start in starts:
+            resample_tile(start)
+
+    return output
+
+
+def block_size_for_memory(matrix, output_shape, memory_limit, order=1,
+                          itemsize=1, num_threads=1, max_block_size=256):
+
+    """
+    Finds the largest cubic block size for resample_blocks whose working
+    memory stays within memory_limit
+
+    Each thread holds one output block and the input region it maps to
+    (plus a float64 copy of that region for order > 1).
+
+    Parameters
+    ==========
+    matrix - output -> input matrix (4 x 4)
+    output_shape - shape of the output volume
+    memory_limit - memory available for resampling, in bytes
+    order - spline interpolation order
+    itemsize - bytes per voxel
+    num_threads - number of threads resampling blocks at once
+    max_block_size - largest block size considered
+
+    Returns
+    =======
+    block_size - int (a power of two, at least 16)
+
+    """
+
+    block_size = max_block_size
+
+    while block_size > 16:
+
+        block_shape = [min(block_size, n) for n in output_shape]
+        mapped = _mapped_corners(matrix, block_shape)
+
+        region_size = np.prod(np.ceil(np.ptp(mapped, axis=1)) + 2 * order + 3)
+        region_bytes = region_size * (itemsize + (8 if order > 1 else 0))
+
+        if num_threads * (region_bytes + 2 * np.prod(block_shape) * itemsize) <= memory_limit:
+            break
+
+        block_size //= 2
+
+    return block_size
+
+
+def resample_blocks(source, matrix, output_shape, output=None, order=1,
+                    cval=200, num_threads=1, block_size=128):
+
+    """
+    Resamples a volume through an affine matrix, one cubic output block at
+    a time, reading only the input region each block needs
+
+    Unlike resample, the source is never accessed as a whole, so it can be
+    a memory-mapped array much larger than the available memory; the same
+    holds for output. Memory use is bounded by num_threads blocks and
+    their input regions (see block_size_for_memory).
+
+    For order > 1 the spline coefficients are computed per block, on an
+    input region with a wider margin, so the result differs very slightly
+    from resample near block edges. For order <= 1 it is identical.
+
+    Parameters
+    ==========
+    source - input array (3D), e.g. np.memmap
+    matrix - output -> input matrix (4 x 4)
+    output_shape - shape of the output volume
+    output - optional preallocated output array (e.g. np.memmap)
+    order - spline interpolation order (default = 1, trilinear)
+    cval - value used outside the input
+    num_threads - number of threads (default = 1)
+    block_size - edge length of the output blocks
+
+    Returns
+    =======
+    output - array with the dtype of source
+
+    """
+
+    if output is None:
+        output = np.zeros(output_shape, dtype=source.dtype)
+
+    margin = order if order <= 1 else order + 4
+
+    def resample_block(start):
+
+        stop = [min(s + block_size, n) for s, n in zip(start, output_shape)]
+        block_shape = tuple(b - a for a, b in zip(start, stop))
+
+        block_matrix = matrix @ scaling_matrix(np.ones((3,)), start)
+
+        lower, upper = input_bounds(block_matrix, block_shape, source.shape,
+                                    margin)
+
+        index = tuple(slice(a, b) for a, b in zip(start, stop))
+
+        if np.any(upper <= lower):
+            output[index] = cval
+            return
+
+        region = np.asarray(source[tuple(slice(a, b) for a, b in zip(lower, upper))])
+        region_matrix = scaling_matrix(np.ones((3,)), -lower) @ block_matrix
+
+        output[index] = affine_transform(region, region_matrix,
+                                         output_shape=block_shape,
+                                         order=order, cval=cval,
+                                         prefilter=order > 1)
+
+    starts = [(i, j, k) for i in range(0, output_shape[0], block_size)
+                        for j in range(0, output_shape[1], block_size)
+                        for k in range(0, output_shape[2], block_size)]
+
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            list(executor.map(resample_block, starts))
+    else:
+        for start in starts:
+            resample_block(start)
+
+    return output
@@ -13,6 +13,8 @@ import matplotlib.pyplot as plt
 import tifffile
 from matplotlib.patches import Ellipse
 
+from projectionContainer import hasContainer, openContainer, pagesForAngles
+
 
 def optFeatureDetector(img, featureType = 'corner', subPixel = False):
     # Take an image and return centroids for all features detected in image
@@ -97,26 +99,41 @@ def fitEllipseCorrected(cont):
     return params,ell_coord
 
 
-def main(imgFolder, imgStep, detectionType, subpixelFitting):
+def main(imgFolder, imgStep, detectionType, subpixelFitting, invertImg = False, pointRange = []):
     # Main method of feature detection
     # Takes input folder path, parameters for fitting
     # Returns filtered image enhancing features and localized positions of features
 
-    # Get list of files. Is defined by imgRot_XXXX.tif, where XXXX is position in image series.
-    # Is a folder with a list of files
-    onlyFiles = [f for f in os.listdir(imgFolder) if os.path.isfile(os.path.join(imgFolder, f)) and re.search('imgRot_\d{4}.tif', f)]
+    projections = None
     
-    if len(onlyFiles) is 0:
-        onlyFiles = [f for f in os.listdir(imgFolder) if os.path.isfile(os.path.join(imgFolder, f)) and re.search('\W+ome.tif', f)]
+    if hasContainer(imgFolder):
+        # Is a projection container (see projectionContainer.py)
+        # Its pages are in the orientation of the imgRot_XXXX.tif files
+        projections = openContainer(imgFolder)
+        numPlanes = len(projections)
+        
+        planes = pagesForAngles(imgFolder, [360*k/numPlanes for k in range(0, numPlanes, imgStep)])
     
-    # Is a single MicroManager ome.tiff file
-    if len(onlyFiles) == 1:
-        isSeries = False
-        numPlanes = len(tifffile.TiffFile(os.path.join(imgFolder, onlyFiles[0])).pages)
     else:
-        isSeries = True
-        numPlanes = len(onlyFiles)
+        # Get list of files. Is defined by imgRot_XXXX.tif, where XXXX is position in image series.
+        # Is a folder with a list of files
+        onlyFiles = sorted(f for f in os.listdir(imgFolder) if os.path.isfile(os.path.join(imgFolder, f)) and re.search(r'imgRot_\d{4}.tif', f))
+        
+        if len(onlyFiles) == 0:
+            onlyFiles = [f for f in os.listdir(imgFolder) if os.path.isfile(os.path.join(imgFolder, f)) and re.search(r'\W+ome.tif', f)]
+        
+        # Is a single MicroManager ome.tiff file
+        if len(onlyFiles) == 1:
+            isSeries = False
+            numPlanes = len(tifffile.TiffFile(os.path.join(imgFolder, onlyFiles[0])).pages)
+        else:
+            isSeries = True
+            numPlanes = len(onlyFiles)
+            
+        planes = range(0, numPlanes, imgStep)
     
+    if numPlanes == 0:
+        raise ValueError('No imgRot_XXXX.tif files, ome.tif stack or projection container in ' + imgFolder)
     
     cornerList = np.array([])
     dstAccum = np.array([])
@@ -125,7 +142,7 @@ def main(imgFolder, imgStep, detectionType, subpixelFitting):
     angleStep = 2*np.pi/numPlanes
     
     
-    for k in range(0, numPlanes, imgStep):
+    for k in planes:
     #for k in range(0, 200, imgStep):
         
         print('Analyzing plane {}'.format(k))
@@ -133,7 +150,9 @@ def main(imgFolder, imgStep, detectionType, subpixelFitting):
         
         
         # Load file
-        if isSeries:
+        if projections is not None:
+            img = np.asarray(projections[k])
+        elif isSeries:
             f = onlyFiles[k]
             with tifffile.TiffFile(os.path.join(imgFolder, f)) as tif:
                 img = tif.asarray()
@@ -298,7 +317,7 @@ if __name__ == "__main__":
     
     #%%
     # Detect features and return filtered image, detected points
-    dstAccum, cornerList = main(imgFolder, imgStep, detectionType, subpixelFitting)
+    dstAccum, cornerList = main(imgFolder, imgStep, detectionType, subpixelFitting, invertImg, pointRange)
     
     #%% Fit point to ellipse 
     
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Block-mean downsampling of projections
+
+Each downsampled pixel is the mean of a factor x factor block of pixels,
+which (unlike taking every factor-th pixel) does not alias. The levels of a
+frame are computed in one pass: each level is averaged from the previous
+one, from unrounded float32 means, so a level equals the block mean of the
+full frame.
+
+"""
+
+import numpy as np
+
+
+DOWNSAMPLE_FACTORS = (2, 4, 8)
+
+
+def blockMean(img, factor):
+    # float32 mean over factor x factor blocks, dropping incomplete blocks
+
+    rows = img.shape[0] // factor
+    cols = img.shape[1] // factor
+
+    blocks = np.asarray(img[:rows*factor, :cols*factor])
+    blocks = blocks.reshape(rows, factor, cols, factor)
+
+    return blocks.mean(axis = (1, 3), dtype = 'float32')
+
+
+def downsampleLevels(img, factors = DOWNSAMPLE_FACTORS):
+    # Dictionary of factor -> downsampled frame, in the data type of img
+    # (rounded for integer types); factors must be increasing powers of two
+
+    levels = {}
+
+    level = img
+    current = 1
+
+    for factor in sorted(factors):
+
+        level = blockMean(level, factor // current)
+        current = factor
+
+        if np.dtype(img.dtype).kind in 'iu':
+            levels[factor] = np.rint(level).astype(img.dtype)
+        else:
+            levels[factor] = level.astype(img.dtype)
+
+    return levels
+
+
+def downsampleFolderName(factor):
+    # Output folder of a level; 4x keeps the original 'downsample' name
+
+    return 'downsample' if factor == 4 else 'downsample' + str(factor)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Flat-field and dark-frame correction of projection stacks
+
+Each frame is corrected as
+
+    corrected = (raw - dark) * mean(flat - dark) / (flat - dark)
+
+where dark and flat are smoothed averages of dark (no light) and flat (no
+specimen) acquisitions. The factor mean(flat - dark) is the same for every
+frame, so corrected frames keep the intensity scale of the raw data and the
+relative intensities between frames, and can be stored in the raw data type.
+
+Smoothing the reference frames is the slow part, so they are computed once
+per channel and cached as a .npz file.
+
+Usage
+=====
+correction = FlatFieldCorrection.fromFiles(flatFile, darkFile, cacheFolder = outputFolder)
+frames = correction.apply(frames)         # (pages, rows, columns) float32, in place
+
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import tifffile
+
+from scipy.ndimage import gaussian_filter
+
+
+def averageFrame(fileName):
+    # Mean of all pages of a TIFF (stack) as float32
+
+    with tifffile.TiffFile(fileName) as tif:
+
+        total = None
+
+        for page in tif.pages:
+            img = page.asarray().astype('float32')
+            total = img if total is None else total + img
+
+    return total / len(tif.pages)
+
+
+def smoothedFrame(fileName, sigma = 8):
+    # Average of a reference stack, smoothed to remove noise and dust
+
+    return gaussian_filter(averageFrame(fileName), sigma)
+
+
+def cacheKey(*parts):
+    # Hash of the reference files (path, size, modification time) and
+    # parameters, so that the cache is rebuilt when any of them changes
+
+    description = []
+
+    for part in parts:
+        if isinstance(part, str) and os.path.isfile(part):
+            stat = os.stat(part)
+            description.append([os.path.abspath(part), stat.st_size, stat.st_mtime])
+        else:
+            description.append(part)
+
+    return hashlib.sha1(json.dumps(description).encode()).hexdigest()[:16]
+
+
+class FlatFieldCorrection:
+
+    """
+    Flat-field and dark-frame correction for one channel
+
+    Parameters
+    ==========
+    flat - smoothed flat frame (rows, columns)
+    dark - smoothed dark frame, or a constant camera offset (default = 0)
+
+    """
+
+    def __init__(self, flat, dark = 0):
+
+        self.dark = np.asarray(dark, dtype = 'float32')
+
+        signal = np.asarray(flat, dtype = 'float32') - self.dark
+        floor = max(1e-3*np.mean(signal), 1e-6)
+
+        self.gain = (np.mean(signal) / np.maximum(signal, floor)).astype('float32')
+
+    @classmethod
+    def fromFiles(cls, flatFile, darkFile = None, sigma = 8, cacheFolder = None):
+        """
+        Builds the correction from flat (and dark) TIFF stacks, reusing the
+        cached frames in cacheFolder if the files and sigma have not changed
+
+        """
+
+        if cacheFolder is None:
+            return cls(smoothedFrame(flatFile, sigma),
+                       0 if darkFile is None else smoothedFrame(darkFile, sigma))
+
+        cacheFile = os.path.join(cacheFolder, 'flatfield_' +
+                                 cacheKey(flatFile, darkFile, sigma) + '.npz')
+
+        if os.path.isfile(cacheFile):
+            with np.load(cacheFile) as cached:
+                correction = cls.__new__(cls)
+                correction.dark = cached['dark']
+                correction.gain = cached['gain']
+                return correction
+
+        correction = cls(smoothedFrame(flatFile, sigma),
+                         0 if darkFile is None else smoothedFrame(darkFile, sigma))
+
+        os.makedirs(cacheFolder, exist_ok = True)
+
+        # np.savez adds .npz to names without it
+        tempFile = cacheFile[:-len('.npz')] + '.tmp.npz'
+        np.savez(tempFile, dark = correction.dark, gain = correction.gain)
+        os.replace(tempFile, cacheFile)
+
+        return correction
+
+    def apply(self, frames):
+        # Correct a float32 frame or (pages, rows, columns) batch in place
+
+        frames -= self.dark
+        frames *= self.gain
+
+        return frames
+
+    def correct(self, frames, dtype = None):
+        # Corrected copy of integer frames, in their own data type (or dtype),
+        # clipped to its range
+
+        if dtype is None:
+            dtype = frames.dtype
+
+        corrected = self.apply(np.asarray(frames, dtype = 'float32'))
+
+        limits = np.iinfo(dtype)
+        np.clip(corrected, limits.min, limits.max, out = corrected)
+        np.rint(corrected, out = corrected)
+
+        return corrected.astype(dtype)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Single-file container for the projections of an acquisition
+
+Instead of one imgRot_XXXX.tif file per angle, all projections are written
+as the pages of one tiled, uncompressed BigTIFF (projections.tif), in the
+orientation of the imgRot_XXXX.tif files. A sidecar (projections.index.json)
+lists the angle of every page and the file offset of each of its tiles, so
+opening the container does not parse the TIFF, and reading any subset of
+angles, or a band of detector rows, only reads the tiles it needs from a
+memory map of the file.
+
+The container can be opened with any TIFF reader (e.g. Fiji), and read here
+with openContainer(), which returns a StackReader:
+
+    projections = openContainer(folder)
+    band = projections[k][100:108]            # detector rows 100-107 at angle k
+    pages = pagesForAngles(folder, [0, 90, 180, 270])
+
+"""
+
+import json
+import os
+
+import numpy as np
+import tifffile
+
+from stackReader import StackReader, indexPage
+
+
+CONTAINER_FILE = 'projections.tif'
+INDEX_FILE = 'projections.index.json'
+
+# Tile dimensions must be multiples of 16
+TILE_SHAPE = (64, 256)
+
+
+class ContainerWriter:
+
+    """
+    Appends projections, in angle order, to a container
+
+    Parameters
+    ==========
+    folder - folder for projections.tif and projections.index.json
+    angleRange - total rotation of the projections in degrees
+    tileShape - (rows, columns) of a tile
+
+    The index is written when the writer is closed, so an incomplete
+    container (e.g. after a crash) has no index and is not used. Leaving a
+    with block by an exception removes the partial container (see abort).
+
+    """
+
+    def __init__(self, folder, angleRange = 360, tileShape = TILE_SHAPE):
+
+        self.folder = folder
+        self.angleRange = angleRange
+        self.tileShape = tuple(tileShape)
+
+        indexFile = os.path.join(folder, INDEX_FILE)
+        if os.path.isfile(indexFile):
+            os.remove(indexFile)
+
+        self.tif = tifffile.TiffWriter(os.path.join(folder, CONTAINER_FILE), bigtiff = True)
+
+        # TiffWriter.save was renamed TiffWriter.write in newer tifffile versions
+        self._write = getattr(self.tif, 'write', None) or self.tif.save
+
+        self.numPages = 0
+
+    def write(self, img):
+
+        self._write(np.ascontiguousarray(img), tile = self.tileShape)
+        self.numPages += 1
+
+    def close(self):
+
+        self.tif.close()
+        writeIndex(self.folder, self.angleRange)
+
+    def abort(self):
+        # Close and remove the partial container
+
+        self.tif.close()
+
+        fileName = os.path.join(self.folder, CONTAINER_FILE)
+        if os.path.isfile(fileName):
+            os.remove(fileName)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def writeIndex(folder, angleRange = 360):
+    # Index the pages of the container in folder, and write the sidecar
+
+    with tifffile.TiffFile(os.path.join(folder, CONTAINER_FILE)) as tif:
+        pages = [indexPage(page, tif.byteorder) for page in tif.pages]
+
+    index = {'file': CONTAINER_FILE,
+             'angle_range': angleRange,
+             'angles': [k*angleRange/len(pages) for k in range(len(pages))],
+             'pages': pages}
+
+    with open(os.path.join(folder, INDEX_FILE + '.tmp'), 'w') as f:
+        json.dump(index, f)
+
+    os.replace(os.path.join(folder, INDEX_FILE + '.tmp'), os.path.join(folder, INDEX_FILE))
+
+    return index
+
+
+def readIndex(folder):
+    # Index of the container in folder, or None if there is no (complete)
+    # container
+
+    indexFile = os.path.join(folder, INDEX_FILE)
+
+    if not os.path.isfile(indexFile):
+        return None
+
+    with open(indexFile) as f:
+        return json.load(f)
+
+
+def hasContainer(folder):
+
+    return os.path.isfile(os.path.join(folder, INDEX_FILE))
+
+
+def openContainer(folder):
+    # StackReader for the projections of the container in folder
+
+    index = readIndex(folder)
+
+    if index is None:
+        raise ValueError('No projection container in ' + folder)
+
+    return StackReader(os.path.join(folder, index['file']), transpose = False,
+                       index = index['pages'])
+
+
+def pagesForAngles(folder, angles):
+    # Pages of the projections nearest to the given angles (in degrees)
+
+    index = readIndex(folder)
+
+    containerAngles = np.array(index['angles'])
+    angleRange = index['angle_range']
+
+    # Nearest angle, wrapping around the full rotation
+    difference = np.abs(np.subtract.outer(np.mod(angles, angleRange), containerAngles))
+    difference = np.minimum(difference, angleRange - difference)
+
+    return [int(page) for page in np.argmin(difference, axis = 1)]
@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+"""
+Filtered back-projection of OPT projections
+
+Reconstructs the imgRot_XXXX.tif projections written by stackToOPTPlanes
+into imgRot__recXXXXXXXX.tif slices (one per detector row), in the layout
+expected by the Analysis scripts, without an external reconstruction tool.
+
+Usage:
+
+    python reconstruction.py [options] <projection folder> ...
+
+    -w, --workers N         number of worker processes (default = number of cores)
+    -r, --rows N            detector rows reconstructed together (default = 8)
+    -c, --channel TYPE      'fluor' (emission) or 'trans' (absorption, log-
+                            transformed); default = taken from the path
+    --center-offset PIXELS  rotation axis offset from the detector centre
+    --tilt DEGREES          rotation axis tilt
+    --filter NAME           'ramp', 'shepp-logan' or 'hann' (default = 'ramp')
+    --angle-range DEGREES   360 or 180 (default = 360)
+
+The projection folder is e.g. <output>/<mouse>/fluor/native; the slices are
+written to its 'recon' subfolder. Unless given, the centre offset and tilt
+are read from reconstruction.json in the projection folder (written by
+rotationAxis.py), and are 0 if it does not exist.
+
+If the folder has no imgRot_XXXX.tif files, the projections are read from
+its projection container (see projectionContainer.py), or else directly
+from the stack named in its reconstruction.json (see stackToOPTPlanes with
+writePlanes = False).
+
+"""
+
+import json
+import os
+import re
+import sys, getopt
+
+import numpy as np
+import tifffile
+
+from multiprocessing import Pool
+
+from stackReader import StackReader
+from projectionContainer import CONTAINER_FILE, INDEX_FILE, hasContainer, openContainer
+
+
+PROJECTION_PATTERN = re.compile(r'imgRot_(\d{4})\.tif$')
+SLICE_NAME = 'imgRot__rec{:08d}.tif'
+METADATA_FILE = 'reconstruction.json'
+
+# tifffile.imsave was renamed tifffile.imwrite in newer tifffile versions
+imwrite = getattr(tifffile, 'imwrite', None) or tifffile.imsave
+
+
+def listProjections(projectionFolder):
+    # Sorted list of imgRot_XXXX.tif files in folder
+
+    files = [f for f in os.listdir(projectionFolder) if PROJECTION_PATTERN.match(f)]
+    files.sort(key = lambda f: int(PROJECTION_PATTERN.match(f).group(1)))
+
+    return [os.path.join(projectionFolder, f) for f in files]
+
+
+def readMetadata(projectionFolder):
+    # Reconstruction parameters stored with the projections (empty if none)
+
+    fileName = os.path.join(projectionFolder, METADATA_FILE)
+
+    if not os.path.isfile(fileName):
+        return {}
+
+    with open(fileName) as f:
+        return json.load(f)
+
+
+def writeMetadata(projectionFolder, values):
+    # Add values to the reconstruction parameters stored with the projections
+
+    metadata = readMetadata(projectionFolder)
+    metadata.update(values)
+
+    with open(os.path.join(projectionFolder, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent = 4)
+
+    return metadata
+
+
+def clearProjections(projectionFolder):
+    # Remove the projections from an earlier run: imgRot_XXXX.tif files, the
+    # projection container and the projection stack in reconstruction.json
+    # projectionSource() would otherwise read them instead of the new ones
+
+    for fileName in listProjections(projectionFolder):
+        os.remove(fileName)
+
+    for name in (INDEX_FILE, CONTAINER_FILE):
+        fileName = os.path.join(projectionFolder, name)
+        if os.path.isfile(fileName):
+            os.remove(fileName)
+
+    metadata = readMetadata(projectionFolder)
+
+    if 'projection_stack' in metadata:
+        del metadata['projection_stack']
+
+        with open(os.path.join(projectionFolder, METADATA_FILE), 'w') as f:
+            json.dump(metadata, f, indent = 4)
+
+
+def rowOffsets(startRow, stopRow, numRows, centerOffset = 0.0, tilt = 0.0):
+    # Rotation axis offset from the detector centre for each row, for an axis
+    # tilted by tilt degrees in the detector plane; centerOffset is the
+    # offset at the middle row
+
+    rows = np.arange(startRow, stopRow) - (numRows - 1) / 2
+
+    return centerOffset + rows*np.tan(np.deg2rad(tilt))
+
+
+def openProjection(fileName):
+    # Memory-map an uncompressed projection, so that a band of rows can be
+    # read without reading the whole plane
+
+    try:
+        return tifffile.memmap(fileName, mode = 'r')
+    except ValueError:
+        return tifffile.imread(fileName)
+
+
+def projectionSource(projectionFolder):
+    # The imgRot_XXXX.tif files in the folder, or if there are none, a
+    # StackReader for its projection container (see projectionContainer.py),
+    # or else for the stack named in its reconstruction.json
+    # All of these can be passed to worker processes cheaply
+
+    projectionFiles = listProjections(projectionFolder)
+
+    if len(projectionFiles) > 0:
+        return projectionFiles
+
+    if hasContainer(projectionFolder):
+        return openContainer(projectionFolder)
+
+    stack = readMetadata(projectionFolder).get('projection_stack')
+
+    if stack is None:
+        raise ValueError('No imgRot_XXXX.tif projections or projection stack in ' + projectionFolder)
+
+    return StackReader(stack)
+
+
+def openProjections(source):
+    # Sequence of projections (angles) from projectionSource()
+
+    if isinstance(source, StackReader):
+        return source
+
+    return [openProjection(f) for f in source]
+
+
+def rampFilter(numDetector, filterName = 'ramp'):
+    # Frequency response of the ramp filter for rfft of length padSize
+    # Built from the band-limited spatial kernel (Kak & Slaney), which avoids
+    # the DC offset of a sampled |f| ramp
+
+    padSize = max(64, int(2**np.ceil(np.log2(2*numDetector))))
+
+    n = np.concatenate((np.arange(1, padSize/2 + 1, 2, dtype = int),
+                        np.arange(padSize/2 - 1, 0, -2, dtype = int)))
+    kernel = np.zeros(padSize)
+    kernel[0] = 0.25
+    kernel[1::2] = -1 / (np.pi*n)**2
+
+    response = 2*np.real(np.fft.rfft(kernel))
+
+    freq = np.fft.rfftfreq(padSize)   # 0 to 0.5 cycles/pixel
+
+    if filterName == 'shepp-logan':
+        response[1:] *= np.sin(np.pi*freq[1:]) / (np.pi*freq[1:])
+    elif filterName == 'hann':
+        response *= 0.5*(1 + np.cos(2*np.pi*freq))
+    elif filterName != 'ramp':
+        raise ValueError('Unknown filter ' + filterName)
+
+    return response.astype('float32'), padSize
+
+
+def filterSinograms(sinograms, filterName = 'ramp', shifts = None):
+    # Ramp-filter a (angles, rows, detector) block along the detector axis,
+    # with one batched FFT over all angles and rows
+    # shifts (one per row, in pixels) moves each row towards lower detector
+    # coordinates in the same pass, e.g. to straighten a tilted axis
+
+    numDetector = sinograms.shape[-1]
+    response, padSize = rampFilter(numDetector, filterName)
+
+    spectrum = np.fft.rfft(sinograms, n = padSize, axis = -1)
+    spectrum *= response
+
+    if shifts is not None:
+        freq = np.fft.rfftfreq(padSize)
+        spectrum *= np.exp(2j*np.pi*np.outer(shifts, freq)).astype('complex64')
+
+    return np.fft.irfft(spectrum, n = padSize, axis = -1)[..., :numDetector].astype('float32')
+
+
+def backProject(filtered, angles, centerOffset = 0.0, outputSize = None):
+    # Back-project a (angles, rows, detector) block of filtered sinograms
+    # Returns (rows, outputSize, outputSize) slices
+    #
+    # The detector coordinates for one angle are computed once and shared by
+    # all rows of the block, which are kept along the last axis so that each
+    # lookup reads them together.
+
+    numAngles, numRows, numDetector = filtered.shape
+
+    if outputSize is None:
+        outputSize = numDetector
+
+    # Zero-pad the detector (one pixel before, two after), so that rays
+    # leaving the detector interpolate to zero
+    padded = np.zeros((numAngles, numDetector + 3, numRows), dtype = 'float32')
+    padded[:, 1:-2, :] = filtered.transpose(0, 2, 1)
+    slope = np.diff(padded, axis = 1)
+
+    coords = np.arange(outputSize, dtype = 'float32') - (outputSize - 1) / 2
+    center = (numDetector - 1) / 2 + centerOffset + 1   # + 1 for the padding
+
+    slices = np.zeros((outputSize, outputSize, numRows), dtype = 'float32')
+
+    u = np.empty((outputSize, outputSize), dtype = 'float32')
+    index = np.empty((outputSize, outputSize), dtype = 'intp')
+    value = np.empty_like(slices)
+    step = np.empty_like(slices)
+
+    for k in range(numAngles):
+
+        np.add(coords[np.newaxis, :]*np.float32(np.cos(angles[k])),
+               coords[:, np.newaxis]*np.float32(np.sin(angles[k])) + np.float32(center),
+               out = u)
+        np.clip(u, 0, numDetector + 1, out = u)
+
+        # Linear interpolation between the two nearest detector pixels
+        index[...] = u
+        u -= index
+
+        np.take(padded[k], index, axis = 0, out = value)
+        np.take(slope[k], index, axis = 0, out = step)
+        step *= u[..., np.newaxis]
+
+        slices += value
+        slices += step
+
+    slices *= np.pi / (2*numAngles)
+
+    return slices.transpose(2, 0, 1)
+
+
+def projectionAngles(numAngles, angleRange = 360, rotationDirection = 1):
+    # Angle of each projection in radians; rotationDirection is 1 for
+    # counter-clockwise and -1 for clockwise rotation
+
+    return rotationDirection*np.arange(numAngles)*np.deg2rad(angleRange)/numAngles
+
+
+def loadSinograms(projections, startRow, stopRow, whiteLevel = None):
+    # Read detector rows [startRow, stopRow) of every projection as a
+    # (angles, rows, detector) float32 block
+    # For absorption (transmission) images, whiteLevel is the unattenuated
+    # intensity, and the block is converted to -log(I / whiteLevel)
+
+    block = np.stack([p[startRow:stopRow] for p in projections]).astype('float32')
+
+    if whiteLevel is not None:
+        np.maximum(block, 1, out = block)
+        block /= whiteLevel
+        np.log(block, out = block)
+        block *= -1
+
+    return block
+
+
+def reconstructRows(projections, startRow, stopRow, params):
+
+    sinograms = loadSinograms(projections, startRow, stopRow, params['whiteLevel'])
+
+    offsets = rowOffsets(startRow, stopRow, projections[0].shape[0],
+                         params['centerOffset'], params['tilt'])
+    centerOffset = np.mean(offsets)
+
+    # Rows whose axis differs from the block's are shifted onto it
+    shifts = offsets - centerOffset if params['tilt'] != 0 else None
+
+    filtered = filterSinograms(sinograms, params['filterName'], shifts)
+
+    return backProject(filtered, params['angles'], centerOffset,
+                       params['outputSize'])
+
+
+def toUint16(slices, dynamicRange):
+
+    low, high = dynamicRange
+    scaled = (slices - low) * (65535 / (high - low))
+
+    return np.clip(scaled, 0, 65535).astype('uint16')
+
+
+_projections = None
+_params = None
+
+
+def _initWorker(source, params):
+
+    global _projections, _params
+
+    _projections = openProjections(source)
+    _params = params
+
+
+def _reconstructBlock(rows):
+
+    startRow, stopRow = rows
+
+    slices = reconstructRows(_projections, startRow, stopRow, _params)
+    slices = toUint16(slices, _params['dynamicRange'])
+
+    for k in range(stopRow - startRow):
+        imwrite(os.path.join(_params['outputFolder'],
+                             SLICE_NAME.format(startRow + k)), slices[k])
+
+    return stopRow - startRow
+
+
+def estimateWhiteLevel(projections, numSamples = 8):
+    # Unattenuated intensity of transmission projections, taken from the
+    # brightest pixels of a few projections
+
+    step = max(1, len(projections) // numSamples)
+
+    samples = [projections[k][::4, ::4] for k in range(0, len(projections), step)]
+
+    return float(np.percentile(np.stack(samples), 99.9))
+
+
+def estimateDynamicRange(projections, params, numSamples = 5):
+    # Output range for the uint16 slices, from a few slices spread across
+    # the detector; values outside it are clipped
+
+    numRows = projections[0].shape[0]
+    rows = np.linspace(numRows*0.1, numRows*0.9, numSamples).astype(int)
+
+    samples = np.stack([reconstructRows(projections, r, r + 1, params)[0] for r in rows])
+    low, high = np.percentile(samples, [0.01, 99.99])
+    margin = 0.1*(high - low)
+
+    return float(low - margin), float(high + margin)
+
+
+def reconstructFolder(projectionFolder, outputFolder = None, channel = None,
+                      numWorkers = None, rowsPerBlock = 8, centerOffset = None,
+                      tilt = None, filterName = 'ramp', angleRange = 360, rotationDirection = 1,
+                      outputSize = None, dynamicRange = None):
+    """
+    Reconstructs all detector rows of a folder of projections
+
+    Parameters
+    ==========
+    projectionFolder - folder with imgRot_XXXX.tif projections, a projection
+                       container, or a reconstruction.json naming the
+                       projection stack
+    outputFolder - where the slices are written (default = projectionFolder/recon)
+    channel - 'fluor' or 'trans'; transmission images are log-transformed
+              (default = 'trans' if the path contains it)
+    numWorkers - number of worker processes (default = number of cores)
+    rowsPerBlock - detector rows reconstructed together by one worker
+    centerOffset - rotation axis offset from the detector centre in pixels
+                   at the middle row (default = from reconstruction.json, or 0)
+    tilt - rotation axis tilt in degrees (default = from reconstruction.json, or 0)
+    filterName - 'ramp', 'shepp-logan' or 'hann'
+    angleRange - total rotation of the projections in degrees
+    rotationDirection - 1 for counter-clockwise, -1 for clockwise
+    outputSize - width of the square slices (default = detector width)
+    dynamicRange - (low, high) values mapped to 0 and 65535
+                   (default = estimated from a few slices)
+
+    Returns
+    =======
+    numSlices - number of slices written
+
+    """
+
+    source = projectionSource(projectionFolder)
+
+    if outputFolder is None:
+        outputFolder = os.path.join(projectionFolder, 'recon')
+
+    os.makedirs(outputFolder, exist_ok = True)
+
+    if channel is None:
+        channel = 'trans' if 'trans' in projectionFolder.lower() else 'fluor'
+
+    if numWorkers is None:
+        numWorkers = os.cpu_count() or 1
+
+    metadata = readMetadata(projectionFolder)
+
+    if centerOffset is None:
+        centerOffset = metadata.get('center_offset', 0.0)
+
+    if tilt is None:
+        tilt = metadata.get('tilt', 0.0)
+
+    projections = openProjections(source)
+    numAngles = len(projections)
+    numRows = projections[0].shape[0]
+
+    params = {'angles': projectionAngles(len(projections), angleRange, rotationDirection),
+              'centerOffset': centerOffset,
+              'tilt': tilt,
+              'filterName': filterName,
+              'outputSize': outputSize,
+              'whiteLevel': estimateWhiteLevel(projections) if channel == 'trans' else None,
+              'outputFolder': outputFolder}
+
+    if dynamicRange is None:
+        dynamicRange = estimateDynamicRange(projections, params)
+
+    params['dynamicRange'] = dynamicRange
+
+    del projections
+
+    blocks = [(start, min(start + rowsPerBlock, numRows))
+              for start in range(0, numRows, rowsPerBlock)]
+
+    print('Reconstructing ' + str(numRows) + ' slices from ' +
+          str(numAngles) + ' projections in ' + projectionFolder +
+          ' (axis offset ' + str(round(centerOffset, 2)) + ' pixels, tilt ' +
+          str(round(tilt, 3)) + ' degrees)')
+
+    numDone = 0
+
+    if numWorkers > 1:
+        with Pool(numWorkers, initializer = _initWorker,
+                  initargs = (source, params)) as pool:
+            for n in pool.imap_unordered(_reconstructBlock, blocks):
+                numDone += n
+    else:
+        _initWorker(source, params)
+        for block in blocks:
+            numDone += _reconstructBlock(block)
+
+    return numDone
+
+
+def main(argv):
+
+    try:
+        opts, argv = getopt.gnu_getopt(argv, 'w:r:c:',
+                                       ['workers=', 'rows=', 'channel=',
+                                        'center-offset=', 'tilt=', 'filter=',
+                                        'angle-range='])
+    except getopt.GetoptError as err:
+        print('ERROR: ' + str(err))
+        return 1
+
+    kwargs = {}
+
+    for opt, value in opts:
+        if opt in ('-w', '--workers'):
+            kwargs['numWorkers'] = int(value)
+        elif opt in ('-r', '--rows'):
+            kwargs['rowsPerBlock'] = int(value)
+        elif opt in ('-c', '--channel'):
+            kwargs['channel'] = value
+        elif opt == '--center-offset':
+            kwargs['centerOffset'] = float(value)
+        elif opt == '--tilt':
+            kwargs['tilt'] = float(value)
+        elif opt == '--filter':
+            kwargs['filterName'] = value
+        elif opt == '--angle-range':
+            kwargs['angleRange'] = float(value)
+
+    if len(argv) == 0:
+        print('ERROR: Required input argument (projection folder)')
+        return 1
+
+    for projectionFolder in argv:
+        numSlices = reconstructFolder(projectionFolder, **kwargs)
+        print('Wrote ' + str(numSlices) + ' slices to ' + os.path.join(projectionFolder, 'recon'))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
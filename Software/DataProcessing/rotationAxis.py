@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Rotation axis offset and tilt from the projections
+
+In a 360 degree scan, the projection at angle + 180 degrees is the mirror
+image of the projection at angle about the rotation axis. Cross-correlating
+each projection with its flipped opposite therefore gives twice the axis
+offset from the detector centre, and doing so separately for bands of
+detector rows gives the tilt of the axis. Only a few pairs of (downsampled)
+projections are read, so this takes seconds.
+
+Usage:
+
+    python rotationAxis.py [options] <projection folder> ...
+
+    -p, --pairs N           number of opposite projection pairs (default = 8)
+    -d, --downsample N      downsampling of the projections (default = 2)
+    -b, --bands N           number of bands of detector rows (default = 16)
+
+The result is written to reconstruction.json in the projection folder,
+where reconstruction.py reads it. Unlike assessTestObject.py, which
+measures how to correct the mounting of the instrument, this measures the
+axis of a scan as acquired, and needs no test object.
+
+"""
+
+import sys, getopt
+
+import numpy as np
+
+from reconstruction import projectionSource, openProjections, writeMetadata
+from downsampling import blockMean
+
+
+def correlationShift(a, b):
+    # Shift d (in pixels) that best maps b onto a, i.e. a(u) ~ b(u - d),
+    # for each row of two (rows, detector) arrays, together with the
+    # normalized peak height of the cross-correlation
+
+    numDetector = a.shape[-1]
+    padSize = 2*numDetector
+
+    a = a - a.mean(axis = -1, keepdims = True)
+    b = b - b.mean(axis = -1, keepdims = True)
+
+    # Taper the outer tenth on each side, so that the edges do not dominate
+    # the correlation
+    taper = max(1, numDetector // 10)
+    window = np.ones(numDetector, dtype = 'float32')
+    window[:taper] = 0.5*(1 - np.cos(np.pi*np.arange(taper) / taper))
+    window[-taper:] = window[:taper][::-1]
+    a = a*window
+    b = b*window
+
+    xcorr = np.fft.irfft(np.fft.rfft(a, padSize)*np.conj(np.fft.rfft(b, padSize)), padSize)
+    xcorr = np.fft.fftshift(xcorr, axes = -1)
+
+    peak = np.argmax(xcorr, axis = -1)
+    peak = np.clip(peak, 1, padSize - 2)
+
+    rows = np.arange(xcorr.shape[0])
+    left, center, right = xcorr[rows, peak - 1], xcorr[rows, peak], xcorr[rows, peak + 1]
+
+    # Sub-pixel position from a parabola through the peak
+    curvature = left - 2*center + right
+    subPixel = np.where(curvature < 0, 0.5*(left - right) / np.where(curvature < 0, curvature, 1), 0)
+
+    norm = np.sqrt(np.sum(a*a, axis = -1)*np.sum(b*b, axis = -1))
+    strength = np.where(norm > 0, center / np.where(norm > 0, norm, 1), 0)
+
+    return peak + subPixel - padSize // 2, strength
+
+
+def estimateRotationAxis(projectionFolder, numPairs = 8, downsample = 2,
+                         numBands = 16, minStrength = 0.5):
+    """
+    Estimates the rotation axis of a 360 degree scan
+
+    Parameters
+    ==========
+    projectionFolder - folder with imgRot_XXXX.tif projections, a projection
+                       container, or a reconstruction.json naming the
+                       projection stack
+    numPairs - number of pairs of opposite projections used
+    downsample - block size used to downsample the projections
+    numBands - number of bands of detector rows, each giving one estimate
+               of the axis position
+    minStrength - bands whose normalized correlation is below this value
+                  (e.g. empty background) are ignored
+
+    Returns
+    =======
+    centerOffset - axis offset from the detector centre in pixels, at the
+                   middle row (as used by reconstruction.py)
+    tilt - axis tilt in degrees
+    numBandsUsed - number of bands the estimate is based on
+
+    """
+
+    projections = openProjections(projectionSource(projectionFolder))
+    numAngles = len(projections)
+
+    if numAngles < 2 or numAngles % 2 != 0:
+        raise ValueError('Need an even number of projections over 360 degrees, found ' +
+                         str(numAngles) + ' in ' + projectionFolder)
+
+    half = numAngles // 2
+    first = np.linspace(0, half, numPairs, endpoint = False).astype(int)
+
+    offsets = []
+    weights = []
+
+    for k in first:
+
+        img = blockMean(projections[k], downsample)
+        opposite = blockMean(projections[k + half], downsample)
+
+        bandSize = img.shape[0] // numBands
+        rows = bandSize*numBands
+
+        # Average the rows of each band to reduce noise
+        img = img[:rows].reshape(numBands, bandSize, -1).mean(axis = 1)
+        opposite = opposite[:rows].reshape(numBands, bandSize, -1).mean(axis = 1)
+
+        # The flipped opposite projection is the projection shifted by
+        # twice the axis offset
+        shift, strength = correlationShift(img, opposite[:, ::-1])
+
+        offsets.append(shift / 2)
+        weights.append(strength)
+
+    numRows, numDetector = projections[0].shape
+
+    # Axis position in downsampled pixels, converted to full-size pixels
+    # (downsampled pixel x covers pixels downsample*x to downsample*x + downsample - 1)
+    axis = np.median(offsets, axis = 0) + (img.shape[-1] - 1) / 2
+    offsets = downsample*axis + (downsample - 1) / 2 - (numDetector - 1) / 2
+    weights = np.median(weights, axis = 0)
+
+    bandRows = (np.arange(numBands) + 0.5)*bandSize*downsample - 0.5
+    middleRow = (numRows - 1) / 2
+
+    use = weights >= minStrength
+
+    if np.sum(use) == 0:
+        raise ValueError('Could not find the rotation axis in ' + projectionFolder)
+
+    if np.sum(use) == 1:
+        return float(offsets[use][0]), 0.0, 1
+
+    slope, intercept = np.polyfit(bandRows[use] - middleRow, offsets[use], 1, w = weights[use])
+
+    return float(intercept), float(np.rad2deg(np.arctan(slope))), int(np.sum(use))
+
+
+def measureRotationAxis(projectionFolder, **kwargs):
+    # Estimate the rotation axis and store it with the projections
+
+    centerOffset, tilt, numBands = estimateRotationAxis(projectionFolder, **kwargs)
+
+    print(projectionFolder + ': axis offset ' + str(round(centerOffset, 2)) +
+          ' pixels, tilt ' + str(round(tilt, 3)) + ' degrees (from ' +
+          str(numBands) + ' bands)')
+
+    return writeMetadata(projectionFolder, {'center_offset': centerOffset,
+                                            'tilt': tilt})
+
+
+def main(argv):
+
+    try:
+        opts, argv = getopt.gnu_getopt(argv, 'p:d:b:',
+                                       ['pairs=', 'downsample=', 'bands='])
+    except getopt.GetoptError as err:
+        print('ERROR: ' + str(err))
+        return 1
+
+    kwargs = {}
+
+    for opt, value in opts:
+        if opt in ('-p', '--pairs'):
+            kwargs['numPairs'] = int(value)
+        elif opt in ('-d', '--downsample'):
+            kwargs['downsample'] = int(value)
+        elif opt in ('-b', '--bands'):
+            kwargs['numBands'] = int(value)
+
+    if len(argv) == 0:
+        print('ERROR: Required input argument (projection folder)')
+        return 1
+
+    for projectionFolder in argv:
+        measureRotationAxis(projectionFolder, **kwargs)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped access to the planes of an OME-TIFF stack
+
+MicroManager writes each projection as one uncompressed, contiguous page of
+the stack. StackReader indexes the position of every page once, and then
+returns each plane as a view into a memory map of the file, so reading one
+projection (or a band of it) does not decode the stack or go through an
+intermediate imgRot_XXXX.tif file. Uncompressed tiled pages (as in the
+projection containers of projectionContainer.py) are indexed by tile, and
+only the tiles of the requested rows and columns are read. Other pages
+(e.g. compressed) are decoded with tifffile instead.
+
+Planes are transposed by default, to match the orientation of the
+imgRot_XXXX.tif files written by stackToOPTPlanes.
+
+"""
+
+import numpy as np
+import tifffile
+
+
+def pageOffset(page):
+    # File offset of the data of an uncompressed, contiguous page, or None
+
+    contiguous = page.is_contiguous
+
+    if isinstance(contiguous, tuple):   # older tifffile versions
+        return int(contiguous[0])
+
+    if contiguous and page.compression == 1 and len(page.shape) == 2:
+        return int(page.dataoffsets[0])
+
+    return None
+
+
+def tileIndex(page):
+    # Tile size and offsets of an uncompressed tiled page, or None
+
+    if (not page.is_tiled or page.compression != 1 or len(page.shape) != 2 or
+            getattr(page, 'tiledepth', 1) != 1):
+        return None
+
+    return {'shape': [int(page.tilelength), int(page.tilewidth)],
+            'offsets': [int(n) for n in page.dataoffsets]}
+
+
+def indexPage(page, byteorder):
+    # Offset (or None), tiles (or None), shape and data type of a page
+
+    entry = {'offset': pageOffset(page),
+             'shape': [int(n) for n in page.shape],
+             'dtype': np.dtype(page.dtype).newbyteorder(byteorder).str}
+
+    if entry['offset'] is None:
+        entry['tiles'] = tileIndex(page)
+
+    return entry
+
+
+def indexStack(fileName):
+    # Index entry (see indexPage) of every page of a TIFF stack
+
+    with tifffile.TiffFile(fileName) as tif:
+        pages = [indexPage(page, tif.byteorder) for page in tif.pages]
+
+    return pages
+
+
+class TiledPlane:
+
+    """
+    A plane stored in uncompressed tiles; indexing it (e.g. plane[100:108])
+    reads only the tiles, and the rows within them, that are needed
+
+    """
+
+    def __init__(self, data, entry):
+
+        self.data = data
+        self.shape = tuple(entry['shape'])
+        self.dtype = np.dtype(entry['dtype'])
+        self.tileShape = tuple(entry['tiles']['shape'])
+        self.offsets = entry['tiles']['offsets']
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        key = key + (slice(None),)*(2 - len(key))
+        rows, cols = [k.indices(n) if isinstance(k, slice) else None
+                      for k, n in zip(key, self.shape)]
+
+        if rows is None or cols is None or rows[2] != 1 or cols[2] != 1:
+            # integers or steps: read the rows, then index in memory
+            return np.asarray(self)[key]
+
+        return self.read(rows[0], rows[1], cols[0], cols[1])
+
+    def read(self, startRow, stopRow, startCol, stopCol):
+        # Copy of rows [startRow, stopRow) and columns [startCol, stopCol)
+
+        tileRows, tileCols = self.tileShape
+        tilesAcross = -(-self.shape[1] // tileCols)
+        tileBytes = tileRows*tileCols*self.dtype.itemsize
+
+        out = np.empty((max(stopRow - startRow, 0), max(stopCol - startCol, 0)), dtype = self.dtype)
+
+        for ty in range(startRow // tileRows, -(-stopRow // tileRows)):
+            for tx in range(startCol // tileCols, -(-stopCol // tileCols)):
+
+                offset = self.offsets[ty*tilesAcross + tx]
+                tile = self.data[offset:offset + tileBytes].view(self.dtype).reshape(self.tileShape)
+
+                r0 = max(startRow, ty*tileRows)
+                r1 = min(stopRow, (ty + 1)*tileRows)
+                c0 = max(startCol, tx*tileCols)
+                c1 = min(stopCol, (tx + 1)*tileCols)
+
+                out[r0 - startRow:r1 - startRow, c0 - startCol:c1 - startCol] = \
+                    tile[r0 - ty*tileRows:r1 - ty*tileRows, c0 - tx*tileCols:c1 - tx*tileCols]
+
+        return out
+
+    def __array__(self, dtype = None, copy = None):
+
+        plane = self.read(0, self.shape[0], 0, self.shape[1])
+
+        return plane if dtype is None else plane.astype(dtype)
+
+
+class StackReader:
+
+    """
+    Sequence of the planes of a TIFF stack
+
+    Parameters
+    ==========
+    fileName - TIFF (e.g. MicroManager OME-TIFF) stack
+    transpose - whether the planes are transposed, as in stackToOPTPlanes
+    index - page index from indexStack (default = read from the file)
+
+    Usage
+    =====
+    stack = StackReader('MMStack_Pos-1.ome.tif')
+    plane = stack[k]                      # memory-mapped view
+    band = stack[k][100:108]              # reads only these rows
+
+    A StackReader can be passed to worker processes; it is pickled as the
+    file name and index, and the file is mapped again in the worker.
+
+    """
+
+    def __init__(self, fileName, transpose = True, index = None):
+
+        self.fileName = fileName
+        self.transpose = transpose
+        self.index = indexStack(fileName) if index is None else index
+
+        self._data = None
+        self._tif = None
+
+    def __getstate__(self):
+
+        return {'fileName': self.fileName,
+                'transpose': self.transpose,
+                'index': self.index}
+
+    def __setstate__(self, state):
+
+        self.__init__(state['fileName'], state['transpose'], state['index'])
+
+    def __len__(self):
+
+        return len(self.index)
+
+    @property
+    def shape(self):
+        # (planes, rows, columns) of the planes as returned
+
+        shape = self.index[0]['shape']
+
+        if self.transpose:
+            shape = shape[::-1]
+
+        return (len(self.index), shape[0], shape[1])
+
+    def __getitem__(self, k):
+
+        if k < 0:
+            k += len(self.index)
+
+        page = self.index[k]
+
+        if page['offset'] is not None or page.get('tiles') is not None:
+
+            if self._data is None:
+                self._data = np.memmap(self.fileName, dtype = 'u1', mode = 'r')
+
+        if page['offset'] is not None:
+
+            dtype = np.dtype(page['dtype'])
+            numBytes = int(np.prod(page['shape']))*dtype.itemsize
+
+            plane = self._data[page['offset']:page['offset'] + numBytes]
+            plane = plane.view(dtype).reshape(page['shape'])
+
+        elif page.get('tiles') is not None:
+
+            plane = TiledPlane(self._data, page)
+
+            if not self.transpose:
+                return plane
+
+            plane = np.asarray(plane)
+
+        else:
+
+            if self._tif is None:
+                self._tif = tifffile.TiffFile(self.fileName)
+
+            plane = self._tif.pages[k].asarray()
+
+        return plane.T if self.transpose else plane
+
+    def __iter__(self):
+
+        for k in range(len(self.index)):
+            yield self[k]
+
+    def close(self):
+
+        self._data = None
+
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
@@ -14,9 +14,46 @@ Created on Thu Jun 07 15:46:51 2018
 
 import tifffile
 import os
+import sys, getopt
+import json
+import multiprocessing
+import shutil
+import time
+import contextlib
+import importlib.util
 import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 #import skimage.filters as filt
 
+from reconstruction import reconstructFolder, writeMetadata, clearProjections, imwrite
+from rotationAxis import measureRotationAxis
+from flatField import FlatFieldCorrection, smoothedFrame
+from downsampling import DOWNSAMPLE_FACTORS, downsampleLevels, downsampleFolderName
+from projectionContainer import ContainerWriter
+
+
+def loadInstrumentation():
+    # Timing instrumentation is shared with the analysis scripts
+    # (../Analysis/instrumentation.py), loaded from its file so that no other
+    # module of that name on the path is picked up
+    # Without the Analysis folder, stages are not recorded
+    
+    fileName = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'Analysis', 'instrumentation.py')
+    
+    if not os.path.isfile(fileName):
+        return lambda name, **args: contextlib.nullcontext()
+    
+    spec = importlib.util.spec_from_file_location('instrumentation', fileName)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    
+    return module.stage
+
+stage = loadInstrumentation()
+
 
 def genBkgdImg(bkgdImage):
 
@@ -27,83 +64,197 @@ def genBkgdImg(bkgdImage):
             
     return bkgd
 
-def stackToOPTPlanes(inputFile, outputFolder, doBackground = False, bkgdDict = {}, includeDownsample = False):
-    
-    with tifffile.TiffFile(inputFile) as tif:
-        for k in range(len(tif.pages)):
-            saveName = 'imgRot_' + format(int(k), '04d') + '.tif'
-            
-            img = tif.pages[k].asarray()
-            
-            if doBackground:
-                
-                if str.find(inputFile, 'fluor'):
-                    bkgd = bkgdDict['fluor']
-                else:
-                    bkgd = bkgdDict['trans']
-                
-                startType = img.dtype
-                # Assuming always an integer datatype
-                maxForType = np.iinfo(startType).max
-                
-                # Frame flattening
-                
-                subImg = img - bkgd.T
-                img = (maxForType*((subImg - np.amin(subImg))/(np.amax(subImg) - np.amin(subImg)))).astype(startType)
-            
+class PlaneWriter:
+    # Writes planes to TIFF files on a pool of threads, while the caller
+    # decodes the next pages
+    # At most maxQueued planes wait to be written, which bounds the memory
+    # used when the disk is slower than decoding.
+
+    def __init__(self, numThreads = 4, maxQueued = 16):
+        
+        self.executor = ThreadPoolExecutor(numThreads)
+        self.maxQueued = maxQueued
+        self.pending = deque()
+        
+        self.numFrames = 0
+        self.numBytes = 0
+        self.startTime = time.time()
+        
+    def submit(self, fileName, img):
+        
+        self.submitTask(imwrite, fileName, img)
+        
+    def submitTask(self, function, *args):
+        # Queue function(*args), where the last argument is the plane
+        # Tasks run in order if there is one thread
+        
+        img = args[-1]
+        
+        self.pending.append(self.executor.submit(function, *args))
+        
+        self.numFrames += 1
+        self.numBytes += img.nbytes
+        
+        while len(self.pending) > self.maxQueued:
+            self.pending.popleft().result()
             
-            imgToSave = img[:, range(0, img.shape[1], 4)]
-            imgToSave = imgToSave[range(0, img.shape[0], 4), :]
+    def close(self):
+        # Wait for all planes, raising the first error
+        
+        try:
+            while len(self.pending) > 0:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown()
             
-            if not os.path.isdir(os.path.split(outputFolder)[0]):
-                os.mkdir(os.path.split(outputFolder)[0])
+        return self.throughput()
+    
+    def throughput(self):
+        # (frames/s, MB/s) since the writer was created
+        
+        elapsed = max(time.time() - self.startTime, 1e-6)
+        
+        return self.numFrames / elapsed, self.numBytes / pow(2, 20) / elapsed
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self.pending:
+                f.cancel()
+            self.executor.shutdown()
             
-            if not os.path.isdir(outputFolder):
-                os.mkdir(outputFolder)
+
+def stackToOPTPlanes(inputFile, outputFolder, doBackground = False, bkgdDict = {}, includeDownsample = False,
+                     writePlanes = True, numWriters = 4, channel = None, batchSize = 16,
+                     downsampleFactors = DOWNSAMPLE_FACTORS, container = False):
+    
+    # Pages are decoded on this thread, batchSize at a time, and written by
+    # numWriters threads.
+    #
+    # With doBackground, each batch is corrected with bkgdDict[channel]
+    # (see genBkgdFigDict and flatField.py). channel is 'fluor' or 'trans',
+    # by default 'fluor' if the input path contains it.
+    #
+    # With includeDownsample, block-mean downsampled copies of every frame
+    # are written to outputFolder/downsample (4x), downsample2,
+    # downsample8, ... (see downsampling.py).
+    #
+    # With writePlanes = False, no imgRot_XXXX.tif files are written to
+    # outputFolder/native. Instead, the stack is named in its
+    # reconstruction.json, and reconstruction.py and rotationAxis.py read
+    # the projections directly from the stack (see stackReader.py).
+    #
+    # With container, the native planes are written as the pages of one
+    # tiled BigTIFF in outputFolder/native, instead of imgRot_XXXX.tif
+    # files (see projectionContainer.py). The pages are written in order on
+    # their own thread. If de-planing fails, the partial container is
+    # removed.
+    #
+    # Projections in outputFolder/native from an earlier run, in any of
+    # these layouts, are removed first, so that reconstruction reads the
+    # new ones.
+    
+    if doBackground and not writePlanes:
+        raise ValueError('Background subtraction requires writing the planes')
+    
+    with stage('stackToOPTPlanes', inputFile=inputFile):
+        
+        nativeFolder = os.path.join(outputFolder, 'native')
+        downsampleFolders = {factor: os.path.join(outputFolder, downsampleFolderName(factor))
+                             for factor in downsampleFactors}
+        
+        os.makedirs(os.path.join(nativeFolder, 'recon'), exist_ok = True)
+        
+        if includeDownsample:
+            for folder in downsampleFolders.values():
+                os.makedirs(os.path.join(folder, 'recon'), exist_ok = True)
+        
+        # Only the projections written by this run are left in nativeFolder
+        clearProjections(nativeFolder)
+        
+        if not writePlanes:
+            writeMetadata(nativeFolder, {'projection_stack': os.path.abspath(inputFile)})
             
-            if not os.path.isdir(os.path.join(outputFolder, 'native')):
-                os.mkdir(os.path.join(outputFolder, 'native'))
+            if not includeDownsample:
+                return True
+        
+        if doBackground:
+            if channel is None:
+                channel = 'fluor' if 'fluor' in inputFile else 'trans'
                 
-            if not os.path.isdir(os.path.join(outputFolder, 'native', 'recon')):
-                os.mkdir(os.path.join(outputFolder, 'native', 'recon'))
+            correction = bkgdDict[channel]
+        
+        with contextlib.ExitStack() as containerStack:
             
-            tifffile.imsave(os.path.join(outputFolder, 'native', saveName), img.T)
+            if writePlanes and container:
+                # Exited in reverse order: the queue is drained (or cancelled)
+                # before the container is closed (or removed)
+                containerWriter = containerStack.enter_context(ContainerWriter(nativeFolder))
+                containerQueue = containerStack.enter_context(PlaneWriter(1))
             
+            with tifffile.TiffFile(inputFile) as tif, PlaneWriter(numWriters) as writer:
+                numPages = len(tif.pages)
                 
-            if includeDownsample:
-                if not os.path.isdir(os.path.join(outputFolder, 'downsample')):
-                    os.mkdir(os.path.join(outputFolder, 'downsample'))
+                for start in range(0, numPages, batchSize):
+                    pages = range(start, min(start + batchSize, numPages))
                     
-                if not os.path.isdir(os.path.join(outputFolder, 'downsample', 'recon')):
-                    os.mkdir(os.path.join(outputFolder, 'downsample', 'recon'))
+                    frames = np.stack([tif.pages[k].asarray() for k in pages])
                     
-                tifffile.imsave(os.path.join(outputFolder, 'downsample', saveName), imgToSave.T)
+                    if doBackground:
+                        frames = correction.correct(frames)
+                    
+                    for k, img in zip(pages, frames):
+                        saveName = 'imgRot_' + format(int(k), '04d') + '.tif'
+                        
+                        if writePlanes and container:
+                            containerQueue.submitTask(containerWriter.write, img.T)
+                        elif writePlanes:
+                            writer.submit(os.path.join(nativeFolder, saveName), img.T)
+                            
+                        if includeDownsample:
+                            for factor, imgToSave in downsampleLevels(img, downsampleFactors).items():
+                                writer.submit(os.path.join(downsampleFolders[factor], saveName), imgToSave.T)
+                        
+                writer.close()
                 
+            if writePlanes and container:
+                containerQueue.close()
+                
+                writer.numFrames += containerQueue.numFrames
+                writer.numBytes += containerQueue.numBytes
             
-            
+        framesPerSecond, mbPerSecond = writer.throughput()
+        print('  Wrote ' + str(writer.numFrames) + ' frames at ' + str(round(framesPerSecond, 1)) +
+              ' frames/s, ' + str(round(mbPerSecond, 1)) + ' MB/s')
+    
     return True
             
 def copyDummyReconFile(dummyReconLogFile, outputFolder):
             
-    if not dummyReconLogFile in os.listdir(os.path.join(outputFolder, 'native')):
-        os.system('copy ' + dummyReconLogFile + ' ' +  os.path.join(outputFolder, 'native', 'imgRot_.log'))
+    if not 'imgRot_.log' in os.listdir(os.path.join(outputFolder, 'native')):
+        shutil.copyfile(dummyReconLogFile, os.path.join(outputFolder, 'native', 'imgRot_.log'))
         
     return True
 
-def genBkgdFigDict(bkgdFileDict):
+def genBkgdFigDict(bkgdFileDict, darkFileDict = {}, blurSigma = 8, cacheFolder = None):
+    # Flat-field (and dark-frame) correction for each channel
+    # The smoothed reference frames are cached in cacheFolder
     
-    bkgdDict = {'trans': genBackgroundFig(bkgdFileDict['trans'], 3),
-                'fluor': genBackgroundFig(bkgdFileDict['fluor'], 3)}
+    bkgdDict = {channel: FlatFieldCorrection.fromFiles(bkgdFileDict[channel],
+                                                       darkFileDict.get(channel),
+                                                       blurSigma, cacheFolder)
+                for channel in ('trans', 'fluor')}
     
     return bkgdDict
 
 def genBackgroundFig(backgroundImage, blurSigma):
     
-    bkgd = tifffile.TiffFile(backgroundImage).asarray().astype(float)
-    
-    subImg = filt.gaussian(bkgd.T, sigma = 8)
-    
-    return subImg
+    return smoothedFrame(backgroundImage, blurSigma)
 
 def parseInputFolder(inputFolder):
     
@@ -149,49 +300,255 @@ def parseInputFolder(inputFolder):
     return fileList
         
         
-def main():
+def acquisitionSettings(inputFile, options):
+    # Description of an acquisition and the options that determine its
+    # output, stored in its completion marker
+    
+    stat = os.stat(inputFile)
+    
+    settings = {'input': os.path.abspath(inputFile),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime}
+    settings.update({key: options[key] for key in OUTPUT_OPTIONS})
+    
+    return settings
+
+def isComplete(outPath, settings):
+    # True if the marker shows the acquisition was processed with the same
+    # input and options
     
-    inputFolder = r'F:\dyiOPT\20191014'
-    outputFolder = r'D:\Data\diyOPT\20191014'
+    marker = os.path.join(outPath, COMPLETION_MARKER)
     
-    alignmentOnly = False
+    if not os.path.isfile(marker):
+        return False
     
-    dummyReconLogFile = r'C:\Users\ScanningLabAnalysis\Documents\Python\diyOPT\imgRot_.log'
+    try:
+        with open(marker) as f:
+            return json.load(f)['settings'] == json.loads(json.dumps(settings))
+    except (ValueError, KeyError):
+        return False
+
+def markComplete(outPath, settings, elapsed):
+    
+    marker = os.path.join(outPath, COMPLETION_MARKER)
     
-    doBackgroundSub = False
-    bkgdImages = {'trans': r'G:\diyOPT\20181113\bfFlat\MMStack_Pos0.ome.tif', 
-                  'fluor': r'G:\diyOPT\20181113\fluorflat\MMStack_Pos0.ome.tif'}
+    with open(marker + '.tmp', 'w') as f:
+        json.dump({'settings': settings,
+                   'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'elapsed_s': round(elapsed, 1)}, f, indent = 4)
+        
+    os.replace(marker + '.tmp', marker)
+
+def processAcquisition(inputFile, outPath, channel, options, ioSlots = None):
+    # De-plane (and reconstruct) one acquisition, unless its completion
+    # marker shows it is up to date
+    # ioSlots is a semaphore limiting how many acquisitions de-plane at once
+    # Returns 'done', 'skipped' or 'failed'
     
-    if doBackgroundSub:
-        bkgdDict = genBkgdFigDict(bkgdImages)
-    else:
-        bkgdDict = {}
+    try:
+        settings = acquisitionSettings(inputFile, options)
+        
+        if not options['force'] and isComplete(outPath, settings):
+            print('Skipping ' + inputFile + ' (complete)')
+            return 'skipped'
+        
+        startTime = time.time()
+        
+        if options['doBackground']:
+            bkgdDict = genBkgdFigDict(options['flatImages'], options['darkImages'],
+                                      cacheFolder = options['cacheFolder'])
+        else:
+            bkgdDict = {}
+        
+        if ioSlots is not None:
+            ioSlots.acquire()
+            
+        try:
+            stackToOPTPlanes(inputFile, outPath, doBackground = options['doBackground'], bkgdDict = bkgdDict,
+                             includeDownsample = options['includeDownsample'],
+                             writePlanes = options['writePlanes'], channel = channel,
+                             container = options['container'])
+        finally:
+            if ioSlots is not None:
+                ioSlots.release()
+        
+        if not options['alignmentOnly']:
+            
+            if options['reconstruct']:
+                measureRotationAxis(os.path.join(outPath, 'native'))
+                reconstructFolder(os.path.join(outPath, 'native'), channel = channel,
+                                  numWorkers = options['reconWorkers'])
+            else:
+                copyDummyReconFile(options['dummyReconLogFile'], outPath)
+        
+        markComplete(outPath, settings, time.time() - startTime)
         
+        print('Successfully deplaned ' + inputFile)
+        
+        return 'done'
+    
+    except Exception as err:
+        print('ERROR: failed to process ' + inputFile + ': ' + repr(err))
+        return 'failed'
+
+def processRun(inputFolder, outputFolder, options, numWorkers = 1, ioJobs = 1):
+    # Process every acquisition found by parseInputFolder on a pool of
+    # numWorkers processes, of which at most ioJobs de-plane at once
+    # Returns a dictionary of input file -> status
+    
     fileList = parseInputFolder(inputFolder)
     
+    jobs = []
+    
     for f in fileList:
         
         inputFile = os.path.join(inputFolder, f[0], f[-1])
         outPath = os.path.join(outputFolder, f[1], f[2])
         
         if os.path.isfile(inputFile):
-    
-            out1 = stackToOPTPlanes(inputFile, outPath, doBackground = doBackgroundSub, bkgdDict = bkgdDict)
-            
-            if out1 and not alignmentOnly:
-                
-                out2 = copyDummyReconFile(dummyReconLogFile, outPath)
-                
-                if out2:
-                    
-                    print('Successfully deplaned ' + inputFile)
-                 
-            else:
-                print("Exited stack deleaving for input " + inputFile)
-                
+            jobs.append((inputFile, outPath, f[2]))
         else:
             print('Path ' + os.path.join(inputFolder, f[0]) + ' does not contain valid stack file.')
+            
+    print('Processing ' + str(len(jobs)) + ' acquisitions, ' + str(numWorkers) +
+          ' at a time (' + str(ioJobs) + ' de-planing)')
+    
+    if options['doBackground']:
+        # Fill the cache of smoothed reference frames once, for all workers
+        genBkgdFigDict(options['flatImages'], options['darkImages'],
+                       cacheFolder = options['cacheFolder'])
+    
+    if numWorkers == 1:
+        return {job[0]: processAcquisition(*job, options = options) for job in jobs}
+    
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(numWorkers) as executor:
+        
+        ioSlots = manager.Semaphore(ioJobs)
+        
+        futures = {executor.submit(processAcquisition, *job, options = options, ioSlots = ioSlots): job[0]
+                   for job in jobs}
+        
+        return {futures[future]: future.result() for future in as_completed(futures)}
 
-if __name__ == "__main__":
-    main()
+
+# Options that change the output of an acquisition (see isComplete)
+OUTPUT_OPTIONS = ['doBackground', 'flatImages', 'darkImages', 'includeDownsample',
+                  'writePlanes', 'container', 'reconstruct', 'alignmentOnly']
+
+COMPLETION_MARKER = 'stackToPlanes.json'
+
+USAGE = """
+Usage:
+
+    python stackToPlanes.py [options] <input folder> <output folder>
+
+De-planes every acquisition (<mouse ID>...[fluor] folder with an
+MMStack_Pos-1.ome.tif) in the input folder to <output folder>/<mouse ID>/<channel>.
+
+    -w, --workers N         acquisitions processed at once (default = 2)
+    --io-jobs N             acquisitions de-planed (reading and writing) at
+                            once, to stay within the disk bandwidth (default = 1)
+    --reconstruct           reconstruct the slices with reconstruction.py
+                            (default = copy the log file needed by NRecon)
+    --recon-workers N       processes reconstructing each acquisition
+                            (default = number of cores / workers)
+    --no-planes             do not write a TIFF per projection; reconstruction
+                            reads the stacks directly
+    --container             write the projections of each acquisition to one
+                            tiled BigTIFF (native/projections.tif) instead
+                            of a TIFF per projection
+    --downsample            also write 2x, 4x and 8x downsampled projections
+    --flat-trans FILE, --flat-fluor FILE
+                            flat-field stacks; enables flat-field correction
+    --dark-trans FILE, --dark-fluor FILE
+                            dark-frame stacks (optional)
+    --recon-log FILE        NRecon log file (default = imgRot_.log next to this script)
+    --alignment-only        only de-plane
+    --force                 also process acquisitions that are complete
+
+An acquisition is complete when <output folder>/<mouse ID>/<channel>/stackToPlanes.json
+records the same input file and options; those are skipped.
+"""
+
+def main(argv):
+    
+    try:
+        opts, argv = getopt.gnu_getopt(argv, 'w:', ['workers=', 'io-jobs=', 'reconstruct', 'recon-workers=',
+                                                    'no-planes', 'downsample', 'flat-trans=', 'flat-fluor=',
+                                                    'dark-trans=', 'dark-fluor=', 'recon-log=',
+                                                    'container', 'alignment-only', 'force'])
+    except getopt.GetoptError as err:
+        print('ERROR: ' + str(err))
+        print(USAGE)
+        return 1
+    
+    if len(argv) != 2:
+        print('ERROR: Required input arguments (input folder, output folder)')
+        print(USAGE)
+        return 1
+    
+    inputFolder, outputFolder = argv
+    
+    numWorkers = 2
+    ioJobs = 1
+    reconWorkers = None
+    
+    options = {'doBackground': False,
+               'flatImages': {},
+               'darkImages': {},
+               'includeDownsample': False,
+               'writePlanes': True,
+               'container': False,
+               'reconstruct': False,
+               'alignmentOnly': False,
+               'force': False,
+               'dummyReconLogFile': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imgRot_.log'),
+               'cacheFolder': outputFolder}
+    
+    for opt, value in opts:
+        if opt in ('-w', '--workers'):
+            numWorkers = int(value)
+        elif opt == '--io-jobs':
+            ioJobs = int(value)
+        elif opt == '--reconstruct':
+            options['reconstruct'] = True
+        elif opt == '--recon-workers':
+            reconWorkers = int(value)
+        elif opt == '--no-planes':
+            options['writePlanes'] = False
+        elif opt == '--container':
+            options['container'] = True
+        elif opt == '--downsample':
+            options['includeDownsample'] = True
+        elif opt.startswith('--flat-'):
+            options['flatImages'][opt[len('--flat-'):]] = os.path.abspath(value)
+        elif opt.startswith('--dark-'):
+            options['darkImages'][opt[len('--dark-'):]] = os.path.abspath(value)
+        elif opt == '--recon-log':
+            options['dummyReconLogFile'] = value
+        elif opt == '--alignment-only':
+            options['alignmentOnly'] = True
+        elif opt == '--force':
+            options['force'] = True
+    
+    if len(options['flatImages']) > 0:
+        if sorted(options['flatImages']) != ['fluor', 'trans']:
+            print('ERROR: Flat-field correction needs both --flat-trans and --flat-fluor')
+            return 1
+        options['doBackground'] = True
+    
+    if reconWorkers is None:
+        reconWorkers = max(1, (os.cpu_count() or 1) // numWorkers)
         
+    options['reconWorkers'] = reconWorkers
+    
+    status = processRun(inputFolder, outputFolder, options, numWorkers, ioJobs)
+    
+    counts = {s: list(status.values()).count(s) for s in ('done', 'skipped', 'failed')}
+    print(str(counts['done']) + ' done, ' + str(counts['skipped']) + ' skipped, ' +
+          str(counts['failed']) + ' failed')
+    
+    return 0 if counts['failed'] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for reconstruction.py
+
+The same projections, read from imgRot_XXXX.tif files, directly from the
+acquired stack (StackReader) and from a projection container, must give
+the same slices.
+
+Run with:
+
+    python -m pytest Software/DataProcessing
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import tifffile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import reconstruction
+import stackToPlanes
+from projectionContainer import ContainerWriter
+from reconstruction import imwrite
+
+
+def syntheticProjections(numAngles = 24, numRows = 16, numDetector = 32):
+    # Transmission projections (angles, rows, detector) of an absorbing
+    # cylinder parallel to the rotation axis, 5 pixels off the axis
+
+    angles = np.linspace(0, 2*np.pi, numAngles, endpoint = False)
+    u = np.arange(numDetector) - (numDetector - 1) / 2
+
+    chord = 2*np.sqrt(np.maximum(36 - (u[np.newaxis, :] - 5*np.cos(angles)[:, np.newaxis])**2, 0))
+    transmission = 4000*np.exp(-0.05*chord)
+
+    return np.repeat(transmission[:, np.newaxis, :], numRows, axis = 1).astype('uint16')
+
+
+def writeProjections(folder, projections, layout):
+    # Store the projections in folder as imgRot_XXXX.tif files, as an
+    # OME-TIFF stack named in reconstruction.json, or as a container
+
+    os.makedirs(folder)
+
+    if layout == 'planes':
+        for k, img in enumerate(projections):
+            imwrite(os.path.join(folder, 'imgRot_' + format(k, '04d') + '.tif'), img)
+
+    elif layout == 'stack':
+        # the acquired pages are the transpose of the projections
+        stackFile = os.path.join(folder, 'MMStack_Pos-1.ome.tif')
+        imwrite(stackFile, np.ascontiguousarray(projections.transpose(0, 2, 1)))
+        reconstruction.writeMetadata(folder, {'projection_stack': stackFile})
+
+    elif layout == 'container':
+        with ContainerWriter(folder, tileShape = (16, 16)) as writer:
+            for img in projections:
+                writer.write(img)
+
+
+def reconstructLayout(tmpdir, projections, layout, channel):
+
+    folder = os.path.join(str(tmpdir), layout, channel, 'native')
+    writeProjections(folder, projections, layout)
+
+    numSlices = reconstruction.reconstructFolder(folder, channel = channel, numWorkers = 1,
+                                                 rowsPerBlock = 4)
+
+    assert numSlices == projections.shape[1]
+
+    return np.stack([tifffile.imread(os.path.join(folder, 'recon', reconstruction.SLICE_NAME.format(k)))
+                     for k in range(numSlices)])
+
+
+@pytest.mark.parametrize('layout', ['stack', 'container'])
+@pytest.mark.parametrize('channel', ['trans', 'fluor'])
+def test_reconstructFromStackReader(tmpdir, layout, channel):
+
+    projections = syntheticProjections()
+
+    expected = reconstructLayout(tmpdir, projections, 'planes', channel)
+    slices = reconstructLayout(tmpdir, projections, layout, channel)
+
+    folder = os.path.join(str(tmpdir), layout, channel, 'native')
+    assert isinstance(reconstruction.projectionSource(folder), reconstruction.StackReader)
+    assert expected.max() > expected.min()
+    np.testing.assert_array_equal(slices, expected)
+
+
+def test_assessTestObjectFromContainer(tmpdir):
+    # The test-object QC finds the same features in a container as in the
+    # imgRot_XXXX.tif files
+
+    pytest.importorskip('cv2')
+    pytest.importorskip('matplotlib')
+
+    import assessTestObject
+
+    # A dark pin, pointing down from the top of the field of view, whose tip
+    # moves from side to side as it rotates
+    numAngles = 24
+    projections = np.full((numAngles, 64, 64), 4000, dtype = 'uint16')
+
+    for k in range(numAngles):
+        column = int(round(32 + 12*np.cos(2*np.pi*k/numAngles)))
+        projections[k, :40, column - 4:column + 4] = 500
+
+    results = {}
+
+    for layout in ('planes', 'container'):
+        folder = os.path.join(str(tmpdir), layout)
+        writeProjections(folder, projections, layout)
+
+        results[layout] = assessTestObject.main(folder, 5, 'corner', False)
+
+    for expected, found in zip(results['planes'], results['container']):
+        assert len(found) > 0
+        np.testing.assert_array_equal(found, expected)
+
+
+def test_stackReplacesEarlierProjections(tmpdir):
+    # Recording the stack removes the imgRot_XXXX.tif files of an earlier run
+
+    projections = syntheticProjections()
+
+    folder = os.path.join(str(tmpdir), 'native')
+    writeProjections(folder, projections, 'planes')
+
+    stackFile = os.path.join(str(tmpdir), 'MMStack_Pos-1.ome.tif')
+    imwrite(stackFile, np.ascontiguousarray(projections.transpose(0, 2, 1)))
+
+    stackToPlanes.stackToOPTPlanes(stackFile, str(tmpdir), writePlanes = False)
+
+    assert reconstruction.listProjections(folder) == []
+    assert isinstance(reconstruction.projectionSource(folder), reconstruction.StackReader)
+
+
+@pytest.mark.parametrize('earlier, container', [('planes', True), ('container', False)])
+def test_planesReplaceEarlierProjections(tmpdir, earlier, container):
+    # Writing the planes in one layout removes those of an earlier run in the
+    # other, so that reconstruction reads the new ones
+
+    projections = syntheticProjections()
+
+    folder = os.path.join(str(tmpdir), 'native')
+    writeProjections(folder, projections, earlier)
+    reconstruction.writeMetadata(folder, {'projection_stack': 'earlier.ome.tif'})
+
+    stackFile = os.path.join(str(tmpdir), 'MMStack_Pos-1.ome.tif')
+    imwrite(stackFile, np.ascontiguousarray(projections[::2].transpose(0, 2, 1)))
+
+    stackToPlanes.stackToOPTPlanes(stackFile, str(tmpdir), container = container)
+
+    assert 'projection_stack' not in reconstruction.readMetadata(folder)
+    assert reconstruction.hasContainer(folder) == container
+    assert len(reconstruction.openProjections(reconstruction.projectionSource(folder))) == len(projections[::2])